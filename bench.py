@@ -0,0 +1,981 @@
+"""
+Нагрузочный стенд для bot.py.
+
+Поднимает в одном процессе фейковый Bot API (getUpdates / вебхук, sendMessage,
+editMessageText, ...) и фейковый LLM-бэкенд (/chat, /chat_batch и
+OpenRouter-совместимый /v1/chat/completions, обычный и SSE), запускает bot.py
+подпроцессом с TELEGRAM_API_BASE / RUNPOD_HTTP / OPENROUTER_URL, указывающими на
+фейки, и гоняет N пользователей по сценарию /start → story → char → lang → ходы.
+
+    python bench.py load --users 1000 --turns 3
+    python bench.py load --users 200 --llm-latency 800 --llm-error-rate 0.1 --json run.json
+    python bench.py load --users 200 --compare run.json --tolerance 0.2
+    python bench.py restart --users 100 --warm
+    python bench.py restart --users 50 --warm --crash --midturn 0.5 --llm-latency 3000
+
+Остальные настройки бота (RUNPOD_BATCH, OUTBOX_ENABLED, STREAM_REPLIES, ...)
+берутся из окружения как обычно.
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import OrderedDict
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+BENCH_TOKEN = "123456:bench"
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# ---------- МИНИ-HTTP ----------
+# Свой маленький HTTP/1.1-сервер: bot.py не импортируем, а фейковому LLM нужен
+# потоковый ответ (chunked) для SSE.
+async def _serve_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handler) -> None:
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            method, target, version = line.decode("latin-1").strip().split(" ", 2)
+            headers = {}
+            while True:
+                h = await reader.readline()
+                if h in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = h.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+            length = int(headers.get("content-length") or 0)
+            body = await reader.readexactly(length) if length else b""
+            try:
+                status, ctype, payload = await handler(method, target, headers, body)
+            except Exception as e:
+                status, ctype, payload = 500, "text/plain", repr(e).encode()
+            keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {ctype}\r\n"
+            head += f"Connection: {'keep-alive' if keep else 'close'}\r\n"
+            if isinstance(payload, bytes):
+                writer.write(f"{head}Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+            else:
+                writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode("latin-1"))
+                async for chunk in payload:
+                    writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+                    await writer.drain()
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            if not keep:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host: str, port: int, handler) -> asyncio.base_events.Server:
+    return await asyncio.start_server(lambda r, w: _serve_conn(r, w, handler), host, port)
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _json(status: int, obj) -> tuple[int, str, bytes]:
+    return status, "application/json", json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _quantile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# ---------- FAKE TELEGRAM BOT API ----------
+class FakeTelegram:
+    """
+    Bot API в памяти. Апдейты отдаются через long-poll getUpdates или, в
+    webhook-режиме, POST'ом на приёмник бота. Исходящие сообщения бота
+    складываются в очередь чата, откуда их забирает виртуальный пользователь.
+    """
+
+    BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    def __init__(self, webhook_url: str | None = None, webhook_secret: str = ""):
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.pending: list[dict] = []
+        self.has_updates = asyncio.Event()
+        self.polled = asyncio.Event()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.inbox: dict[int, asyncio.Queue] = {}
+        self.calls: dict[str, int] = {}
+        self.dropped = 0  # сброшено deleteWebhook(drop_pending_updates=True)
+        self._webhook_client = None
+        self.last_call = time.monotonic()
+
+    def _message(self, chat_id: int, text: str, reply_markup=None, sender: dict | None = None) -> dict:
+        msg = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": sender or self.BOT_USER,
+            "text": text,
+        }
+        self.next_message_id += 1
+        if reply_markup:
+            msg["reply_markup"] = reply_markup
+        return msg
+
+    async def push(self, update: dict) -> None:
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        if self.webhook_url is None:
+            self.pending.append(update)
+            self.has_updates.set()
+            return
+        import httpx  # только для webhook-режима
+        if self._webhook_client is None:
+            self._webhook_client = httpx.AsyncClient(timeout=30.0)
+        r = await self._webhook_client.post(
+            self.webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret}
+        )
+        r.raise_for_status()
+
+    async def settle(self, quiet: float = 1.0, limit: float = 30.0) -> None:
+        # ждём, пока бот допишет хвосты (стриминговые правки, отложенные ответы)
+        deadline = time.monotonic() + limit
+        while time.monotonic() < deadline and time.monotonic() - self.last_call < quiet:
+            await asyncio.sleep(0.1)
+
+    async def close(self) -> None:
+        if self._webhook_client is not None:
+            await self._webhook_client.aclose()
+
+    def user_message(self, chat_id: int, text: str) -> dict:
+        user = {"id": chat_id, "is_bot": False, "first_name": f"u{chat_id}", "language_code": "ru"}
+        msg = self._message(chat_id, text, sender=user)
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": msg}
+
+    def callback(self, chat_id: int, message: dict, data: str) -> dict:
+        user = {"id": chat_id, "is_bot": False, "first_name": f"u{chat_id}", "language_code": "ru"}
+        return {"callback_query": {
+            "id": f"{chat_id}-{time.monotonic_ns()}", "from": user,
+            "chat_instance": str(chat_id), "data": data, "message": message,
+        }}
+
+    @staticmethod
+    def _params(headers: dict, body: bytes, query: str) -> dict:
+        # PTB шлёт application/x-www-form-urlencoded; не-строковые значения — JSON
+        if "application/json" in headers.get("content-type", ""):
+            return json.loads(body or b"{}")
+        params = {k: v[0] for k, v in parse_qs(query).items()}
+        params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+        for key in ("chat_id", "message_id", "offset", "timeout", "limit", "reply_markup", "drop_pending_updates"):
+            if key in params:
+                try:
+                    params[key] = json.loads(params[key])
+                except ValueError:
+                    pass
+        return params
+
+    def _deliver(self, method: str, chat_id, message: dict) -> None:
+        queue = self.inbox.get(chat_id)
+        if queue is not None:
+            queue.put_nowait((method, message, time.perf_counter()))
+
+    async def _get_updates(self, params: dict):
+        self.polled.set()
+        offset = int(params.get("offset") or 0)
+        if offset:
+            self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self.has_updates.clear()
+            try:
+                await asyncio.wait_for(self.has_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[: int(params.get("limit") or 100)]
+
+    async def handle(self, method: str, target: str, headers: dict, body: bytes):
+        url = urlsplit(target)
+        api = url.path.rsplit("/", 1)[-1]
+        self.calls[api] = self.calls.get(api, 0) + 1
+        if api != "getUpdates":
+            self.last_call = time.monotonic()
+        p = self._params(headers, body, url.query)
+        if api == "getMe":
+            return _json(200, {"ok": True, "result": self.BOT_USER})
+        if api == "getUpdates":
+            return _json(200, {"ok": True, "result": await self._get_updates(p)})
+        if api == "deleteWebhook" and p.get("drop_pending_updates") is True:
+            self.dropped += len(self.pending)
+            self.pending.clear()
+            return _json(200, {"ok": True, "result": True})
+        if api == "sendMessage":
+            msg = self._message(p["chat_id"], p.get("text", ""), p.get("reply_markup"))
+            self._deliver(api, p["chat_id"], msg)
+            return _json(200, {"ok": True, "result": msg})
+        if api == "editMessageText":
+            msg = self._message(p["chat_id"], p.get("text", ""), p.get("reply_markup"))
+            msg["message_id"] = p["message_id"]
+            msg["edit_date"] = msg["date"]
+            self._deliver(api, p["chat_id"], msg)
+            return _json(200, {"ok": True, "result": msg})
+        # answerCallbackQuery, sendChatAction, deleteWebhook, setWebhook, deleteMessage, ...
+        return _json(200, {"ok": True, "result": True})
+
+# ---------- FAKE LLM ----------
+REPLIES = {
+    "ru": [
+        "Я рядом. Расскажи, что у тебя на душе, и мы разберёмся вместе.",
+        "Слышу тебя. Давай не будем торопиться — что случилось дальше?",
+        "Мне правда интересно. Что ты почувствовала в тот момент?",
+    ],
+    "en": [
+        "I'm here. Tell me what's on your mind and we'll figure it out together.",
+        "I hear you. Let's take it slow — what happened next?",
+    ],
+}
+GARBAGE = ["... ... ... ... ... ...", "!!!!!!!!!!!!!!!!!!!!!!!!!", "аааааааааааааааааааааааааа"]
+
+class FakeLLM:
+    """
+    Бэкенд /chat, /chat_batch и OpenRouter с настраиваемыми задержкой, ошибками и мусором.
+    Понимает сессии RUNPOD_SESSIONS: держит историю по id и версии, на незнакомую
+    базу отвечает 409. prefill_ms — цена обработки каждой 1000 символов истории,
+    которой нет в «кэше» сессии.
+    """
+
+    MAX_SESSIONS = 10_000
+
+    def __init__(self, latency_ms: float, sigma: float, error_rate: float, garbage_rate: float,
+                 or_error_rate: float, token_delay_ms: float, prefill_ms: float = 0.0, session_miss_rate: float = 0.0):
+        self.latency_ms, self.sigma = latency_ms, sigma
+        self.error_rate, self.garbage_rate = error_rate, garbage_rate
+        self.or_error_rate = or_error_rate
+        self.token_delay = token_delay_ms / 1000.0
+        self.prefill = prefill_ms / 1000.0
+        self.session_miss_rate = session_miss_rate
+        self.sessions: OrderedDict[str, tuple[int, list]] = OrderedDict()
+        self.stats = {"chat": 0, "chat_batch": 0, "batch_items": 0, "openrouter": 0,
+                      "errors": 0, "garbage": 0, "streams": 0,
+                      "request_bytes": 0, "prefill_chars": 0, "session_delta": 0, "session_miss": 0}
+
+    def _prompt(self, item: dict) -> tuple[int, dict | None] | None:
+        """(символов на префилл, подтверждение сессии) или None при промахе сессии."""
+        history = item.get("history") or []
+        size = len(item.get("summary") or "") + sum(len(m.get("content") or "") for m in history)
+        sess = item.get("session")
+        if not isinstance(sess, dict):
+            return size, None
+        sid, base, version, drop = sess.get("id"), sess.get("base"), sess.get("version"), int(sess.get("drop") or 0)
+        if sid in self.sessions and random.random() < self.session_miss_rate:
+            del self.sessions[sid]  # имитация вытеснения на бэкенде
+        stored = self.sessions.get(sid)
+        if base is None:
+            msgs = list(history)
+        elif stored and stored[0] == base:
+            self.stats["session_delta"] += 1
+            msgs = stored[1][drop:] + list(history)
+            # сдвиг окна ломает префикс — тогда считаем всё заново
+            size = sum(len(m.get("content") or "") for m in msgs) if drop else size - len(item.get("summary") or "")
+        elif stored and stored[0] == version:
+            # повтор той же версии (параллельные кандидаты, ретрай) — всё уже в кэше
+            self.stats["session_delta"] += 1
+            msgs, size = stored[1], 0
+        else:
+            self.stats["session_miss"] += 1
+            return None
+        self.sessions[sid] = (version, msgs)
+        self.sessions.move_to_end(sid)
+        if len(self.sessions) > self.MAX_SESSIONS:
+            self.sessions.popitem(last=False)
+        return size, {"id": sid, "version": version}
+
+    def _prefill_delay(self, chars: int) -> float:
+        self.stats["prefill_chars"] += chars
+        return self.prefill * chars / 1000.0
+
+    def _latency(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.latency_ms / 1000.0), self.sigma)
+
+    def _reply(self, lang: str) -> str:
+        if random.random() < self.garbage_rate:
+            self.stats["garbage"] += 1
+            return random.choice(GARBAGE)
+        return random.choice(REPLIES.get(lang, REPLIES["ru"]))
+
+    async def _sse(self, text: str, frame, session: dict | None = None):
+        for word in text.split(" "):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield f"data: {json.dumps(frame(word + ' '), ensure_ascii=False)}\n\n".encode("utf-8")
+        if session:
+            yield f"data: {json.dumps({'session': session})}\n\n".encode("utf-8")
+        yield b"data: [DONE]\n\n"
+
+    def _failed(self, rate: float) -> bool:
+        if random.random() < rate:
+            self.stats["errors"] += 1
+            return True
+        return False
+
+    async def handle(self, method: str, target: str, headers: dict, body: bytes):
+        path = urlsplit(target).path
+        if method != "POST":  # GET — проверка, HEAD — прогрев соединения при старте бота
+            return 200, "text/plain", b"" if method == "HEAD" else b"ok"
+        data = json.loads(body or b"{}")
+
+        if path.endswith("/chat_batch"):
+            items = data.get("items") or []
+            self.stats["chat_batch"] += 1
+            self.stats["batch_items"] += len(items)
+            self.stats["request_bytes"] += len(body)
+            prompts = [self._prompt(it) for it in items]
+            # батч стоит чуть дороже одиночного запроса, но намного дешевле N запросов
+            await asyncio.sleep(self._latency() * (1 + 0.1 * (len(items) - 1))
+                                + self._prefill_delay(sum(p[0] for p in prompts if p)))
+            results = []
+            for it, prompt in zip(items, prompts):
+                if prompt is None:
+                    results.append({"error": "session_miss"})
+                elif self._failed(self.error_rate):
+                    results.append({"error": "backend error"})
+                else:
+                    results.append({"reply": self._reply(it.get("lang", "ru")), **({"session": prompt[1]} if prompt[1] else {})})
+            return _json(200, {"results": results})
+
+        if path.endswith("/chat"):
+            self.stats["chat"] += 1
+            self.stats["request_bytes"] += len(body)
+            prompt = self._prompt(data)
+            if prompt is None:
+                return _json(409, {"error": "session_miss"})
+            await asyncio.sleep(self._latency() + self._prefill_delay(prompt[0]))
+            if self._failed(self.error_rate):
+                return _json(500, {"error": "backend error"})
+            text = self._reply(data.get("lang", "ru"))
+            if data.get("stream"):
+                self.stats["streams"] += 1
+                return 200, "text/event-stream", self._sse(text, lambda w: {"delta": w}, prompt[1])
+            return _json(200, {"reply": text, **({"session": prompt[1]} if prompt[1] else {})})
+
+        if path.endswith("/chat/completions"):
+            self.stats["openrouter"] += 1
+            await asyncio.sleep(self._latency())
+            if self._failed(self.or_error_rate):
+                return _json(502, {"error": {"message": "upstream error"}})
+            last = ((data.get("messages") or [{}])[-1].get("content") or "")
+            text = self._reply("en" if last.isascii() else "ru")
+            if data.get("stream"):
+                self.stats["streams"] += 1
+                return 200, "text/event-stream", self._sse(text, lambda w: {"choices": [{"delta": {"content": w}}]})
+            return _json(200, {"choices": [{"message": {"role": "assistant", "content": text}}]})
+
+        return _json(404, {"error": "not found"})
+
+# ---------- НАГРУЗКА ----------
+PHRASES = [
+    "Привет, как ты сегодня?",
+    "Мне немного тревожно, можно поговорить?",
+    "Расскажи, что было дальше.",
+    "Я не знаю, что ему ответить.",
+    "Спасибо, что выслушал.",
+]
+
+class Recorder:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    def ok(self, stage: str, seconds: float) -> None:
+        self.latency.setdefault(stage, []).append(seconds)
+
+    def fail(self, stage: str) -> None:
+        self.errors[stage] = self.errors.get(stage, 0) + 1
+
+async def _expect(inbox: asyncio.Queue, timeout: float) -> tuple[str, dict, float]:
+    return await asyncio.wait_for(inbox.get(), timeout)
+
+def _buttons(message: dict) -> list[str]:
+    rows = (message.get("reply_markup") or {}).get("inline_keyboard") or []
+    return [b.get("callback_data") for row in rows for b in row if b.get("callback_data")]
+
+def _drain(inbox: asyncio.Queue) -> list[tuple[str, dict, float]]:
+    items = []
+    while not inbox.empty():
+        items.append(inbox.get_nowait())
+    return items
+
+async def run_user(tg: FakeTelegram, rec: Recorder, chat_id: int, args) -> None:
+    inbox = tg.inbox[chat_id] = asyncio.Queue()
+    try:
+        # /start и выбор по кнопкам: каждая клавиатура выбора — отдельная стадия
+        t0 = time.perf_counter()
+        await tg.push(tg.user_message(chat_id, "/start"))
+        try:
+            _, msg, t1 = await _expect(inbox, args.step_timeout)
+        except asyncio.TimeoutError:
+            rec.fail("start")
+            return
+        rec.ok("start", t1 - t0)
+        for _ in range(6):
+            buttons = _buttons(msg)
+            tag = next((b.split("|", 1)[0] for b in buttons if b.split("|", 1)[0] in ("story", "char", "lang")), None)
+            if tag is None:
+                break
+            choices = [b for b in buttons if b.startswith(tag + "|")]
+            data = f"lang|{args.lang}" if tag == "lang" and f"lang|{args.lang}" in choices else random.choice(choices)
+            _drain(inbox)
+            t0 = time.perf_counter()
+            await tg.push(tg.callback(chat_id, msg, data))
+            try:
+                _, msg, t1 = await _expect(inbox, args.step_timeout)
+            except asyncio.TimeoutError:
+                rec.fail(tag)
+                return
+            rec.ok(tag, t1 - t0)
+
+        # ходы диалога: время до первого сообщения бота (со стримингом — до первых токенов)
+        for _ in range(args.turns):
+            if args.think:
+                await asyncio.sleep(random.uniform(0, 2 * args.think))
+            _drain(inbox)
+            t0 = time.perf_counter()
+            await tg.push(tg.user_message(chat_id, random.choice(PHRASES)))
+            try:
+                while True:
+                    method, msg, t1 = await _expect(inbox, args.step_timeout)
+                    if method == "sendMessage":
+                        break
+            except asyncio.TimeoutError:
+                rec.fail("turn")
+                continue
+            rec.ok("turn", t1 - t0)
+    except Exception as e:
+        rec.fail("client")
+        print(f"user {chat_id}: {e!r}", file=sys.stderr)
+    finally:
+        tg.inbox.pop(chat_id, None)
+
+# ---------- МЕТРИКИ БОТА ----------
+def _parse_histograms(text: str, name: str) -> dict[str, dict[float, float]]:
+    # pixorbi_stage_seconds_bucket{stage="...",...,le="0.5"} 12 → {stage: {0.5: 12}}, суммируя по меткам
+    out: dict[str, dict[float, float]] = {}
+    prefix = name + "_bucket{"
+    for line in text.splitlines():
+        if not line.startswith(prefix):
+            continue
+        labels_raw, value = line[len(prefix):].rsplit("} ", 1)
+        labels = dict(part.split("=", 1) for part in labels_raw.split('",') if "=" in part)
+        stage = labels.get("stage", "").strip('"')
+        le = labels.get("le", "").strip('"')
+        bound = float("inf") if le == "+Inf" else float(le)
+        buckets = out.setdefault(stage, {})
+        buckets[bound] = buckets.get(bound, 0.0) + float(value)
+    return out
+
+def _bucket_quantile(buckets: dict[float, float], q: float) -> float:
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]] if bounds else 0
+    if not total:
+        return float("nan")
+    rank, prev_bound, prev_count = q * total, 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float("inf"):
+                return prev_bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / max(count - prev_count, 1e-9)
+        prev_bound, prev_count = bound, count
+    return prev_bound
+
+async def scrape_bot_stages(ports: list[int]) -> dict[str, dict]:
+    import httpx
+    merged: dict[str, dict[float, float]] = {}
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        for port in ports:
+            try:
+                r = await client.get(f"http://127.0.0.1:{port}/metrics")
+            except httpx.HTTPError:
+                continue
+            stages = _parse_histograms(r.text, "pixorbi_stage_seconds")
+            # очередь чата — отдельная гистограмма без меток
+            queue = _parse_histograms(r.text, "pixorbi_chat_queue_seconds").get("")
+            if queue:
+                stages["chat_queue"] = queue
+            for stage, buckets in stages.items():
+                acc = merged.setdefault(stage, {})
+                for bound, n in buckets.items():
+                    acc[bound] = acc.get(bound, 0.0) + n
+    return {stage: {"n": int(b.get(float("inf"), 0)), **{f"p{int(q * 100)}": _bucket_quantile(b, q) for q in (0.5, 0.95, 0.99)}}
+            for stage, b in sorted(merged.items())}
+
+# ---------- ОТЧЁТ ----------
+def summarize(rec: Recorder, wall: float) -> dict:
+    stages = {}
+    for stage in sorted(set(rec.latency) | set(rec.errors)):
+        values = rec.latency.get(stage, [])
+        stages[stage] = {
+            "n": len(values), "errors": rec.errors.get(stage, 0),
+            **{f"p{int(q * 100)}": _quantile(values, q) for q in (0.5, 0.95, 0.99)},
+        }
+    done = sum(s["n"] for s in stages.values())
+    return {
+        "wall_seconds": wall,
+        "updates_per_second": done / wall if wall else 0.0,
+        "turns_per_second": stages.get("turn", {}).get("n", 0) / wall if wall else 0.0,
+        "stages": stages,
+    }
+
+def _ms(v: float) -> str:
+    return "-" if v != v else f"{v * 1000:.0f}"
+
+def print_table(title: str, stages: dict) -> None:
+    print(f"\n{title}")
+    print(f"  {'stage':<22}{'n':>7}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, s in stages.items():
+        print(f"  {stage:<22}{s['n']:>7}{s.get('errors', 0):>6}{_ms(s['p50']):>10}{_ms(s['p95']):>10}{_ms(s['p99']):>10}")
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    # регрессия: p95 стадии вырос больше чем на tolerance или пропускная способность упала
+    problems = []
+    for stage, s in result["stages"].items():
+        base = baseline.get("stages", {}).get(stage)
+        if not base or base["p95"] != base["p95"] or s["p95"] != s["p95"]:
+            continue
+        if s["p95"] > base["p95"] * (1 + tolerance):
+            problems.append(f"{stage}: p95 {_ms(base['p95'])} → {_ms(s['p95'])} ms")
+    base_bytes = baseline.get("backend_bytes_per_request") or 0
+    if base_bytes and result.get("backend_bytes_per_request", 0) > base_bytes * (1 + tolerance):
+        problems.append(f"backend bytes/turn {base_bytes:.0f} → {result['backend_bytes_per_request']:.0f}")
+    base_tps = baseline.get("turns_per_second") or 0
+    if base_tps and result["turns_per_second"] < base_tps * (1 - tolerance):
+        problems.append(f"turns/s {base_tps:.1f} → {result['turns_per_second']:.1f}")
+    return problems
+
+# ---------- САНИТАЙЗЕР ----------
+# Эталон — прежняя цепочка из четырёх re.sub + повторов; новый движок обязан
+# давать тот же результат и целиком, и по кускам стрима.
+GOLDEN = [
+    "", "   ", "Привет!", "Hello , world .", "Wait.... what?", "Wait . . . . what?", "a .. b",
+    "No!!!!!!", "Why?? ? ? ?", "Хм…… ну…", "um, I mean , like", "Uh huh lol haha", "drum and bass",
+    "x  y\t\tz", "line one  \n  line two", "end ,", "  leading and trailing  ",
+    "!!!!!!!!!!!!!!!!!!!!", "... ... ... ...", "ааааааааааааааааааааааа", "She winks . Then giggle !!!!",
+    "Он сказал :  «нет» ;  потом ушёл .... ", "Да ! ! ! ! Конечно", "Ok…… …… fine", "snake_case  um_x um",
+]
+
+_LEGACY_FILLS = re.compile(r"\b(?:uh|um|lol|haha|giggle|winks|wipe)\b", re.I)
+
+def _legacy_sanitize_reply(s: str) -> str:
+    if s:
+        s = _LEGACY_FILLS.sub("", s)
+        s = re.sub(r"\s+([,.!?;:])", r"\1", s)
+        s = re.sub(r"\.{4,}", "...", s)
+        s = re.sub(r"[ \t]{2,}", " ", s)
+        s = s.strip()
+    return re.sub(r"([!?…])\1{3,}", r"\1\1", s or "")
+
+def realistic_reply(rng: random.Random, tokens: int = 360, noise: float = 0.03) -> str:
+    # ~360 токенов реплики персонажа; noise — доля мест с типичным «мусором» модели
+    words = ("я", "ты", "рядом", "тихо", "смотрю", "на", "тебя", "и", "улыбаюсь", "I", "pull", "you",
+             "close", "steady", "here", "okay", "взгляд", "дыхание", "um", "lol")
+    punct = (".", ",", "!", "?", "…", ".\n")
+    junk = (" ,", " .", "....", "!!!!", "  ", " . . . .", "? ? ? ?", "……")
+    out = []
+    for _ in range(tokens):
+        out.append(rng.choice(words))
+        r = rng.random()
+        out.append(rng.choice(junk) + " " if r < noise else rng.choice(punct) + " " if r < 0.15 else " ")
+    return "".join(out)
+
+def _chunks(text: str, rng: random.Random) -> list[str]:
+    out, i = [], 0
+    while i < len(text):
+        n = rng.randint(1, 12)
+        out.append(text[i:i + n])
+        i += n
+    return out
+
+def run_sanitize(args) -> int:
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", BENCH_TOKEN)
+    sys.path.insert(0, HERE)
+    import timeit
+    import bot
+
+    rng = random.Random(args.seed)
+    corpus = GOLDEN + [realistic_reply(rng, rng.randint(5, 360), noise=0.3) for _ in range(args.corpus)]
+    mismatches = 0
+    for text in corpus:
+        want = _legacy_sanitize_reply(text)
+        stream = bot.StreamSanitizer()
+        for chunk in _chunks(text, rng):
+            stream.feed(chunk)
+        got = {"sanitize_reply": bot.sanitize_reply(text), "stream": stream.finish()}
+        for name, value in got.items():
+            if value != want:
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"MISMATCH {name}: {text!r}\n  want {want!r}\n  got  {value!r}")
+    print(f"Golden corpus: {len(corpus)} texts, {mismatches} mismatches")
+
+    replies = [realistic_reply(rng) for _ in range(50)]
+    chunked = [_chunks(r, rng) for r in replies]
+
+    def legacy():
+        for r in replies:
+            _legacy_sanitize_reply(r)
+
+    def fused():
+        for r in replies:
+            bot.sanitize_reply(r)
+
+    def legacy_stream():
+        # прежний стрим в худшем случае: полная чистка всего накопленного текста на каждом куске
+        for chunks in chunked:
+            raw = ""
+            for c in chunks:
+                raw += c
+                _legacy_sanitize_reply(raw[:raw.rfind(" ")])
+            _legacy_sanitize_reply(raw)
+
+    def fused_stream():
+        for chunks in chunked:
+            stream = bot.StreamSanitizer()
+            for c in chunks:
+                stream.feed(c)
+            stream.finish()
+
+    print(f"\nMicrobenchmark: {len(replies)} replies × ~360 tokens, best of {args.repeat}")
+    results = {}
+    for name, fn in (("legacy", legacy), ("fused", fused), ("legacy stream", legacy_stream), ("fused stream", fused_stream)):
+        best = min(timeit.repeat(fn, number=args.number, repeat=args.repeat)) / (args.number * len(replies))
+        results[name] = best
+        print(f"  {name:<15}{best * 1e6:>10.1f} µs/reply")
+    print(f"  speedup: whole reply ×{results['legacy'] / results['fused']:.2f}, "
+          f"stream ×{results['legacy stream'] / results['fused stream']:.2f}")
+    return 1 if mismatches else 0
+
+# ---------- ЗАПУСК ----------
+def bot_env(args, api_port: int, llm_port: int, tmp: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{api_port}/bot",
+        "RUNPOD_HTTP": f"http://127.0.0.1:{llm_port}/chat",
+        "OPENROUTER_URL": f"http://127.0.0.1:{llm_port}/v1/chat/completions",
+        "OPENROUTER_API_KEY": env.get("OPENROUTER_API_KEY") or "bench",
+        "STATE_DB": os.path.join(tmp, "state.sqlite3"),
+        "BOT_MODE": args.mode,
+        "PYTHONUNBUFFERED": "1",
+    })
+    if args.metrics_port:
+        env["METRICS_PORT"] = str(args.metrics_port)
+    if args.mode == "webhook":
+        env.update({"WEBHOOK_URL": "", "WEBHOOK_LISTEN": "127.0.0.1", "WEBHOOK_PORT": str(args.webhook_port),
+                    "WEBHOOK_SECRET": "bench-secret", "WEBHOOK_WORKERS": str(args.workers)})
+    return env
+
+def start_bot(env: dict, log_path: str) -> subprocess.Popen:
+    log_file = open(log_path, "ab")
+    return subprocess.Popen([sys.executable, os.path.join(HERE, "bot.py")], env=env, cwd=HERE,
+                            stdout=log_file, stderr=subprocess.STDOUT)
+
+def stop_bot(proc: subprocess.Popen, timeout: float = 20.0) -> None:
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGINT if os.name != "nt" else signal.SIGTERM)
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+async def wait_ready(tg: FakeTelegram, args, proc: subprocess.Popen | None) -> None:
+    deadline = time.monotonic() + args.startup_timeout
+    if args.mode == "webhook":
+        import httpx
+        async with httpx.AsyncClient(timeout=2.0) as client:
+            while time.monotonic() < deadline:
+                # приёмник отвечает раньше, чем поднимутся воркеры; каждый воркер при старте зовёт getMe
+                try:
+                    healthy = (await client.get(f"http://127.0.0.1:{args.webhook_port}/healthz")).status_code == 200
+                except httpx.HTTPError:
+                    healthy = False
+                if healthy and tg.calls.get("getMe", 0) >= args.workers:
+                    break
+                if proc is not None and proc.poll() is not None:
+                    raise RuntimeError(f"bot exited with code {proc.returncode}, see {args.bot_log}")
+                await asyncio.sleep(0.2)
+    else:
+        while time.monotonic() < deadline and not tg.polled.is_set():
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"bot exited with code {proc.returncode}, see {args.bot_log}")
+            await asyncio.sleep(0.1)
+    if time.monotonic() >= deadline:
+        raise RuntimeError(f"bot did not start in {args.startup_timeout:.0f}s, see {args.bot_log}")
+    # даты сообщений — целые секунды; не даём им оказаться раньше started_at бота
+    await asyncio.sleep(1.0)
+
+async def run_load(args) -> int:
+    api_port = args.api_port or _free_port()
+    llm_port = args.llm_port or _free_port()
+    if args.mode == "webhook":
+        args.webhook_port = args.webhook_port or _free_port()
+    webhook_url = f"http://127.0.0.1:{args.webhook_port}/telegram" if args.mode == "webhook" else None
+
+    tg = FakeTelegram(webhook_url, "bench-secret")
+    llm = FakeLLM(args.llm_latency, args.llm_sigma, args.llm_error_rate, args.llm_garbage_rate,
+                  args.or_error_rate, args.token_delay, args.prefill_ms, args.session_miss_rate)
+    servers = [await serve("127.0.0.1", api_port, tg.handle), await serve("127.0.0.1", llm_port, llm.handle)]
+
+    tmp = tempfile.mkdtemp(prefix="pixorbi-bench-")
+    args.bot_log = args.bot_log or os.path.join(tmp, "bot.log")
+    env = bot_env(args, api_port, llm_port, tmp)
+    proc = None
+    if args.no_spawn:
+        print("Start the bot yourself with:")
+        for key in ("TELEGRAM_BOT_TOKEN", "TELEGRAM_API_BASE", "RUNPOD_HTTP", "OPENROUTER_URL", "BOT_MODE"):
+            print(f"  {key}={env[key]}")
+    else:
+        proc = start_bot(env, args.bot_log)
+    try:
+        await wait_ready(tg, args, proc)
+        print(f"Bot ready, {args.users} users × {args.turns} turns (log: {args.bot_log})")
+
+        rec = Recorder()
+        t0 = time.perf_counter()
+        tasks = []
+        for i in range(args.users):
+            tasks.append(asyncio.create_task(run_user(tg, rec, 100_000 + i, args)))
+            if args.ramp:
+                await asyncio.sleep(args.ramp / args.users)
+        await asyncio.gather(*tasks)
+        result = summarize(rec, time.perf_counter() - t0)
+
+        await tg.settle()
+        if args.metrics_port:
+            ports = [args.metrics_port] if args.mode != "webhook" else [args.metrics_port + 1 + i for i in range(args.workers)]
+            result["bot_stages"] = await scrape_bot_stages(ports)
+        result["telegram_calls"] = dict(sorted(tg.calls.items()))
+        result["llm"] = dict(llm.stats)
+        requests = llm.stats["chat"] + llm.stats["batch_items"]
+        result["backend_bytes_per_request"] = llm.stats["request_bytes"] / requests if requests else 0.0
+    finally:
+        if proc is not None:
+            # фейки должны отвечать, пока бот дописывает хвосты и останавливается
+            await asyncio.get_running_loop().run_in_executor(None, stop_bot, proc)
+        await tg.close()
+        for server in servers:
+            server.close()
+
+    print_table("Client-side latency (update sent → bot message received):", result["stages"])
+    if result.get("bot_stages"):
+        print_table("Bot-side stages (from /metrics):", result["bot_stages"])
+    print(f"\nWall {result['wall_seconds']:.1f}s, {result['updates_per_second']:.1f} updates/s, "
+          f"{result['turns_per_second']:.1f} turns/s")
+    print("Bot API calls:", ", ".join(f"{k}={v}" for k, v in result["telegram_calls"].items()))
+    print("LLM:", ", ".join(f"{k}={v}" for k, v in result["llm"].items()))
+    if result["backend_bytes_per_request"]:
+        print(f"Backend request size: {result['backend_bytes_per_request']:.0f} bytes/turn")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        if problems:
+            print("\nREGRESSION vs", args.compare)
+            for p in problems:
+                print("  " + p)
+            return 1
+        print(f"\nNo regression vs {args.compare} (tolerance {args.tolerance:.0%})")
+    errors = sum(s["errors"] for s in result["stages"].values())
+    return 1 if errors and args.fail_on_error else 0
+
+async def run_restart(args) -> int:
+    """
+    Перезапуск посреди разговора: пользователи настроены, бот останавливается
+    (SIGINT или --crash), за время простоя каждый пишет по сообщению, бот стартует снова.
+    С --midturn сообщения приходят до остановки, и бот падает посреди ходов.
+    Меряем время до первого ответа после старта, сколько сообщений потерялось и сколько ответов ушло дважды.
+    """
+    args.mode = "polling"  # в webhook-режиме очередь держит сам Telegram
+    api_port, llm_port = args.api_port or _free_port(), args.llm_port or _free_port()
+    tg = FakeTelegram()
+    llm = FakeLLM(args.llm_latency, args.llm_sigma, 0.0, 0.0, 0.0, args.token_delay)
+    servers = [await serve("127.0.0.1", api_port, tg.handle), await serve("127.0.0.1", llm_port, llm.handle)]
+    tmp = tempfile.mkdtemp(prefix="pixorbi-bench-")
+    args.bot_log = args.bot_log or os.path.join(tmp, "bot.log")
+    env = bot_env(args, api_port, llm_port, tmp)
+    if args.warm:
+        env["WARM_RESTART"] = "1"
+    loop = asyncio.get_running_loop()
+    proc = start_bot(env, args.bot_log)
+    try:
+        await wait_ready(tg, args, proc)
+        rec = Recorder()
+        setup = argparse.Namespace(**{**vars(args), "turns": 0})
+        await asyncio.gather(*(run_user(tg, rec, 100_000 + i, setup) for i in range(args.users)))
+        await tg.settle()
+        print(f"{args.users} users set up (log: {args.bot_log}); restarting "
+              f"({'crash' if args.crash else 'graceful'}, {'warm' if args.warm else 'cold'}"
+              f"{', mid-turn' if args.midturn else ''})")
+
+        chats = [100_000 + i for i in range(args.users)]
+        sent = {}
+
+        async def say(chat_id: int) -> None:
+            tg.inbox[chat_id] = asyncio.Queue()
+            await tg.push(tg.user_message(chat_id, random.choice(PHRASES)))
+            sent[chat_id] = time.perf_counter()
+
+        if args.crash:
+            # настройки пользователей должны успеть попасть в STATE_DB, иначе после падения бот их не помнит
+            await asyncio.sleep(float(env.get("STATE_FLUSH_INTERVAL") or 5.0) + 0.5)
+        if args.midturn:
+            # сообщения уходят до остановки: бот успевает их забрать и начать ходы
+            for chat_id in chats:
+                await say(chat_id)
+            await asyncio.sleep(args.midturn)
+        if args.crash:
+            proc.kill()
+            proc.wait()
+        else:
+            await loop.run_in_executor(None, stop_bot, proc)
+        tg.polled.clear()
+        if not args.midturn:
+            for chat_id in chats:
+                await say(chat_id)
+        await asyncio.sleep(args.downtime)
+
+        t_start = time.perf_counter()
+        proc = start_bot(env, args.bot_log)
+
+        async def reply_time(chat_id: int) -> float | None:
+            try:
+                while True:
+                    method, msg, t1 = await _expect(tg.inbox[chat_id], args.step_timeout)
+                    if method == "sendMessage" and not msg.get("reply_markup"):  # не клавиатура настройки
+                        return t1
+            except asyncio.TimeoutError:
+                return None
+
+        replies_at = await asyncio.gather(*(reply_time(c) for c in chats))
+        await wait_ready(tg, args, proc)  # после остановки посреди ходов ответы могли уйти ещё до старта
+        await tg.settle()
+        # лишние ответы — ход обработан дважды (апдейт пришёл повторно после перезапуска)
+        repeated = sum(1 for c in chats for method, *_ in _drain(tg.inbox[c]) if method == "sendMessage")
+        got = [t for t in replies_at if t is not None]
+        since_start = [t - t_start for t in got]
+        since_sent = [t - sent[c] for c, t in zip(chats, replies_at) if t is not None]
+        result = {
+            "warm": args.warm, "crash": args.crash, "midturn": args.midturn, "users": args.users,
+            "answered": len(got), "lost": len(chats) - len(got), "repeated": repeated,
+            "dropped_by_telegram": tg.dropped,
+            "first_reply_after_start": min(since_start) if since_start else float("nan"),
+            "last_reply_after_start": max(since_start) if since_start else float("nan"),
+            "stages": {"after_start": {"n": len(since_start), "errors": len(chats) - len(got),
+                                       **{f"p{int(q * 100)}": _quantile(since_start, q) for q in (0.5, 0.95, 0.99)}},
+                       "since_sent": {"n": len(since_sent), "errors": 0,
+                                      **{f"p{int(q * 100)}": _quantile(since_sent, q) for q in (0.5, 0.95, 0.99)}}},
+        }
+    finally:
+        await loop.run_in_executor(None, stop_bot, proc)
+        await tg.close()
+        for server in servers:
+            server.close()
+
+    print_table("Replies to messages sent during the restart:", result["stages"])
+    print(f"\nFirst reply {_ms(result['first_reply_after_start'])} ms after start, last "
+          f"{_ms(result['last_reply_after_start'])} ms; answered {result['answered']}/{args.users}, "
+          f"lost {result['lost']}, answered twice {result['repeated']} "
+          f"(dropped by deleteWebhook: {result['dropped_by_telegram']})")
+    startup = [line for line in open(args.bot_log, encoding="utf-8", errors="replace") if "Startup:" in line]
+    if startup:
+        print("Bot startup:", startup[-1].split("Startup:", 1)[1].strip())
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 1 if (result["lost"] or result["repeated"]) and args.fail_on_error else 0
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test and benchmarks for bot.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    load = sub.add_parser("load", help="fake Bot API + fake LLM + simulated users")
+    load.add_argument("--users", type=int, default=100)
+    load.add_argument("--turns", type=int, default=3, help="chat turns per user after setup")
+    load.add_argument("--think", type=float, default=0.0, help="mean pause between turns, s")
+    load.add_argument("--ramp", type=float, default=0.0, help="spread user starts over this many seconds")
+    load.add_argument("--lang", default="ru", choices=("ru", "en"))
+    load.add_argument("--step-timeout", type=float, default=120.0)
+    load.add_argument("--mode", default="polling", choices=("polling", "webhook"))
+    load.add_argument("--workers", type=int, default=2, help="WEBHOOK_WORKERS in webhook mode")
+    load.add_argument("--llm-latency", type=float, default=300.0, help="median backend latency, ms")
+    load.add_argument("--llm-sigma", type=float, default=0.5, help="lognormal spread of the latency")
+    load.add_argument("--llm-error-rate", type=float, default=0.0, help="share of /chat requests failing with 500")
+    load.add_argument("--llm-garbage-rate", type=float, default=0.0, help="share of punctuation-only replies")
+    load.add_argument("--or-error-rate", type=float, default=0.0, help="share of OpenRouter requests failing")
+    load.add_argument("--token-delay", type=float, default=30.0, help="delay between streamed chunks, ms")
+    load.add_argument("--prefill-ms", type=float, default=0.0, help="backend cost per 1000 uncached history chars, ms")
+    load.add_argument("--session-miss-rate", type=float, default=0.0, help="share of requests whose backend session is evicted")
+    load.add_argument("--metrics-port", type=int, default=0, help="enable bot /metrics and report its stages")
+    load.add_argument("--api-port", type=int, default=0)
+    load.add_argument("--llm-port", type=int, default=0)
+    load.add_argument("--webhook-port", type=int, default=0)
+    load.add_argument("--startup-timeout", type=float, default=30.0)
+    load.add_argument("--bot-log", default="")
+    load.add_argument("--no-spawn", action="store_true", help="do not start bot.py, only serve the fakes")
+    load.add_argument("--json", default="", help="write results to this file")
+    load.add_argument("--compare", default="", help="baseline JSON from a previous --json run")
+    load.add_argument("--tolerance", type=float, default=0.2)
+    load.add_argument("--fail-on-error", action="store_true")
+
+    rst = sub.add_parser("restart", help="time to first reply and lost messages across a bot restart")
+    rst.add_argument("--users", type=int, default=50)
+    rst.add_argument("--warm", action="store_true", help="run the bot with WARM_RESTART=1")
+    rst.add_argument("--crash", action="store_true", help="SIGKILL instead of a graceful stop")
+    rst.add_argument("--downtime", type=float, default=2.0, help="seconds between stop and start")
+    rst.add_argument("--midturn", type=float, default=0.0,
+                     help="send the messages before the stop and stop this many seconds later, while turns run")
+    rst.add_argument("--lang", default="ru", choices=("ru", "en"))
+    rst.add_argument("--step-timeout", type=float, default=30.0)
+    rst.add_argument("--llm-latency", type=float, default=300.0)
+    rst.add_argument("--llm-sigma", type=float, default=0.5)
+    rst.add_argument("--token-delay", type=float, default=30.0)
+    rst.add_argument("--metrics-port", type=int, default=0)
+    rst.add_argument("--api-port", type=int, default=0)
+    rst.add_argument("--llm-port", type=int, default=0)
+    rst.add_argument("--startup-timeout", type=float, default=30.0)
+    rst.add_argument("--bot-log", default="")
+    rst.add_argument("--json", default="")
+    rst.add_argument("--fail-on-error", action="store_true")
+
+    san = sub.add_parser("sanitize", help="golden corpus and microbenchmark for the reply sanitizer")
+    san.add_argument("--corpus", type=int, default=2000, help="generated texts on top of the golden list")
+    san.add_argument("--seed", type=int, default=1)
+    san.add_argument("--number", type=int, default=3)
+    san.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args(argv)
+    if args.command == "load":
+        return asyncio.run(run_load(args))
+    if args.command == "restart":
+        return asyncio.run(run_restart(args))
+    if args.command == "sanitize":
+        return run_sanitize(args)
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,571 +1,3654 @@
-# bot.py
-# -*- coding: utf-8 -*-
-import os
-import logging
-import time
-import re
-import random
-import httpx
-from datetime import datetime, timezone
-
-from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup
-)
-from telegram.constants import ChatAction
-from telegram.error import Conflict
-from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
-    ContextTypes, CallbackQueryHandler, filters
-)
-
-# ---------- ЛОГИ ----------
-logging.basicConfig(
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-    level=logging.INFO,
-)
-log = logging.getLogger("pixorbi-bot")
-
-# ---------- ENV ----------
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "thedrummer/unslopnemo-12b")
-OR_HTTP_REFERER = os.getenv("OR_HTTP_REFERER", "https://pixorbibot.onrender.com")
-OR_X_TITLE = os.getenv("OR_X_TITLE", "PixorbiDream")
-
-# URL бэкенда; нормализуем до .../chat
-RUNPOD_HTTP = (os.getenv("RUNPOD_HTTP") or "").strip()
-if RUNPOD_HTTP and not RUNPOD_HTTP.endswith("/chat"):
-    RUNPOD_HTTP = RUNPOD_HTTP.rstrip("/") + "/chat"
-
-# ключи для доступа к бэкенду через LB
-RUNPOD_ACCOUNT_KEY = os.getenv("RUNPOD_ACCOUNT_KEY") or os.getenv("RUNPOD_API_KEY")  # rpa_...
-APP_KEY = os.getenv("APP_KEY")  # внутренний ключ приложения (проверяется в app.py)
-
-def _as_bool(v: str | None, default=False) -> bool:
-    if v is None:
-        return default
-    return v.strip().lower() in {"1", "true", "yes", "y", "on"}
-
-FORCE_RESELECT_ON_START = _as_bool(os.getenv("FORCE_RESELECT_ON_START"), True)
-
-try:
-    LANG_SWITCH_THRESHOLD = max(1, int(os.getenv("LANG_SWITCH_THRESHOLD", "3")))
-except Exception:
-    LANG_SWITCH_THRESHOLD = 3
-
-if not TELEGRAM_BOT_TOKEN:
-    raise RuntimeError("TELEGRAM_BOT_TOKEN is required (Render → Environment)")
-
-# ---------- КОНСТАНТЫ / ХРАНИЛКА ----------
-STORY_KEY = "story"
-CHAR_KEY  = "char"
-LANG_KEY  = "lang"
-STARTED_KEY = "started"
-AWAIT_SETUP = "await_setup"
-LANG_MISMATCH_STREAK = "lang_mismatch_streak"
-
-DIALOG_HISTORY = "dialog_history"
-HIST_MAX_TURNS = 12  # хранить до 12 пользовательских + 12 ответов
-
-DEFAULT_STORY = os.getenv("DEFAULT_STORY", "hope")  # «Меня зовут Хоуп»
-
-# ---------- МЕТАДАННЫЕ ИСТОРИЙ И ПЕРСОНАЖЕЙ ----------
-# Все имена персонажей — слаги в нижнем регистре. Показываем удобные подписи на RU/EN.
-STORIES = {
-    "hope": {
-        "title_ru": "Меня зовут Хоуп",
-        "title_en": "My Name is Hope",
-        "characters": {
-            # все мужчины по описанию
-            "ellis":   {"ru": "Эллис",   "en": "Ellis"},
-            "james":   {"ru": "Джеймс",  "en": "James"},
-            "kyle":    {"ru": "Кайл",    "en": "Kyle"},
-            "keen":    {"ru": "Кин",     "en": "Keen"},
-            "zachary": {"ru": "Закари",  "en": "Zachary"},
-        },
-    },
-}
-
-# Персонные промпты: жёсткая фиксация языка + стиль
-def persona_system_prompt(character: str, lang: str) -> str:
-    ch = (character or "").lower()
-    l  = (lang or "ru").lower()[:2]
-    name_map = STORIES["hope"]["characters"]  # пока одна история — берём из неё
-    display_name = name_map.get(ch, {}).get(l, ch.title())
-
-    base_ru = {
-        "ellis":   "Ты — Эллис, прямолинейный, заботливый и немного ироничный. Говоришь коротко и по делу, без грубости.",
-        "james":   "Ты — Джеймс, умный и спокойный, склонен анализировать и поддерживать.",
-        "kyle":    "Ты — Кайл, лёгкий и флиртующий, но не навязчивый. Поддерживаешь настроение.",
-        "keen":    "Ты — Кин, собранный и дисциплинированный, предпочитаешь чёткие формулировки.",
-        "zachary": "Ты — Закари, эмоциональный, но держишь себя в руках. Тёплый, доверительный тон.",
-    }
-    base_en = {
-        "ellis":   "You are Ellis: straightforward, caring, slightly ironic. Keep replies short and to the point.",
-        "james":   "You are James: smart, calm, analytical and supportive.",
-        "kyle":    "You are Kyle: light-hearted and flirty, never pushy. Keep the mood up.",
-        "keen":    "You are Keen: focused and disciplined. Prefer clear and concise wording.",
-        "zachary": "You are Zachary: emotional yet composed. Warm, trusting tone.",
-    }
-    base = (base_ru if l == "ru" else base_en).get(ch, "")
-
-    enforce = (
-        f"ЖЁСТКОЕ ПРАВИЛО: отвечай СТРОГО на русском. Имя: {display_name}. "
-        f"Если пользователь пишет не по-русски — всё равно отвечай по-русски и мягко напомни."
-        if l == "ru" else
-        f"HARD RULE: reply STRICTLY in English. Name: {display_name}. "
-        f"If the user uses another language, still answer in English and gently remind them."
-    )
-    canon = (
-        "\nПравила согласованности:\n"
-        "- Не противоречь фактам, сказанным тобой ранее в этом чате.\n"
-        "- Держи один образ и биографию из канона истории.\n"
-        "- Говори короткими естественными фразами; без сценических ремарок в скобках."
-        if l == "ru" else
-        "\nConsistency rules:\n"
-        "- Never contradict facts you already stated in this chat.\n"
-        "- Keep a single persona/biography consistent with the story canon.\n"
-        "- Use short, natural sentences; no stage directions in parentheses."
-    )
-    fewshot = (
-        "\n\nПримеры стиля:\n"
-        "Пользователь: Поцелуешь меня?\n"
-        "Ассистент: Тихо усмехаюсь и наклоняюсь ближе. Короткий тёплый поцелуй — и взгляд не отрываю.\n"
-        "Пользователь: Обними меня.\n"
-        "Ассистент: Обнимаю крепко и спокойно. «Я рядом»."
-        if l == "ru" else
-        "\n\nStyle examples:\n"
-        "User: Will you kiss me?\n"
-        "Assistant: I smirk softly and lean in. A warm, brief kiss — I keep my eyes on you.\n"
-        "User: Hold me.\n"
-        "Assistant: I pull you close, steady. “I’m here.”"
-    )
-    return base + "\n" + enforce + canon + fewshot
-
-# ---------- ЯЗЫКОВЫЕ НАПОМИНАНИЯ ----------
-def detect_lang(text: str) -> str | None:
-    has_cyr = bool(re.search(r"[А-Яа-яЁё]", text))
-    has_lat = bool(re.search(r"[A-Za-z]", text))
-    if has_cyr and not has_lat:
-        return "ru"
-    if has_lat and not has_cyr:
-        return "en"
-    return None
-
-LANG_REMINDERS = {
-    "ru": [
-        "Давай по-русски, пожалуйста 😊",
-        "Я сейчас говорю только по-русски. Переключишься?",
-        "Без английского, ладно? На русском будет легче 💫",
-    ],
-    "en": [
-        "Let’s keep it in English, please 💫",
-        "I’m answering only in English now. Can you switch?",
-        "English only for me right now, please.",
-    ],
-}
-def get_lang_reminder(lang: str) -> str:
-    arr = LANG_REMINDERS["ru" if (lang or "ru") == "ru" else "en"]
-    return random.choice(arr)
-
-# ---------- САНИТАЙЗЕР ----------
-RE_PUNCT_ONLY = re.compile(r"^[\s!?.…-]{10,}$")
-RE_FILLS = re.compile(r"\b(?:uh|um|lol|haha|giggle|winks|wipe)\b", re.I)
-
-def clean_text(s: str) -> str:
-    if not s:
-        return s
-    s = RE_FILLS.sub("", s)
-    s = re.sub(r"\s+([,.!?;:])", r"\1", s)
-    s = re.sub(r"\.{4,}", "...", s)
-    s = re.sub(r"[ \t]{2,}", " ", s)
-    return s.strip()
-
-def looks_bad(s: str) -> bool:
-    if not s or RE_PUNCT_ONLY.match(s):
-        return True
-    if len(set(s.strip())) <= 2 and len(s.strip()) >= 20:
-        return True
-    return False
-
-# ---------- ХРАНИЛКА ДИАЛОГА ----------
-def _push_history(ctx: ContextTypes.DEFAULT_TYPE, role: str, content: str) -> None:
-    hist = ctx.user_data.get(DIALOG_HISTORY)
-    if not isinstance(hist, list):
-        hist = []
-    hist.append({"role": role, "content": content})
-    if len(hist) > HIST_MAX_TURNS * 2:
-        hist = hist[-HIST_MAX_TURNS*2:]
-    ctx.user_data[DIALOG_HISTORY] = hist
-
-def _build_messages(ctx: ContextTypes.DEFAULT_TYPE, system_prompt: str, user_text: str) -> list[dict]:
-    msgs = [{"role": "system", "content": system_prompt}]
-    hist = ctx.user_data.get(DIALOG_HISTORY)
-    if isinstance(hist, list) and hist:
-        msgs.extend(hist)
-    msgs.append({"role": "user", "content": user_text})
-    return msgs
-
-# ---------- TELEGRAM ACTIONS ----------
-async def send_action_safe(update: Update, action: ChatAction) -> None:
-    try:
-        await update.effective_chat.send_action(action)
-    except Exception:
-        pass
-
-# ---------- КНОПКИ / МЕНЮ ----------
-def main_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Выбрать историю",  callback_data="menu|change_story")],
-        [InlineKeyboardButton("Сменить персонажа", callback_data="menu|change_char")],
-        [InlineKeyboardButton("Сменить язык",      callback_data="menu|change_lang")],
-    ])
-
-def choose_story_kb(lang: str = "ru") -> InlineKeyboardMarkup:
-    rows = []
-    for sid, meta in STORIES.items():
-        title = meta["title_ru"] if (lang or "ru") == "ru" else meta["title_en"]
-        rows.append([InlineKeyboardButton(title, callback_data=f"story|{sid}")])
-    return InlineKeyboardMarkup(rows)
-
-def choose_char_kb(story_id: str, lang: str = "ru") -> InlineKeyboardMarkup:
-    meta = STORIES.get(story_id) or STORIES[DEFAULT_STORY]
-    rows = []
-    for slug, names in meta["characters"].items():
-        label = names["ru"] if (lang or "ru") == "ru" else names["en"]
-        rows.append([InlineKeyboardButton(label, callback_data=f"char|{slug}")])
-    return InlineKeyboardMarkup(rows)
-
-def choose_lang_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Русский 🇷🇺", callback_data="lang|ru")],
-        [InlineKeyboardButton("English 🇬🇧", callback_data="lang|en")],
-    ])
-
-# ---------- СОСТОЯНИЕ / ХЕЛПЕРЫ ----------
-def need_setup(ctx: ContextTypes.DEFAULT_TYPE) -> bool:
-    if ctx.user_data.get(AWAIT_SETUP):
-        return True
-    if not ctx.user_data.get(STORY_KEY) or not ctx.user_data.get(CHAR_KEY) or not ctx.user_data.get(LANG_KEY):
-        return True
-    return False
-
-def reset_setup(ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    ctx.user_data[AWAIT_SETUP] = True
-    ctx.user_data[LANG_MISMATCH_STREAK] = 0
-    ctx.user_data[DIALOG_HISTORY] = []
-
-# ---------- BACKEND / OPENROUTER ----------
-async def call_openrouter(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE, temperature: float = 0.6) -> str:
-    """
-    Если задан RUNPOD_HTTP — шлём в бэкенд (/chat) с историей, языком и нужными заголовками.
-    Иначе — прямой вызов OpenRouter (fallback).
-    """
-    history = ctx.user_data.get(DIALOG_HISTORY) or []
-    story_id = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
-
-    if RUNPOD_HTTP:
-        try:
-            headers = {"Content-Type": "application/json"}
-            if RUNPOD_ACCOUNT_KEY:
-                headers["Authorization"] = f"Bearer {RUNPOD_ACCOUNT_KEY}"
-            if APP_KEY:
-                headers["x-api-key"] = APP_KEY
-
-            async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
-                r = await client.post(
-                    RUNPOD_HTTP,
-                    headers=headers,
-                    json={
-                        "story_id": story_id,
-                        "character": character,
-                        "lang": lang,
-                        "message": text,
-                        "history": history,
-                    },
-                )
-                r.raise_for_status()
-                data = r.json()
-
-            content = (data or {}).get("reply", "") or ""
-            content = clean_text(content)
-            content = re.sub(r"([!?…])\1{3,}", r"\1\1", content)
-            return content or "(пустой ответ)"
-        except httpx.HTTPStatusError as e:
-            body = ""
-            try:
-                body = e.response.text[:300]
-            except Exception:
-                pass
-            log.warning("RUNPOD_HTTP HTTP %s: %s", e.response.status_code, body)
-        except Exception as e:
-            log.warning("RUNPOD_HTTP failed, falling back to OpenRouter: %s", e)
-
-    # ---- Fallback: прямой OpenRouter ----
-    if not OPENROUTER_API_KEY:
-        return "(LLM не настроен)"
-
-    system_prompt = persona_system_prompt(character, lang)
-    messages = _build_messages(ctx, system_prompt, text)
-
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "HTTP-Referer": OR_HTTP_REFERER,
-        "X-Title": OR_X_TITLE,
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": messages,
-        "temperature": temperature,
-        "top_p": 0.85,
-        "frequency_penalty": 0.35,
-        "max_tokens": 360,
-    }
-
-    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
-        r = await client.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload)
-        r.raise_for_status()
-        data = r.json()
-
-    choice = (data.get("choices") or [{}])[0]
-    content = (choice.get("message") or {}).get("content") or ""
-    content = clean_text(content)
-    content = re.sub(r"([!?…])\1{3,}", r"\1\1", content)
-    return content or "(пустой ответ)"
-
-# ---------- ВЕБХУК ----------
-async def delete_webhook(app: Application) -> None:
-    try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        log.info("Webhook deleted (drop_pending_updates=True).")
-        app.bot_data["started_at"] = datetime.now(timezone.utc)
-    except Exception as e:
-        log.warning("delete_webhook failed: %s", e)
-
-# ---------- КОМАНДЫ ----------
-async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    ctx.user_data[STARTED_KEY] = True
-
-    if FORCE_RESELECT_ON_START:
-        for key in (STORY_KEY, CHAR_KEY, LANG_KEY):
-            ctx.user_data.pop(key, None)
-
-    reset_setup(ctx)
-
-    if not ctx.user_data.get(STORY_KEY):
-        await update.message.reply_text("Выбери историю:", reply_markup=choose_story_kb(ctx.user_data.get(LANG_KEY, "ru")))
-        return
-
-    if not ctx.user_data.get(CHAR_KEY):
-        story = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
-        await update.message.reply_text("Теперь выбери персонажа:",
-                                        reply_markup=choose_char_kb(story, ctx.user_data.get(LANG_KEY, "ru")))
-        return
-
-    if not ctx.user_data.get(LANG_KEY):
-        await update.message.reply_text("Выбери язык:", reply_markup=choose_lang_kb())
-        return
-
-    title = STORIES[ctx.user_data[STORY_KEY]]["title_ru"] if ctx.user_data[LANG_KEY] == "ru" else STORIES[ctx.user_data[STORY_KEY]]["title_en"]
-    await update.message.reply_text(
-        f"История: {title}\n"
-        f"Персонаж: {ctx.user_data[CHAR_KEY].title()}, язык: {ctx.user_data[LANG_KEY].upper()}.\n"
-        f"Нажми «Меню» для смены настроек.",
-        reply_markup=main_menu_kb()
-    )
-
-async def cmd_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text("Меню:", reply_markup=main_menu_kb())
-
-async def cmd_story(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    cur = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
-    meta = STORIES.get(cur, STORIES[DEFAULT_STORY])
-    await update.message.reply_text(f"Текущая история: {meta['title_ru']} / {meta['title_en']}")
-
-async def cmd_char(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    cur = ctx.user_data.get(CHAR_KEY, "не выбран")
-    await update.message.reply_text(f"Текущий персонаж: {cur}")
-
-async def cmd_lang(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    cur = ctx.user_data.get(LANG_KEY, "не выбран")
-    await update.message.reply_text(f"Текущий язык: {cur}. Сменить?", reply_markup=choose_lang_kb())
-
-async def cmd_reset(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    ctx.user_data.clear()
-    reset_setup(ctx)
-    await update.message.reply_text("Сброс настроек. Выбери историю:", reply_markup=choose_story_kb())
-
-# ---------- CALLBACKS ----------
-def _is_stale_callback(update: Update, app: Application) -> bool:
-    started_at = app.bot_data.get("started_at")
-    msg = update.callback_query.message
-    if not (started_at and msg and msg.date):
-        return False
-    return msg.date.replace(tzinfo=timezone.utc) < started_at
-
-async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    await q.answer()
-
-    if _is_stale_callback(update, ctx.application):
-        log.info("Ignore stale callback: %s", q.data)
-        return
-
-    parts = (q.data or "").split("|", 1)
-    tag = parts[0]
-    val = parts[1] if len(parts) > 1 else None
-
-    if tag == "story" and val:
-        ctx.user_data[STORY_KEY] = val
-        ctx.user_data.pop(CHAR_KEY, None)
-        reset_setup(ctx)
-        await q.edit_message_text("История выбрана. Теперь выбери персонажа:",
-                                  reply_markup=choose_char_kb(val, ctx.user_data.get(LANG_KEY, "ru")))
-        return
-
-    if tag == "char" and val:
-        ctx.user_data[CHAR_KEY] = val
-        ctx.user_data.pop(LANG_KEY, None)
-        reset_setup(ctx)
-        await q.edit_message_text("Персонаж выбран. Теперь выбери язык:",
-                                  reply_markup=choose_lang_kb())
-        return
-
-    if tag == "lang" and val:
-        ctx.user_data[LANG_KEY] = val
-        ctx.user_data[AWAIT_SETUP] = False
-        ctx.user_data[LANG_MISMATCH_STREAK] = 0
-        await q.edit_message_text(
-            f"Язык установлен: {val.upper()}. Можно писать сообщения!",
-            reply_markup=main_menu_kb()
-        )
-        return
-
-    if tag == "menu" and val == "change_story":
-        reset_setup(ctx)
-        await q.edit_message_text("Выбери историю:", reply_markup=choose_story_kb(ctx.user_data.get(LANG_KEY, "ru")))
-        return
-
-    if tag == "menu" and val == "change_char":
-        reset_setup(ctx)
-        story = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
-        await q.edit_message_text("Выбери персонажа:", reply_markup=choose_char_kb(story, ctx.user_data.get(LANG_KEY, "ru")))
-        return
-
-    if tag == "menu" and val == "change_lang":
-        reset_setup(ctx)
-        await q.edit_message_text("Выбери язык:", reply_markup=choose_lang_kb())
-        return
-
-# ---------- ТЕКСТ ----------
-async def on_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message or not update.message.text:
-        return
-
-    # Последовательность выбора
-    if need_setup(ctx):
-        if not ctx.user_data.get(STORY_KEY):
-            await update.message.reply_text("Сначала выбери историю:", reply_markup=choose_story_kb())
-        elif not ctx.user_data.get(CHAR_KEY):
-            story = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
-            await update.message.reply_text("Теперь выбери персонажа:", reply_markup=choose_char_kb(story))
-        elif not ctx.user_data.get(LANG_KEY):
-            await update.message.reply_text("Теперь выбери язык:", reply_markup=choose_lang_kb())
-        else:
-            await update.message.reply_text("Нажми кнопки настройки выше, затем продолжим.")
-        return
-
-    char = ctx.user_data.get(CHAR_KEY)
-    lang = ctx.user_data.get(LANG_KEY)
-    user_text = update.message.text.strip()
-
-    # Контроль языка пользователя
-    in_lang = detect_lang(user_text)
-    if in_lang and in_lang != lang:
-        streak = int(ctx.user_data.get(LANG_MISMATCH_STREAK, 0)) + 1
-        ctx.user_data[LANG_MISMATCH_STREAK] = streak
-
-        reminder = get_lang_reminder(lang)
-        if streak >= LANG_SWITCH_THRESHOLD:
-            await update.message.reply_text(reminder, reply_markup=choose_lang_kb())
-        else:
-            await update.message.reply_text(reminder)
-        return
-    else:
-        if ctx.user_data.get(LANG_MISMATCH_STREAK):
-            ctx.user_data[LANG_MISMATCH_STREAK] = 0
-
-    # Память: добавляем реплику пользователя
-    _push_history(ctx, "user", user_text)
-
-    # Индикатор «печатает»
-    await send_action_safe(update, ChatAction.TYPING)
-
-    # Генерация ответа
-    try:
-        reply = await call_openrouter(char, lang, user_text, ctx, temperature=0.6)
-    except httpx.HTTPStatusError as e:
-        log.exception("OpenRouter HTTP error")
-        await update.message.reply_text(f"LLM HTTP {e.response.status_code}: {e.response.reason_phrase}")
-        return
-    except Exception as e:
-        log.exception("OpenRouter error")
-        await update.message.reply_text(f"LLM ошибка: {e}")
-        return
-
-    # Если ответ мусорный — 2-я попытка
-    if looks_bad(reply):
-        log.warning("Bad reply detected, retrying with temperature=0.4")
-        await send_action_safe(update, ChatAction.TYPING)
-        try:
-            reply = await call_openrouter(char, lang, user_text, ctx, temperature=0.4)
-        except Exception:
-            pass
-
-    if looks_bad(reply):
-        reply = "Давай попробуем ещё раз — сформулируй мысль чуть точнее."
-
-    _push_history(ctx, "assistant", reply)
-    await update.message.reply_text(reply)
-
-# ---------- ОШИБКИ ----------
-async def on_error(update: object, ctx: ContextTypes.DEFAULT_TYPE) -> None:
-    if isinstance(ctx.error, Conflict):
-        log.warning("409 Conflict. Waiting…")
-        return
-    log.exception("Unhandled error", exc_info=ctx.error)
-    try:
-        if isinstance(update, Update) and update.effective_message:
-            await update.effective_message.reply_text("Ошибка 🛠️")
-    except Exception:
-        pass
-
-# ---------- APP ----------
-def build_app() -> Application:
-    app = (
-        Application.builder()
-        .token(TELEGRAM_BOT_TOKEN)
-        .post_init(delete_webhook)
-        .build()
-    )
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("menu", cmd_menu))
-    app.add_handler(CommandHandler("story", cmd_story))
-    app.add_handler(CommandHandler("char", cmd_char))
-    app.add_handler(CommandHandler("lang", cmd_lang))
-    app.add_handler(CommandHandler("reset", cmd_reset))
-    app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
-    app.add_error_handler(on_error)
-    return app
-
-if __name__ == "__main__":
-    app = build_app()
-    while True:
-        try:
-            app.run_polling(allowed_updates=Update.ALL_TYPES, poll_interval=1.0)
-            break
-        except Conflict:
-            logging.getLogger("pixorbi-bot").warning("409 Conflict. Retry in 5s…")
-            time.sleep(5)
+# bot.py
+# -*- coding: utf-8 -*-
+import os
+import asyncio
+import atexit
+import bisect
+import contextvars
+import copy
+import hashlib
+import logging
+import logging.handlers
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+import traceback
+import re
+import random
+import json
+import sqlite3
+import zlib
+import httpx
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
+from typing import AsyncIterator
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+
+from telegram import (
+    Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+)
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, Conflict, RetryAfter
+from telegram.ext import (
+    Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler,
+    ContextTypes, CallbackQueryHandler, TypeHandler, filters
+)
+
+# ---------- ЛОГИ ----------
+# Вывод в stdout — в отдельном потоке (QueueHandler → QueueListener): при шторме ошибок
+# цикл событий не ждёт терминал. На цикле остаются только сбор полей и getMessage().
+log = logging.getLogger("pixorbi-bot")
+
+# Структурные поля: chat_id/update_id ставит планировщик апдейтов, stage — _within,
+# остальное можно передать через extra={...}.
+LOG_FIELD_NAMES = ("chat_id", "update_id", "stage", "latency")
+_LOG_FIELDS: contextvars.ContextVar[dict] = contextvars.ContextVar("log_fields", default={})
+_LOG_LISTENER: logging.handlers.QueueListener | None = None
+
+def log_fields(**fields) -> contextvars.Token:
+    return _LOG_FIELDS.set({**_LOG_FIELDS.get(), **fields})
+
+class _FieldsFilter(logging.Filter):
+    """
+    Выполняется в потоке, который пишет лог: подхватывает поля из contextvars и extra.
+    Трейсбек одной и той же ошибки (тип + место) — не чаще раза в interval секунд,
+    остальные записи идут одной строкой с типом ошибки и счётчиком пропущенных.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self._seen: dict[tuple, list] = {}  # ключ ошибки -> [когда снова можно, сколько пропущено]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = dict(_LOG_FIELDS.get())
+        for name in LOG_FIELD_NAMES:
+            value = record.__dict__.get(name)
+            if value is not None:
+                fields[name] = value
+        record.fields = fields
+        if self.interval > 0 and record.exc_info and record.exc_info[0] is not None:
+            self._sample(record)
+        return True
+
+    def _sample(self, record: logging.LogRecord) -> None:
+        etype, exc, tb = record.exc_info
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        key = (etype, tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb else (etype, record.pathname, record.lineno)
+        now = time.monotonic()
+        state = self._seen.get(key)
+        if state is None or now >= state[0]:
+            if state and state[1]:
+                record.fields["suppressed"] = state[1]
+            self._seen[key] = [now + self.interval, 0]
+            return
+        state[1] += 1
+        record.fields["exc"] = f"{etype.__name__}: {exc}"
+        record.exc_info = None
+        record.exc_text = None
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # в отличие от штатного prepare, трейсбек не форматируем — это сделает поток слушателя
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+class _Formatter(logging.Formatter):
+    def __init__(self, json_lines: bool):
+        super().__init__("%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+        self.json_lines = json_lines
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " | " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not self.json_lines:
+            return super().format(record)
+        doc = {"ts": self.formatTime(record), "level": record.levelname, "logger": record.name,
+               "msg": record.getMessage(), **(getattr(record, "fields", None) or {})}
+        if record.exc_info:
+            doc["traceback"] = self.formatException(record.exc_info)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+def setup_logging() -> None:
+    global _LOG_LISTENER
+    handler = logging.StreamHandler()
+    handler.setFormatter(_Formatter(LOG_JSON))
+    fields = _FieldsFilter(LOG_TRACEBACK_INTERVAL)
+    root = logging.getLogger()
+    try:
+        root.setLevel(LOG_LEVEL)
+    except ValueError:
+        root.setLevel(logging.INFO)
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    if LOG_QUEUE:
+        queue_handler = _QueueHandler(SimpleQueue())
+        queue_handler.addFilter(fields)
+        _LOG_LISTENER = logging.handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+        _LOG_LISTENER.start()
+        atexit.register(stop_logging)
+        root.addHandler(queue_handler)
+    else:
+        handler.addFilter(fields)
+        root.addHandler(handler)
+
+def stop_logging() -> None:
+    """Дописываем очередь; процессы multiprocessing выходят без atexit, поэтому зовём явно."""
+    global _LOG_LISTENER
+    listener, _LOG_LISTENER = _LOG_LISTENER, None
+    if listener is not None:
+        listener.stop()
+
+# ---------- ENV ----------
+PROCESS_STARTED = time.monotonic()
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "thedrummer/unslopnemo-12b")
+OR_HTTP_REFERER = os.getenv("OR_HTTP_REFERER", "https://pixorbibot.onrender.com")
+OR_X_TITLE = os.getenv("OR_X_TITLE", "PixorbiDream")
+
+# URL бэкенда; нормализуем до .../chat
+RUNPOD_HTTP = (os.getenv("RUNPOD_HTTP") or "").strip()
+if RUNPOD_HTTP and not RUNPOD_HTTP.endswith("/chat"):
+    RUNPOD_HTTP = RUNPOD_HTTP.rstrip("/") + "/chat"
+
+# ключи для доступа к бэкенду через LB
+RUNPOD_ACCOUNT_KEY = os.getenv("RUNPOD_ACCOUNT_KEY") or os.getenv("RUNPOD_API_KEY")  # rpa_...
+APP_KEY = os.getenv("APP_KEY")  # внутренний ключ приложения (проверяется в app.py)
+
+def _as_bool(v: str | None, default=False) -> bool:
+    if v is None:
+        return default
+    return v.strip().lower() in {"1", "true", "yes", "y", "on"}
+
+def _env_int(name: str, default: int, minimum: int | None = None) -> int:
+    try:
+        v = int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+    return max(minimum, v) if minimum is not None else v
+
+def _env_float(name: str, default: float, minimum: float | None = None) -> float:
+    try:
+        v = float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+    return max(minimum, v) if minimum is not None else v
+
+FORCE_RESELECT_ON_START = _as_bool(os.getenv("FORCE_RESELECT_ON_START"), True)
+
+try:
+    LANG_SWITCH_THRESHOLD = max(1, int(os.getenv("LANG_SWITCH_THRESHOLD", "3")))
+except Exception:
+    LANG_SWITCH_THRESHOLD = 3
+
+# HTTP-клиенты к апстримам: пул keep-alive соединений, таймауты по апстриму
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+HTTP_MAX_CONNECTIONS = _env_int("HTTP_MAX_CONNECTIONS", 100, 1)
+HTTP_MAX_KEEPALIVE = _env_int("HTTP_MAX_KEEPALIVE", 20, 0)
+HTTP_KEEPALIVE_EXPIRY = _env_float("HTTP_KEEPALIVE_EXPIRY", 30.0, 0.0)
+HTTP_CONNECT_TIMEOUT = _env_float("HTTP_CONNECT_TIMEOUT", 10.0, 0.5)
+HTTP2_ENABLED = _as_bool(os.getenv("HTTP2"), False)  # нужен пакет h2
+RUNPOD_TIMEOUT = _env_float("RUNPOD_TIMEOUT", 60.0, 1.0)
+OPENROUTER_TIMEOUT = _env_float("OPENROUTER_TIMEOUT", 60.0, 1.0)
+HTTP_STATS_INTERVAL = _env_float("HTTP_STATS_INTERVAL", 0.0, 0.0)  # 0 — не логировать
+
+# Предохранитель (circuit breaker) и хеджирование RUNPOD_HTTP → OpenRouter
+BREAKER_FAILURES = _env_int("BREAKER_FAILURES", 5, 1)            # ошибок подряд до размыкания
+BREAKER_OPEN_SECONDS = _env_float("BREAKER_OPEN_SECONDS", 30.0, 1.0)
+RUNPOD_HEALTH_URL = (os.getenv("RUNPOD_HEALTH_URL") or "").strip()  # пусто — пробуем живым запросом
+HEDGE_ENABLED = _as_bool(os.getenv("HEDGE_ENABLED"), False)
+HEDGE_QUANTILE = min(0.999, _env_float("HEDGE_QUANTILE", 0.95, 0.5))
+HEDGE_MIN_DELAY = _env_float("HEDGE_MIN_DELAY", 1.0, 0.05)
+HEDGE_MAX_DELAY = _env_float("HEDGE_MAX_DELAY", 15.0, 0.1)
+
+# Микробатчинг запросов к RUNPOD_HTTP: копим до RUNPOD_BATCH_MAX штук или RUNPOD_BATCH_WAIT_MS мс
+RUNPOD_BATCH = _as_bool(os.getenv("RUNPOD_BATCH"), False)
+RUNPOD_BATCH_URL = (os.getenv("RUNPOD_BATCH_URL") or "").strip()  # по умолчанию .../chat_batch
+RUNPOD_BATCH_MAX = _env_int("RUNPOD_BATCH_MAX", 8, 1)
+RUNPOD_BATCH_WAIT_MS = _env_float("RUNPOD_BATCH_WAIT_MS", 10.0, 0.0)
+RUNPOD_BATCH_RECHECK = _env_float("RUNPOD_BATCH_RECHECK", 600.0, 10.0)
+
+# Сессии бэкенда: вместо всей истории шлём только реплики после подтверждённой бэкендом версии
+# (он держит KV/префикс-кэш). Промах сессии (HTTP 409) — переотправляем историю целиком.
+RUNPOD_SESSIONS = _as_bool(os.getenv("RUNPOD_SESSIONS"), False)
+
+# Стриминг ответа: первое сообщение по первым токенам, затем правки с троттлингом
+STREAM_REPLIES = _as_bool(os.getenv("STREAM_REPLIES"), False)
+STREAM_EDIT_INTERVAL = _env_float("STREAM_EDIT_INTERVAL", 1.5, 0.3)
+STREAM_MIN_CHARS = _env_int("STREAM_MIN_CHARS", 20, 1)
+
+# Параллельная обработка: чаты — конкурентно, внутри чата — по порядку
+MAX_CONCURRENT_UPDATES = _env_int("MAX_CONCURRENT_UPDATES", 64, 1)
+LLM_MAX_INFLIGHT = _env_int("LLM_MAX_INFLIGHT", 16, 1)         # одновременных запросов к LLM
+LLM_QUEUE_TIMEOUT = _env_float("LLM_QUEUE_TIMEOUT", 30.0, 0.0)  # сколько ждать свободный слот
+FAST_COMMANDS = {"/menu", "/story", "/char", "/lang"}
+
+# Общий бюджет времени на один ход (бэкенд + fallback + повтор)
+TURN_DEADLINE = _env_float("TURN_DEADLINE", 90.0, 5.0)
+RETRY_MIN_BUDGET = _env_float("RETRY_MIN_BUDGET", 3.0, 0.0)  # меньше — повтор при мусорном ответе не делаем
+
+# Склейка серии быстрых сообщений в один ход (0 — выключено), секунды
+BURST_WINDOW = _env_float("BURST_WINDOW", 0.0, 0.0)
+
+# Несколько кандидатов параллельно вместо повтора (1 — выключено; цена — x CANDIDATES токенов)
+CANDIDATES = _env_int("CANDIDATES", 1, 1)
+try:
+    CANDIDATE_TEMPERATURES = [float(t) for t in os.getenv("CANDIDATE_TEMPERATURES", "0.6,0.4,0.8").split(",") if t.strip()]
+except Exception:
+    CANDIDATE_TEMPERATURES = [0.6, 0.4, 0.8]
+CANDIDATE_TEMPERATURES = CANDIDATE_TEMPERATURES or [0.6]
+
+# Персистентность user_data: SQLite, запись пачками раз в STATE_FLUSH_INTERVAL секунд
+STATE_DB = (os.getenv("STATE_DB", "state.sqlite3") or "").strip()  # пусто — только в памяти
+STATE_FLUSH_INTERVAL = _env_float("STATE_FLUSH_INTERVAL", 5.0, 0.5)
+# Простаивающие сессии: через SESSION_COMPRESS_AFTER сек история сжимается в памяти,
+# через SESSION_IDLE_TTL сек пользователь выгружается (данные остаются в базе). 0 — выключено.
+SESSION_COMPRESS_AFTER = _env_float("SESSION_COMPRESS_AFTER", 600.0, 0.0)
+SESSION_IDLE_TTL = _env_float("SESSION_IDLE_TTL", 3600.0, 0.0)
+SESSION_MAX_RESIDENT = _env_int("SESSION_MAX_RESIDENT", 0, 0)  # 0 — без лимита
+
+# Тёплый перезапуск: очередь Telegram не сбрасываем, getUpdates ведёт свой WarmPoller и подтверждает
+# только обработанное до конца (offset хранится в STATE_DB). В работе — не больше WARM_CATCHUP_MAX апдейтов.
+WARM_RESTART = _as_bool(os.getenv("WARM_RESTART"), False)
+WARM_CATCHUP_MAX = _env_int("WARM_CATCHUP_MAX", 500, 1)
+WARM_POLL_TIMEOUT = _env_float("WARM_POLL_TIMEOUT", 10.0, 0.0)  # long-poll getUpdates
+WARM_REFETCH_INTERVAL = _env_float("WARM_REFETCH_INTERVAL", 0.25, 0.05)  # пауза, пока всё полученное ещё в работе
+WARM_CATCHUP_MAX_AGE = _env_float("WARM_CATCHUP_MAX_AGE", 900.0, 0.0)  # сообщения старше — пропускаем; 0 — все
+POLL_INTERVAL = _env_float("POLL_INTERVAL", 0.0, 0.0)  # пауза между getUpdates; long-poll и так ждёт на сервере
+
+# Исходящая очередь в Telegram: общий лимит и лимит на чат (сообщений/сек).
+# Общий лимит — на весь бот: в webhook-режиме каждый воркер получает 1/WEBHOOK_WORKERS его части.
+OUTBOX_ENABLED = _as_bool(os.getenv("OUTBOX_ENABLED"), False)
+OUTBOX_GLOBAL_RATE = _env_float("OUTBOX_GLOBAL_RATE", 28.0, 0.1)
+OUTBOX_GLOBAL_BURST = _env_float("OUTBOX_GLOBAL_BURST", 30.0, 1.0)
+OUTBOX_CHAT_RATE = _env_float("OUTBOX_CHAT_RATE", 1.0, 0.05)
+OUTBOX_CHAT_BURST = _env_float("OUTBOX_CHAT_BURST", 3.0, 1.0)
+OUTBOX_MAX_RETRIES = _env_int("OUTBOX_MAX_RETRIES", 3, 0)
+
+# Режим работы: polling (один процесс) или webhook (приёмник + WEBHOOK_WORKERS процессов)
+BOT_MODE = (os.getenv("BOT_MODE") or "polling").strip().lower()
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org/bot")
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip()     # публичный https-адрес, пусто — setWebhook не зовём
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = _env_int("WEBHOOK_PORT", _env_int("PORT", 8443), 1)
+WEBHOOK_WORKERS = _env_int("WEBHOOK_WORKERS", os.cpu_count() or 1, 1)
+_WORKER_INDEX: int | None = None  # номер воркера в webhook-режиме
+
+# Каталог историй: файлы в STORIES_DIR, опрос изменений раз в CATALOG_POLL_INTERVAL секунд (0 — без перезагрузки)
+STORIES_DIR = os.getenv("STORIES_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "stories")
+CATALOG_POLL_INTERVAL = _env_float("CATALOG_POLL_INTERVAL", 10.0, 0.0)
+KB_PAGE_SIZE = _env_int("KB_PAGE_SIZE", 8, 1)  # кнопок на странице выбора истории/персонажа
+
+# Кэш ответов на типовые первые реплики («привет», «hi»): ключ — история, персонаж, язык и весь
+# нормализованный контекст; пока в записи меньше REPLY_CACHE_VARIANTS ответов, ходим в LLM и докладываем.
+REPLY_CACHE = _as_bool(os.getenv("REPLY_CACHE"), False)
+REPLY_CACHE_VARIANTS = _env_int("REPLY_CACHE_VARIANTS", 3, 1)
+REPLY_CACHE_TTL = _env_float("REPLY_CACHE_TTL", 3600.0, 1.0)
+REPLY_CACHE_MAX_KB = _env_int("REPLY_CACHE_MAX_KB", 1024, 1)
+REPLY_CACHE_MAX_HISTORY = _env_int("REPLY_CACHE_MAX_HISTORY", 0, 0)  # сообщений в истории; 0 — только первый ход
+
+# Метрики Prometheus: GET http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено).
+# В webhook-режиме воркер i слушает METRICS_PORT + 1 + i.
+METRICS_PORT = _env_int("METRICS_PORT", 0, 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Логи: LOG_QUEUE=1 — запись в stdout из фонового потока; LOG_JSON=1 — JSON-строки.
+# Одинаковые трейсбеки — не чаще раза в LOG_TRACEBACK_INTERVAL секунд (0 — все).
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").strip().upper()
+LOG_QUEUE = _as_bool(os.getenv("LOG_QUEUE"), True)
+LOG_JSON = _as_bool(os.getenv("LOG_JSON"), False)
+LOG_TRACEBACK_INTERVAL = _env_float("LOG_TRACEBACK_INTERVAL", 60.0, 0.0)
+
+# Сторож цикла событий: лаг меряется каждые LOOP_WATCHDOG_INTERVAL сек; если цикл не отвечает
+# дольше LOOP_LAG_THRESHOLD, в лог уходит стек потока цикла (то, что его держит).
+LOOP_WATCHDOG = _as_bool(os.getenv("LOOP_WATCHDOG"), False)
+LOOP_WATCHDOG_INTERVAL = _env_float("LOOP_WATCHDOG_INTERVAL", 0.1, 0.01)
+LOOP_LAG_THRESHOLD = _env_float("LOOP_LAG_THRESHOLD", 0.5, 0.05)
+
+setup_logging()
+
+if not TELEGRAM_BOT_TOKEN:
+    raise RuntimeError("TELEGRAM_BOT_TOKEN is required (Render → Environment)")
+
+# ---------- КОНСТАНТЫ / ХРАНИЛКА ----------
+STORY_KEY = "story"
+CHAR_KEY  = "char"
+LANG_KEY  = "lang"
+STARTED_KEY = "started"
+AWAIT_SETUP = "await_setup"
+LANG_MISMATCH_STREAK = "lang_mismatch_streak"
+
+DIALOG_HISTORY = "dialog_history"
+HIST_MAX_TURNS = 12  # хранить до 12 пользовательских + 12 ответов
+DIALOG_TOKENS = "dialog_tokens"          # старый формат: токены теперь внутри DialogHistory
+DIALOG_TOKENS_SUM = "dialog_tokens_sum"
+DIALOG_SUMMARY = "dialog_summary"        # сводка выпавших из окна реплик
+SUMMARY_PENDING = "summary_pending"      # выпавшие реплики, ещё не вошедшие в сводку
+
+HIST_TOKEN_BUDGET = _env_int("HIST_TOKEN_BUDGET", 1200, 50)
+SUMMARY_ENABLED = _as_bool(os.getenv("SUMMARY_ENABLED"), True)
+SUMMARY_MAX_CHARS = _env_int("SUMMARY_MAX_CHARS", 800, 100)
+
+DEFAULT_STORY = os.getenv("DEFAULT_STORY", "hope")  # «Меня зовут Хоуп»
+
+# ---------- МЕТАДАННЫЕ ИСТОРИЙ И ПЕРСОНАЖЕЙ ----------
+# Истории лежат в STORIES_DIR: index.json — названия и файлы историй, <story>.json —
+# персонажи (имена на RU/EN и персонные тексты). Все имена персонажей — слаги в нижнем регистре.
+
+# Персонные промпты: жёсткая фиксация языка + стиль
+PROMPT_ENFORCE = {
+    "ru": "ЖЁСТКОЕ ПРАВИЛО: отвечай СТРОГО на русском. Имя: {name}. "
+          "Если пользователь пишет не по-русски — всё равно отвечай по-русски и мягко напомни.",
+    "en": "HARD RULE: reply STRICTLY in English. Name: {name}. "
+          "If the user uses another language, still answer in English and gently remind them.",
+}
+PROMPT_CANON = {
+    "ru": "\nПравила согласованности:\n"
+          "- Не противоречь фактам, сказанным тобой ранее в этом чате.\n"
+          "- Держи один образ и биографию из канона истории.\n"
+          "- Говори короткими естественными фразами; без сценических ремарок в скобках.",
+    "en": "\nConsistency rules:\n"
+          "- Never contradict facts you already stated in this chat.\n"
+          "- Keep a single persona/biography consistent with the story canon.\n"
+          "- Use short, natural sentences; no stage directions in parentheses.",
+}
+PROMPT_FEWSHOT = {
+    "ru": "\n\nПримеры стиля:\n"
+          "Пользователь: Поцелуешь меня?\n"
+          "Ассистент: Тихо усмехаюсь и наклоняюсь ближе. Короткий тёплый поцелуй — и взгляд не отрываю.\n"
+          "Пользователь: Обними меня.\n"
+          "Ассистент: Обнимаю крепко и спокойно. «Я рядом».",
+    "en": "\n\nStyle examples:\n"
+          "User: Will you kiss me?\n"
+          "Assistant: I smirk softly and lean in. A warm, brief kiss — I keep my eyes on you.\n"
+          "User: Hold me.\n"
+          "Assistant: I pull you close, steady. “I’m here.”",
+}
+
+def _prompt_lang(lang: str | None) -> str:
+    return "ru" if (lang or "ru").lower()[:2] == "ru" else "en"
+
+def compose_persona_prompt(characters: dict, character: str, lang: str) -> str:
+    """Собирает промпт персонажа; кэшируется в каталоге, здесь — только сборка."""
+    ch = (character or "").lower()
+    l = _prompt_lang(lang)
+    meta = characters.get(ch, {})
+    display_name = meta.get(l, ch.title())
+    base = meta.get(f"persona_{l}", "")
+    return base + "\n" + PROMPT_ENFORCE[l].format(name=display_name) + PROMPT_CANON[l] + PROMPT_FEWSHOT[l]
+
+def persona_system_prompt(character: str, lang: str, story: str | None = None) -> str:
+    return CATALOG.prompt(story, character, lang)
+
+# ---------- ЯЗЫКОВЫЕ НАПОМИНАНИЯ ----------
+def detect_lang(text: str) -> str | None:
+    has_cyr = bool(re.search(r"[А-Яа-яЁё]", text))
+    has_lat = bool(re.search(r"[A-Za-z]", text))
+    if has_cyr and not has_lat:
+        return "ru"
+    if has_lat and not has_cyr:
+        return "en"
+    return None
+
+LANG_REMINDERS = {
+    "ru": [
+        "Давай по-русски, пожалуйста 😊",
+        "Я сейчас говорю только по-русски. Переключишься?",
+        "Без английского, ладно? На русском будет легче 💫",
+    ],
+    "en": [
+        "Let’s keep it in English, please 💫",
+        "I’m answering only in English now. Can you switch?",
+        "English only for me right now, please.",
+    ],
+}
+def get_lang_reminder(lang: str) -> str:
+    arr = LANG_REMINDERS["ru" if (lang or "ru") == "ru" else "en"]
+    return random.choice(arr)
+
+# ---------- САНИТАЙЗЕР ----------
+RE_PUNCT_ONLY = re.compile(r"^[\s!?.…-]{10,}$")
+RE_PUNCT_PARTIAL = re.compile(r"^[\s!?.…-]*$")  # недописанный ответ пока из одной пунктуации
+# опережающая проверка первой буквы даёт движку быстрый пропуск по набору символов
+RE_FILLS = re.compile(r"(?=[ulhgw])\b(?:uh|um|lol|haha|giggle|winks|wipe)\b", re.I)
+RE_FILL_TAIL = re.compile(r"(?<!\w)(?:uh|um|lol|haha|giggle|winks|wipe)\Z", re.I)  # филлер в конце куска
+
+# Остальные правила — одним проходом. Результат тот же, что у прежней цепочки
+# «пробелы перед знаком → ....→... → двойные пробелы → !!!!→!!»: точки и !/?
+# через пробелы склеиваются прямо в своих правилах, а пробелы перед пунктуацией
+# проверяются раньше схлопывания пробелов.
+_CLEAN_RULES = (
+    r"(?P<ws>\s+(?=[,.!?;:]))",       # пробел перед знаком препинания
+    r"(?P<dots>\.(?:\s*\.){3,})",      # .... и ". . . ." → ...
+    r"(?P<sp>[ \t]{2,})",             # двойные пробелы
+)
+_REPEAT_RULES = (
+    r"(?P<rep>(?P<rc>[!?])(?:\s*(?P=rc)){3,})",  # !!!! → !!
+    r"(?P<ell>…{4,})",                          # ……… → ……
+)
+RE_CLEAN = re.compile(r"(?=[\s.])(?:" + "|".join(_CLEAN_RULES) + ")")
+RE_SANITIZE = re.compile(r"(?=[\s.!?…])(?:" + "|".join(_CLEAN_RULES + _REPEAT_RULES) + ")")
+_SANITIZE_REPL = {"ws": "", "dots": "...", "sp": " ", "ell": "……"}
+RE_CUT = re.compile(r"\w(?=\s)")  # конец слова перед пробелом — безопасная граница для стрима
+
+def _sanitize_sub(m: re.Match) -> str:
+    kind = m.lastgroup
+    return m.group("rc") * 2 if kind == "rep" else _SANITIZE_REPL[kind]
+
+def clean_text(s: str) -> str:
+    if not s:
+        return s
+    return RE_CLEAN.sub(_sanitize_sub, RE_FILLS.sub("", s)).strip()
+
+def sanitize_reply(s: str) -> str:
+    """clean_text + схлопывание повторов !?… — для ответов модели."""
+    if not s:
+        return ""
+    return RE_SANITIZE.sub(_sanitize_sub, RE_FILLS.sub("", s)).strip()
+
+class StreamSanitizer:
+    """
+    sanitize_reply по кускам стрима. Режем только после целого слова перед пробелом
+    (и не после филлера): ни одно правило такую границу не пересекает, поэтому
+    склейка кусков совпадает с sanitize_reply по всему тексту.
+    """
+    __slots__ = ("raw", "text", "_done")
+
+    def __init__(self):
+        self.raw = ""    # весь сырой текст
+        self.text = ""   # очищенный префикс, который уже не изменится
+        self._done = 0   # до какого места raw обработан
+
+    def reset(self) -> None:
+        self.raw, self.text, self._done = "", "", 0
+
+    def _emit(self, piece: str) -> None:
+        piece = RE_SANITIZE.sub(_sanitize_sub, RE_FILLS.sub("", piece))
+        self.text += piece if self.text else piece.lstrip()
+
+    def feed(self, delta: str) -> str:
+        start = max(len(self.raw) - 1, self._done)
+        self.raw += delta
+        cut = self._done
+        for m in RE_CUT.finditer(self.raw, start):
+            if not RE_FILL_TAIL.search(self.raw, max(0, m.end() - 8), m.end()):
+                cut = m.end()
+        if cut > self._done:
+            self._emit(self.raw[self._done:cut])
+            self._done = cut
+        return self.text
+
+    def finish(self) -> str:
+        self._emit(self.raw[self._done:])
+        self._done = len(self.raw)
+        self.text = self.text.rstrip()
+        return self.text
+
+def looks_bad(s: str) -> bool:
+    if not s or RE_PUNCT_ONLY.match(s):
+        return True
+    s = s.strip()
+    if len(s) >= 20 and len(set(s)) <= 2:
+        return True
+    return False
+
+# ---------- ХРАНИЛКА ДИАЛОГА ----------
+def _estimate_tokens(text: str) -> int:
+    # грубая оценка без токенайзера: ~3 символа на токен (кириллица дороже латиницы) + служебные
+    return (len(text or "") + 2) // 3 + 4
+
+_ROLE_CODES = {"user": "u", "assistant": "a", "system": "s"}
+_ROLE_NAMES = {v: k for k, v in _ROLE_CODES.items()}
+_ROLE_IDS = {"user": 0, "assistant": 1, "system": 2}
+_ROLES = ("user", "assistant", "system")
+
+class DialogHistory:
+    """
+    Компактная история: роль — один байт, токены — array, тексты — список строк.
+    Остывшую историю можно заморозить: тексты сжимаются zlib и
+    распаковываются при первом обращении.
+    seq — сколько реплик добавлено за всё время (версия для сессии бэкенда),
+    acked — (seq, начало окна), которые бэкенд подтвердил для session.
+    """
+    __slots__ = ("roles", "tokens", "total", "_texts", "_frozen", "seq", "session", "acked")
+
+    def __init__(self):
+        self.roles = bytearray()
+        self.tokens = array("I")
+        self.total = 0
+        self._texts: list[str] | None = []
+        self._frozen: bytes | None = None
+        self.seq = 0
+        self.session: str | None = None
+        self.acked: tuple[int, int] | None = None
+
+    @classmethod
+    def from_messages(cls, messages) -> "DialogHistory":
+        hist = cls()
+        for m in messages or []:
+            if isinstance(m, dict):
+                hist.append(m.get("role") or "user", m.get("content") or "")
+            else:  # упакованный вид [код роли, текст]
+                hist.append(_ROLE_NAMES.get(m[0], m[0]), m[1])
+        return hist
+
+    @property
+    def texts(self) -> list[str]:
+        if self._texts is None:
+            self._texts = json.loads(zlib.decompress(self._frozen).decode("utf-8"))
+            self._frozen = None
+        return self._texts
+
+    def freeze(self) -> None:
+        if self._texts:
+            self._frozen = zlib.compress(json.dumps(self._texts, ensure_ascii=False).encode("utf-8"), 6)
+            self._texts = None
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def append(self, role: str, content: str) -> int:
+        n = _estimate_tokens(content)
+        self.texts.append(content)
+        self.roles.append(_ROLE_IDS.get(role, 0))
+        self.tokens.append(n)
+        self.total += n
+        self.seq += 1
+        return n
+
+    def popleft(self) -> dict:
+        texts = self.texts
+        self.total -= self.tokens.pop(0)
+        role = _ROLES[self.roles.pop(0)]
+        return {"role": role, "content": texts.pop(0)}
+
+    def pop(self) -> None:
+        self.texts.pop()
+        self.roles.pop()
+        self.total -= self.tokens.pop()
+        self.seq -= 1
+        if self.acked and self.acked[0] > self.seq:
+            self.acked = None  # бэкенд видел снятую реплику — его версия больше не наша
+
+    def session_delta(self) -> tuple[dict, tuple[int, int]]:
+        """
+        Часть запроса к бэкенду в режиме сессий и отметка (seq, начало окна) для подтверждения.
+        base=None — история целиком; иначе history — только реплики после base,
+        а drop — сколько старых реплик выпало из окна с тех пор.
+        """
+        if self.session is None:
+            self.session = os.urandom(8).hex()
+        start = self.seq - len(self)
+        mark = (self.seq, start)
+        if self.acked is not None:
+            base, base_start = self.acked
+            new = self.seq - base
+            if 0 <= new <= len(self):
+                msgs = self.as_messages()[len(self) - new:] if new else []
+                return {"session": {"id": self.session, "base": base, "version": self.seq, "drop": start - base_start},
+                        "history": msgs}, mark
+        return {"session": {"id": self.session, "base": None, "version": self.seq, "drop": 0},
+                "history": self.as_messages()}, mark
+
+    def ack(self, session: dict | None, mark: tuple[int, int]) -> bool:
+        # подтверждение засчитываем, только если бэкенд вернул ту самую сессию и версию
+        if not isinstance(session, dict) or session.get("id") != self.session or session.get("version") != mark[0]:
+            return False
+        if mark[0] > self.seq:
+            return False
+        self.acked = mark
+        return True
+
+    def drop_session(self) -> None:
+        self.acked = None
+
+    def last(self) -> tuple[str, str] | None:
+        if not self.roles:
+            return None
+        return _ROLES[self.roles[-1]], self.texts[-1]
+
+    def as_messages(self) -> list[dict]:
+        return [{"role": _ROLES[r], "content": t} for r, t in zip(self.roles, self.texts)]
+
+    def packed(self) -> list[list[str]]:
+        return [[_ROLE_CODES[_ROLES[r]], t] for r, t in zip(self.roles, self.texts)]
+
+    def copy(self) -> "DialogHistory":
+        other = DialogHistory()
+        other.roles, other.tokens, other.total = bytearray(self.roles), array("I", self.tokens), self.total
+        other._texts = list(self._texts) if self._texts is not None else None
+        other._frozen = self._frozen
+        other.seq, other.session, other.acked = self.seq, self.session, self.acked
+        return other
+
+def _history(ctx: ContextTypes.DEFAULT_TYPE) -> DialogHistory:
+    hist = ctx.user_data.get(DIALOG_HISTORY)
+    if not isinstance(hist, DialogHistory):
+        # старый формат (список словарей) — переводим один раз
+        hist = ctx.user_data[DIALOG_HISTORY] = DialogHistory.from_messages(hist if isinstance(hist, list) else [])
+        ctx.user_data.pop(DIALOG_TOKENS, None)
+        ctx.user_data.pop(DIALOG_TOKENS_SUM, None)
+    return hist
+
+def _push_history(ctx: ContextTypes.DEFAULT_TYPE, role: str, content: str) -> None:
+    """
+    История режется по бюджету токенов HIST_TOKEN_BUDGET (и не длиннее HIST_MAX_TURNS пар).
+    Выпавшие реплики копятся в SUMMARY_PENDING и потом сворачиваются в сводку.
+    """
+    hist = _history(ctx)
+    hist.append(role, content)
+
+    evicted = []
+    while len(hist) > 1 and (len(hist) > HIST_MAX_TURNS * 2 or hist.total > HIST_TOKEN_BUDGET):
+        evicted.append(hist.popleft())
+
+    if evicted and SUMMARY_ENABLED:
+        pending = ctx.user_data.get(SUMMARY_PENDING)
+        if not isinstance(pending, list):
+            pending = ctx.user_data[SUMMARY_PENDING] = []
+        pending.extend(evicted)
+        if len(pending) > HIST_MAX_TURNS * 2:
+            del pending[:-HIST_MAX_TURNS * 2]
+
+def _owns_history(ctx: ContextTypes.DEFAULT_TYPE, hist: DialogHistory) -> bool:
+    """Ход всё ещё пишет в ту же историю: смена персонажа/истории или /reset ставят новую."""
+    return ctx.user_data.get(DIALOG_HISTORY) is hist
+
+def _pop_history(ctx: ContextTypes.DEFAULT_TYPE, role: str, content: str) -> bool:
+    """Откат последней реплики (отменённый ход); True, если она действительно была последней."""
+    hist = _history(ctx)
+    if hist.last() != (role, content):
+        return False
+    hist.pop()
+    return True
+
+def _build_messages(ctx: ContextTypes.DEFAULT_TYPE, system_prompt: str, user_text: str) -> list[dict]:
+    summary = ctx.user_data.get(DIALOG_SUMMARY)
+    if summary:
+        system_prompt += "\n\n" + _summary_header(ctx.user_data.get(LANG_KEY)) + summary
+    msgs = [{"role": "system", "content": system_prompt}]
+    msgs.extend(_history(ctx).as_messages())
+    msgs.append({"role": "user", "content": user_text})
+    return msgs
+
+# ---------- TELEGRAM ACTIONS ----------
+async def send_action_safe(update: Update, action: ChatAction) -> None:
+    try:
+        await update.effective_chat.send_action(action)
+    except Exception:
+        pass
+
+# ---------- ИСХОДЯЩАЯ ОЧЕРЕДЬ TELEGRAM ----------
+# Приоритет: сообщение > правка/удаление. Прочие методы — без очереди: ответ на кнопку
+# под лимиты сообщений не попадает, а «печатает» шлётся только когда чату нечего ждать.
+_OUTBOX_PRIORITY = {
+    "sendMessage": 1,
+    "editMessageText": 2,
+    "editMessageReplyMarkup": 2,
+    "deleteMessage": 2,
+}
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def delay(self, now: float) -> float:
+        if now < self.stamp:  # пауза после 429
+            return self.stamp - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until: float) -> None:
+        self.tokens = 0
+        self.stamp = max(self.stamp, until)
+
+class _OutJob:
+    __slots__ = ("prio", "seq", "endpoint", "chat", "key", "callback", "args", "kwargs", "future", "enqueued", "retries")
+
+class OutboundScheduler(BaseRateLimiter):
+    """
+    Все отправки в Telegram идут через одну очередь с token bucket на весь бот и на каждый чат.
+    «Печатает» токенов не тратит: выбрасывается, если чат и так ждёт отправки или одно уже в пути.
+    Правки одного сообщения схлопываются в последнюю, на 429 ждём retry_after и повторяем.
+    """
+
+    def __init__(self, global_rate: float, global_burst: float, chat_rate: float, chat_burst: float, max_retries: int):
+        self._global = _TokenBucket(global_rate, global_burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats: dict[str, _TokenBucket] = {}
+        self._max_retries = max_retries
+        self._queue: list[_OutJob] = []
+        self._seq = 0
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._waits: deque[float] = deque(maxlen=1000)
+        self._actions: set[str | None] = set()  # чаты, где «печатает» уже в пути
+        self.counters = {"sent": 0, "dropped_actions": 0, "merged_edits": 0, "retry_after": 0, "failed": 0}
+
+    def share_global(self, parts: int) -> None:
+        """Общий лимит делят parts процессов: каждому — своя доля скорости и запаса."""
+        self._global = _TokenBucket(self._global.rate / parts, max(1.0, self._global.burst / parts))
+
+    async def initialize(self) -> None:
+        if self._task is not None:  # зовут и Application, и Updater — бот у них общий
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for job in self._queue:
+            if not job.future.done():
+                job.future.cancel()
+        self._queue.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == "sendChatAction" and self._task is not None:
+            return await self._send_action(callback, args, kwargs, data)
+        prio = _OUTBOX_PRIORITY.get(endpoint)
+        if prio is None or self._task is None:
+            return await callback(*args, **kwargs)
+        chat = str(data["chat_id"]) if data.get("chat_id") is not None else None
+
+        key = (chat, data.get("message_id"), data.get("inline_message_id"))
+        if endpoint == "editMessageText":
+            for j in self._queue:
+                if j.endpoint == endpoint and j.key == key and not j.future.done():
+                    j.callback, j.args, j.kwargs = callback, args, kwargs  # старая правка уже не нужна
+                    self.counters["merged_edits"] += 1
+                    return await asyncio.shield(j.future)
+
+        job = _OutJob()
+        self._seq += 1
+        job.prio, job.seq, job.endpoint, job.chat, job.key = prio, self._seq, endpoint, chat, key
+        job.callback, job.args, job.kwargs = callback, args, kwargs
+        job.future = asyncio.get_running_loop().create_future()
+        job.enqueued = time.monotonic()
+        job.retries = 0
+        self._queue.append(job)
+        self._wakeup.set()
+        return await job.future
+
+    async def _send_action(self, callback, args, kwargs, data):
+        chat = str(data["chat_id"]) if data.get("chat_id") is not None else None
+        now = time.monotonic()
+        if (
+            chat in self._actions
+            or self._global.delay(now) > 0
+            or (chat in self._chats and self._chats[chat].delay(now) > 0)
+            or any(j.chat == chat for j in self._queue)
+        ):
+            self.counters["dropped_actions"] += 1
+            return True
+        self._actions.add(chat)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter:
+            self.counters["dropped_actions"] += 1  # индикатор не повторяем
+            return True
+        finally:
+            self._actions.discard(chat)
+
+    def _chat_bucket(self, chat: str) -> _TokenBucket:
+        bucket = self._chats.get(chat)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                now = time.monotonic()
+                self._chats = {c: b for c, b in self._chats.items() if b.delay(now) > 0 or b.tokens < b.burst}
+            bucket = self._chats[chat] = _TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _pick(self, now: float) -> tuple[_OutJob | None, float]:
+        best, wait = None, 1.0
+        for job in self._queue:
+            d = self._chat_bucket(job.chat).delay(now) if job.chat is not None else 0.0
+            if d > 0:
+                wait = min(wait, d)
+            elif best is None or (job.prio, job.seq) < (best.prio, best.seq):
+                best = job
+        return best, wait
+
+    async def _sleep(self, seconds: float) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._queue = [j for j in self._queue if not j.future.done()]
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            job, wait = self._pick(now)
+            if job is None:
+                await self._sleep(wait)
+                continue
+            g = self._global.delay(now)
+            if g > 0:
+                await self._sleep(g)
+                continue
+            self._queue.remove(job)
+            self._global.take(now)
+            if job.chat is not None:
+                self._chat_bucket(job.chat).take(now)
+            self._waits.append(now - job.enqueued)
+            asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: _OutJob) -> None:
+        try:
+            result = await job.callback(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            self.counters["retry_after"] += 1
+            until = time.monotonic() + float(e.retry_after)
+            (self._chat_bucket(job.chat) if job.chat is not None else self._global).pause(until)
+            if job.retries < self._max_retries and not job.future.done():
+                job.retries += 1
+                self._queue.append(job)
+                self._wakeup.set()
+                return
+            self.counters["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        except Exception as e:
+            self.counters["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        self.counters["sent"] += 1
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        depth = {}
+        for job in self._queue:
+            depth[job.endpoint] = depth.get(job.endpoint, 0) + 1
+        return {
+            "depth": len(self._queue),
+            "depth_by_endpoint": depth,
+            "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "wait_max": waits[-1] if waits else 0.0,
+            **self.counters,
+        }
+
+OUTBOX = (
+    OutboundScheduler(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_MAX_RETRIES)
+    if OUTBOX_ENABLED else None
+)
+
+# ---------- КАТАЛОГ ----------
+# Неизменяемый снимок каталога. При старте читается только index.json и собираются
+# клавиатуры выбора истории; сама история (персонажи, промпты, клавиатуры персонажей)
+# подгружается с диска при первом обращении, так что память растёт с числом историй
+# в работе, а не в каталоге. Изменения файлов замечает фоновый опрос mtime: новый
+# снимок собирается в отдельном потоке и подменяется одним присваиванием, а ходы,
+# уже взявшие промпт из старого снимка, дорабатывают с ним.
+class CatalogError(RuntimeError):
+    pass
+
+def _file_mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _read_json(path: str):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+class StoryEntry:
+    __slots__ = ("characters", "mtime", "prompts", "char_kb")
+
+    def __init__(self, characters: dict, mtime: int | None):
+        self.characters = characters
+        self.mtime = mtime
+        self.prompts: dict[tuple[str, str], str] = {}
+        self.char_kb: dict[tuple[str, int], InlineKeyboardMarkup] = {}
+
+class Catalog:
+    def __init__(self, root: str, index: dict, index_mtime: int | None, page_size: int = KB_PAGE_SIZE):
+        self.root = root
+        self.index = index  # story_id -> {"title_ru", "title_en", "file"}
+        self.index_mtime = index_mtime
+        self.page_size = page_size
+        self.story_ids = list(index)
+        self.default = DEFAULT_STORY if DEFAULT_STORY in index else self.story_ids[0]
+        self._loaded: dict[str, StoryEntry] = {}
+        self._failed: dict[str, int | None] = {}  # story_id -> mtime файла, который не прочитался
+        self._story_kb: dict[tuple[str, int], InlineKeyboardMarkup] = {}
+        for lang in ("ru", "en"):
+            for page in range(self._pages(len(self.story_ids))):
+                self._story_kb[(lang, page)] = self._build_story_kb(lang, page)
+
+    @classmethod
+    def load(cls, root: str, previous: "Catalog | None" = None) -> "Catalog":
+        """Читает index.json; загруженные истории переносит из previous или перечитывает, если файл изменился."""
+        path = os.path.join(root, "index.json")
+        mtime = _file_mtime(path)
+        stories = (_read_json(path) or {}).get("stories") or {}
+        index = {}
+        for sid, meta in stories.items():
+            if not isinstance(meta, dict) or not meta.get("title_ru") or not meta.get("title_en"):
+                raise CatalogError(f"{path}: story {sid!r} needs title_ru and title_en")
+            index[sid] = {"title_ru": meta["title_ru"], "title_en": meta["title_en"],
+                          "file": meta.get("file") or f"{sid}.json"}
+        if not index:
+            raise CatalogError(f"{path}: no stories")
+        catalog = cls(root, index, mtime)
+        if previous is not None:
+            for sid, entry in list(previous._loaded.items()):
+                if sid not in index:
+                    continue
+                if index[sid]["file"] == previous.index[sid]["file"] and \
+                        _file_mtime(os.path.join(root, index[sid]["file"])) == entry.mtime:
+                    catalog._loaded[sid] = entry
+                elif catalog._load_story(sid) is None:
+                    # битый файл: остаёмся на старой версии истории до следующей правки
+                    kept = StoryEntry(entry.characters, _file_mtime(os.path.join(root, index[sid]["file"])))
+                    kept.prompts, kept.char_kb = entry.prompts, entry.char_kb
+                    catalog._loaded[sid] = kept
+        return catalog
+
+    def changed(self) -> bool:
+        if _file_mtime(os.path.join(self.root, "index.json")) != self.index_mtime:
+            return True
+        return any(_file_mtime(os.path.join(self.root, self.index[sid]["file"])) != entry.mtime
+                   for sid, entry in list(self._loaded.items()))
+
+    def _load_story(self, sid: str) -> StoryEntry | None:
+        path = os.path.join(self.root, self.index[sid]["file"])
+        mtime = _file_mtime(path)
+        try:
+            characters = _read_json(path)["characters"]
+            for slug, names in characters.items():
+                if not names.get("ru") or not names.get("en"):
+                    raise ValueError(f"character {slug!r} needs ru and en names")
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            log.error("Catalog: story %s not loaded from %s: %s", sid, path, e)
+            self._failed[sid] = mtime  # до правки файла не перечитываем и не шумим в лог
+            return None
+        entry = StoryEntry(characters, mtime)
+        for slug in characters:
+            for lang in ("ru", "en"):
+                entry.prompts[(slug, lang)] = compose_persona_prompt(characters, slug, lang)
+        items = {lang: [(names[lang], f"char|{slug}") for slug, names in characters.items()] for lang in ("ru", "en")}
+        for lang in ("ru", "en"):
+            for page in range(self._pages(len(characters))):
+                entry.char_kb[(lang, page)] = InlineKeyboardMarkup(self._page_rows(items[lang], page, f"cpage|{sid}"))
+        self._loaded[sid] = entry
+        log.info("Catalog: story %s loaded (%d characters)", sid, len(characters))
+        return entry
+
+    def _entry(self, story_id: str | None) -> tuple[str, StoryEntry | None]:
+        sid = story_id if story_id in self.index else self.default
+        entry = self._loaded.get(sid)
+        if entry is None and (sid not in self._failed or
+                              self._failed[sid] != _file_mtime(os.path.join(self.root, self.index[sid]["file"]))):
+            entry = self._load_story(sid)
+        if entry is None and sid != self.default:
+            return self._entry(self.default)
+        return sid, entry
+
+    def _pages(self, n: int) -> int:
+        return max(1, -(-n // self.page_size))
+
+    def _page_rows(self, items: list[tuple[str, str]], page: int, nav: str) -> list[list[InlineKeyboardButton]]:
+        # items — (подпись, callback_data); nav — префикс callback_data для листания
+        pages = self._pages(len(items))
+        chunk = items[page * self.page_size:(page + 1) * self.page_size]
+        rows = [[InlineKeyboardButton(label, callback_data=data)] for label, data in chunk]
+        if pages > 1:
+            buttons = []
+            if page > 0:
+                buttons.append(InlineKeyboardButton("◀️", callback_data=f"{nav}|{page - 1}"))
+            buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+            if page < pages - 1:
+                buttons.append(InlineKeyboardButton("▶️", callback_data=f"{nav}|{page + 1}"))
+            rows.append(buttons)
+        return rows
+
+    def _build_story_kb(self, lang: str, page: int) -> InlineKeyboardMarkup:
+        items = [(meta["title_ru"] if lang == "ru" else meta["title_en"], f"story|{sid}")
+                 for sid, meta in self.index.items()]
+        return InlineKeyboardMarkup(self._page_rows(items, page, "spage"))
+
+    @property
+    def loaded_count(self) -> int:
+        return len(self._loaded)
+
+    def story(self, story_id: str | None) -> dict:
+        return self.index.get(story_id) or self.index[self.default]
+
+    def title(self, story_id: str | None, lang: str | None) -> str:
+        meta = self.story(story_id)
+        return meta["title_ru"] if _prompt_lang(lang) == "ru" else meta["title_en"]
+
+    def prompt(self, story_id: str | None, character: str, lang: str) -> str:
+        _, entry = self._entry(story_id)
+        characters = entry.characters if entry is not None else {}
+        if entry is not None:
+            cached = entry.prompts.get(((character or "").lower(), _prompt_lang(lang)))
+            if cached is not None:
+                return cached
+        # неизвестный персонаж — собираем на лету и не кэшируем (ключи приходят от пользователя)
+        return compose_persona_prompt(characters, character, lang)
+
+    def story_kb(self, lang: str | None = "ru", page: int = 0) -> InlineKeyboardMarkup:
+        lang = _prompt_lang(lang)
+        kb = self._story_kb.get((lang, page))
+        return kb if kb is not None else self._story_kb[(lang, 0)]
+
+    def char_kb(self, story_id: str | None, lang: str | None = "ru", page: int = 0) -> InlineKeyboardMarkup:
+        _, entry = self._entry(story_id)
+        if entry is None:
+            return InlineKeyboardMarkup([])
+        lang = _prompt_lang(lang)
+        kb = entry.char_kb.get((lang, page))
+        return kb if kb is not None else entry.char_kb[(lang, 0)]
+
+try:
+    CATALOG = Catalog.load(STORIES_DIR)
+except (OSError, ValueError, CatalogError) as e:
+    raise RuntimeError(f"Story catalog is not readable from {STORIES_DIR}: {e}") from e
+
+async def reload_catalog() -> bool:
+    """Пересобирает снимок в отдельном потоке, если файлы изменились, и подменяет его целиком."""
+    global CATALOG
+    loop = asyncio.get_running_loop()
+    current = CATALOG
+    if not await loop.run_in_executor(None, current.changed):
+        return False
+    try:
+        fresh = await loop.run_in_executor(None, Catalog.load, current.root, current)
+    except (OSError, ValueError, CatalogError) as e:
+        log.error("Catalog reload failed, keeping the current one: %s", e)
+        # повторим, только когда index.json снова изменится
+        current.index_mtime = _file_mtime(os.path.join(current.root, "index.json"))
+        return False
+    CATALOG = fresh
+    log.info("Catalog reloaded: %d stories, %d loaded", len(fresh.story_ids), fresh.loaded_count)
+    return True
+
+async def _watch_catalog(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reload_catalog()
+        except Exception as e:
+            log.warning("Catalog watch failed: %s", e)
+
+def start_catalog_watch(app: Application) -> None:
+    if CATALOG_POLL_INTERVAL > 0:
+        app.bot_data["_catalog_task"] = asyncio.create_task(_watch_catalog(CATALOG_POLL_INTERVAL))
+
+def stop_catalog_watch(app: Application) -> None:
+    task = app.bot_data.pop("_catalog_task", None)
+    if task:
+        task.cancel()
+
+# ---------- КНОПКИ / МЕНЮ ----------
+MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Выбрать историю",  callback_data="menu|change_story")],
+    [InlineKeyboardButton("Сменить персонажа", callback_data="menu|change_char")],
+    [InlineKeyboardButton("Сменить язык",      callback_data="menu|change_lang")],
+])
+LANG_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Русский 🇷🇺", callback_data="lang|ru")],
+    [InlineKeyboardButton("English 🇬🇧", callback_data="lang|en")],
+])
+
+def main_menu_kb() -> InlineKeyboardMarkup:
+    return MAIN_MENU_KB
+
+def choose_story_kb(lang: str = "ru", page: int = 0) -> InlineKeyboardMarkup:
+    return CATALOG.story_kb(lang, page)
+
+def choose_char_kb(story_id: str, lang: str = "ru", page: int = 0) -> InlineKeyboardMarkup:
+    return CATALOG.char_kb(story_id, lang, page)
+
+def choose_lang_kb() -> InlineKeyboardMarkup:
+    return LANG_KB
+
+# ---------- СОСТОЯНИЕ / ХЕЛПЕРЫ ----------
+def need_setup(ctx: ContextTypes.DEFAULT_TYPE) -> bool:
+    if ctx.user_data.get(AWAIT_SETUP):
+        return True
+    if not ctx.user_data.get(STORY_KEY) or not ctx.user_data.get(CHAR_KEY) or not ctx.user_data.get(LANG_KEY):
+        return True
+    return False
+
+def reset_setup(ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    ctx.user_data[AWAIT_SETUP] = True
+    ctx.user_data[LANG_MISMATCH_STREAK] = 0
+    ctx.user_data[DIALOG_HISTORY] = DialogHistory()
+    ctx.user_data.pop(DIALOG_TOKENS, None)
+    ctx.user_data.pop(DIALOG_TOKENS_SUM, None)
+    ctx.user_data[DIALOG_SUMMARY] = ""
+    ctx.user_data[SUMMARY_PENDING] = []
+
+# ---------- МЕТРИКИ ----------
+# Счётчики и гистограммы в текстовом формате Prometheus. На горячем пути — только
+# поиск в dict и bisect; всё форматирование — при запросе /metrics.
+def _prom_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_prom_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, v in list(self._values.items()):
+            lines.append(f"{self.name}{_prom_labels(self.labels, key)} {v:g}")
+        return lines
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._series: dict[tuple, list] = {}  # labels -> [counts по корзинам + inf, sum]
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in list(self._series.items()):
+            acc = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_prom_labels(self.labels + ('le',), key + (le,))} {acc}")
+            lines.append(f"{self.name}_sum{_prom_labels(self.labels, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_prom_labels(self.labels, key)} {acc}")
+        return lines
+
+M_STAGE = Histogram("pixorbi_stage_seconds", "Time spent per stage of a turn", ("stage", "story", "char"))
+# ожидание в очереди чата меряется до загрузки user_data — история и персонаж ещё неизвестны
+M_CHAT_QUEUE = Histogram("pixorbi_chat_queue_seconds", "Wait for the per-chat update lock")
+M_TURNS = Counter("pixorbi_turns_total", "Chat turns answered", ("story", "char"))
+M_FALLBACKS = Counter("pixorbi_fallbacks_total", "RUNPOD_HTTP -> OpenRouter fallbacks", ("reason", "story", "char"))
+M_BAD_RETRIES = Counter("pixorbi_bad_reply_retries_total", "looks_bad retries", ("story", "char"))
+M_LANG_REMINDERS = Counter("pixorbi_lang_reminders_total", "Language mismatch reminders", ("story", "char"))
+M_ERRORS = Counter("pixorbi_errors_total", "Errors by kind", ("kind",))
+M_TOKENS = Counter("pixorbi_tokens_total", "Estimated tokens", ("direction", "story", "char"))
+M_LOOP_LAG = Histogram("pixorbi_loop_lag_seconds", "Event loop wake-up lag", (),
+                       (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+M_SESSIONS = Counter("pixorbi_backend_session_requests_total", "RUNPOD_HTTP requests by history mode", ("mode",))
+M_REPLY_CACHE = Counter("pixorbi_reply_cache_total", "Reply cache lookups and fills", ("result", "story", "char"))
+METRICS = [M_STAGE, M_CHAT_QUEUE, M_TURNS, M_FALLBACKS, M_BAD_RETRIES, M_LANG_REMINDERS, M_ERRORS, M_TOKENS, M_SESSIONS, M_REPLY_CACHE, M_LOOP_LAG]
+
+def _metric_labels(ctx: ContextTypes.DEFAULT_TYPE) -> tuple[str, str]:
+    return ctx.user_data.get(STORY_KEY) or DEFAULT_STORY, ctx.user_data.get(CHAR_KEY) or "-"
+
+def _gauge_lines() -> list[str]:
+    # мгновенные значения собираем при запросе, а не на каждом апдейте
+    gauges: list[tuple[str, str, dict, float]] = []
+    if _LLM_SLOTS is not None:
+        gauges.append(("pixorbi_llm_inflight", "LLM calls in flight", {}, LLM_MAX_INFLIGHT - _LLM_SLOTS._value))
+    states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    for name, b in BREAKERS.items():
+        gauges.append(("pixorbi_circuit_state", "0 closed, 1 half-open, 2 open", {"upstream": name}, states[b.state]))
+    for name, st in http_pool_stats().items():
+        gauges.append(("pixorbi_http_connections", "Pooled upstream connections", {"upstream": name}, st["connections"]))
+    gauges.append(("pixorbi_catalog_stories_loaded", "Stories loaded from the catalog", {}, CATALOG.loaded_count))
+    if STATE is not None:
+        gauges.append(("pixorbi_sessions_resident", "User sessions kept in memory", {}, STATE.resident))
+    if REPLY_CACHE:
+        gauges.append(("pixorbi_reply_cache_entries", "Reply cache keys", {}, len(REPLY_CACHE_STORE)))
+        gauges.append(("pixorbi_reply_cache_bytes", "Reply cache size", {}, REPLY_CACHE_STORE.size))
+    if OUTBOX is not None:
+        gauges.append(("pixorbi_outbox_depth", "Queued Telegram requests", {}, OUTBOX.stats()["depth"]))
+    lines, seen = [], set()
+    for name, doc, labels, value in gauges:
+        if name not in seen:
+            seen.add(name)
+            lines += [f"# HELP {name} {doc}", f"# TYPE {name} gauge"]
+        lines.append(f"{name}{_prom_labels(tuple(labels), tuple(labels.values()))} {value:g}")
+    return lines
+
+def render_metrics() -> bytes:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += _gauge_lines()
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+async def _metrics_handler(method: str, path: str, headers: dict, body: bytes):
+    if method == "GET" and path.split("?", 1)[0] == "/metrics":
+        return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics()
+    return 404, "text/plain", b"not found"
+
+async def start_metrics(app: Application) -> None:
+    if not METRICS_PORT:
+        return
+    port = METRICS_PORT if _WORKER_INDEX is None else METRICS_PORT + 1 + _WORKER_INDEX
+    try:
+        app.bot_data["_metrics_server"] = await serve_http(METRICS_HOST, port, _metrics_handler)
+        log.info("Metrics on http://%s:%d/metrics", METRICS_HOST, port)
+    except OSError as e:
+        log.warning("Metrics endpoint disabled: %s", e)
+
+async def stop_metrics(app: Application) -> None:
+    server = app.bot_data.pop("_metrics_server", None)
+    if server is not None:
+        server.close()
+
+# ---------- HTTP-КЛИЕНТЫ ----------
+# Один долгоживущий клиент на апстрим: соединения (TCP+TLS) переиспользуются между сообщениями.
+UPSTREAM_RUNPOD = "runpod"
+UPSTREAM_OPENROUTER = "openrouter"
+UPSTREAM_TIMEOUTS = {
+    UPSTREAM_RUNPOD: RUNPOD_TIMEOUT,
+    UPSTREAM_OPENROUTER: OPENROUTER_TIMEOUT,
+}
+
+_HTTP_CLIENTS: dict[str, httpx.AsyncClient] = {}
+_HTTP_COUNTERS: dict[str, dict[str, int]] = {}
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def _make_http_client(upstream: str) -> httpx.AsyncClient:
+    counters = _HTTP_COUNTERS.setdefault(upstream, {"requests": 0, "responses": 0, "errors": 0})
+
+    async def on_request(request: httpx.Request) -> None:
+        counters["requests"] += 1
+
+    async def on_response(response: httpx.Response) -> None:
+        counters["responses"] += 1
+        if response.status_code >= 400:
+            counters["errors"] += 1
+
+    http2 = HTTP2_ENABLED
+    if http2 and not _http2_available():
+        log.warning("HTTP2=1, но пакет h2 не установлен — используем HTTP/1.1")
+        http2 = False
+
+    total = UPSTREAM_TIMEOUTS.get(upstream, 60.0)
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(total, connect=min(HTTP_CONNECT_TIMEOUT, total)),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=http2,
+        event_hooks={"request": [on_request], "response": [on_response]},
+    )
+
+def http_client(upstream: str) -> httpx.AsyncClient:
+    """Общий клиент апстрима; создаётся лениво, если post_init ещё не отработал."""
+    client = _HTTP_CLIENTS.get(upstream)
+    if client is None or client.is_closed:
+        client = _HTTP_CLIENTS[upstream] = _make_http_client(upstream)
+    return client
+
+def http_pool_stats() -> dict[str, dict]:
+    stats = {}
+    for upstream, client in _HTTP_CLIENTS.items():
+        item = dict(_HTTP_COUNTERS.get(upstream, {}))
+        # httpx не отдаёт пул публично — читаем httpcore-пул осторожно
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        try:
+            conns = list(getattr(pool, "connections", None) or [])
+            idle = sum(1 for c in conns if c.is_idle())
+        except Exception:
+            conns, idle = [], 0
+        item.update(connections=len(conns), idle=idle, active=len(conns) - idle, closed=client.is_closed)
+        stats[upstream] = item
+    return stats
+
+async def _log_upstream_stats(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        for upstream, st in http_pool_stats().items():
+            log.info(
+                "HTTP pool %s: conns=%s active=%s idle=%s req=%s resp=%s err=%s",
+                upstream, st["connections"], st["active"], st["idle"],
+                st.get("requests", 0), st.get("responses", 0), st.get("errors", 0),
+            )
+        stats = upstream_stats()
+        hedge = stats.pop("hedge")
+        batch = stats.pop("batch", None)
+        if batch:
+            log.info("RUNPOD batch: batches=%s batched=%s single=%s largest=%s unsupported=%s",
+                     batch["batches"], batch["batched_items"], batch["single_items"], batch["largest"], batch["unsupported"])
+        for upstream, st in stats.items():
+            log.info(
+                "Circuit %s: state=%s ok=%s fail=%s rejected=%s opened=%s p95=%s",
+                upstream, st["state"], st["success"], st["failure"], st["rejected"], st["opened"],
+                f"{st['p95']:.2f}s" if st["p95"] is not None else "-",
+            )
+        if OUTBOX is not None:
+            ob = OUTBOX.stats()
+            log.info("Outbox: depth=%s wait_p50=%.2fs wait_p95=%.2fs sent=%s dropped_actions=%s merged_edits=%s retry_after=%s",
+                     ob["depth"], ob["wait_p50"], ob["wait_p95"], ob["sent"], ob["dropped_actions"],
+                     ob["merged_edits"], ob["retry_after"])
+        if HEDGE_ENABLED:
+            log.info("Hedge: hedged=%s primary_wins=%s fallback_wins=%s unhedged=%s",
+                     hedge["hedged"], hedge["primary_wins"], hedge["fallback_wins"], hedge["unhedged"])
+
+async def init_http_clients(app: Application) -> None:
+    upstreams = []
+    if RUNPOD_HTTP:
+        upstreams.append(UPSTREAM_RUNPOD)
+    if OPENROUTER_API_KEY:
+        upstreams.append(UPSTREAM_OPENROUTER)
+    for upstream in upstreams:
+        http_client(upstream)
+    if HTTP_STATS_INTERVAL > 0:
+        app.bot_data["_http_stats_task"] = asyncio.create_task(_log_upstream_stats(HTTP_STATS_INTERVAL))
+    log.info("HTTP clients ready: %s (http2=%s)", ", ".join(upstreams) or "-", HTTP2_ENABLED)
+
+async def prewarm_http_clients(timeout: float = 5.0) -> None:
+    """HEAD в каждый апстрим заранее: первый ход после старта не платит за TCP+TLS."""
+    urls = {UPSTREAM_RUNPOD: RUNPOD_HTTP, UPSTREAM_OPENROUTER: OPENROUTER_URL}
+
+    async def warm(upstream: str) -> None:
+        try:
+            await http_client(upstream).head(urls[upstream], timeout=timeout)
+        except httpx.HTTPError as e:
+            log.info("Prewarm %s failed: %s", upstream, e)
+
+    await asyncio.gather(*(warm(u) for u in list(_HTTP_CLIENTS) if urls.get(u)))
+
+async def close_http_clients(app: Application) -> None:
+    task = app.bot_data.pop("_http_stats_task", None)
+    if task:
+        task.cancel()
+    clients = list(_HTTP_CLIENTS.values())
+    _HTTP_CLIENTS.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            log.warning("HTTP client close failed: %s", e)
+
+# ---------- ПРЕДОХРАНИТЕЛИ АПСТРИМОВ ----------
+class UpstreamUnavailable(Exception):
+    """Апстрим отключён предохранителем и запасного нет."""
+
+class CircuitBreaker:
+    """
+    closed → (BREAKER_FAILURES ошибок подряд) → open → (BREAKER_OPEN_SECONDS) → half_open → closed/open.
+    В open запросы к апстриму не идут вовсе. Если задан health_url — проверяем его в фоне,
+    иначе после паузы пропускаем один пробный живой запрос (half_open).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, upstream: str, failures: int, open_seconds: float, health_url: str = ""):
+        self.upstream = upstream
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.health_url = health_url
+        self.state = self.CLOSED
+        self.fail_streak = 0
+        self.opened_at = 0.0
+        self._trial = False
+        self._probe: asyncio.Task | None = None
+        self._latencies: deque[float] = deque(maxlen=200)
+        self.counters = {"success": 0, "failure": 0, "rejected": 0, "opened": 0}
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and not self.health_url and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        self.counters["rejected"] += 1
+        return False
+
+    def success(self, latency: float) -> None:
+        self.counters["success"] += 1
+        self._latencies.append(latency)
+        self.fail_streak = 0
+        self._trial = False
+        if self.state != self.CLOSED:
+            log.info("Circuit %s closed", self.upstream)
+        self.state = self.CLOSED
+
+    def failure(self) -> None:
+        self.counters["failure"] += 1
+        self.fail_streak += 1
+        self._trial = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.fail_streak >= self.failures):
+            self._open()
+
+    def cancelled(self) -> None:
+        # отменённый запрос (проиграл хедж / вышел дедлайн) — не сигнал о здоровье
+        self._trial = False
+
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.counters["opened"] += 1
+        log.warning("Circuit %s open for %.0fs after %d failures", self.upstream, self.open_seconds, self.fail_streak)
+        if self.health_url and (self._probe is None or self._probe.done()):
+            try:
+                self._probe = asyncio.get_running_loop().create_task(self._probe_loop())
+            except RuntimeError:
+                pass
+
+    async def _probe_loop(self) -> None:
+        while self.state == self.OPEN:
+            await asyncio.sleep(self.open_seconds)
+            try:
+                r = await http_client(self.upstream).get(self.health_url, timeout=5.0)
+                healthy = r.status_code < 500
+            except Exception:
+                healthy = False
+            if healthy:
+                self.state = self.HALF_OPEN
+                log.info("Circuit %s half-open: health probe ok", self.upstream)
+                return
+
+    def quantile(self, q: float) -> float | None:
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        p95 = self.quantile(0.95)
+        return {"state": self.state, "fail_streak": self.fail_streak, "p95": p95, **self.counters}
+
+BREAKERS = {
+    UPSTREAM_RUNPOD: CircuitBreaker(UPSTREAM_RUNPOD, BREAKER_FAILURES, BREAKER_OPEN_SECONDS, RUNPOD_HEALTH_URL),
+    UPSTREAM_OPENROUTER: CircuitBreaker(UPSTREAM_OPENROUTER, BREAKER_FAILURES, BREAKER_OPEN_SECONDS),
+}
+HEDGE_STATS = {"hedged": 0, "unhedged": 0, "primary_wins": 0, "fallback_wins": 0}
+
+def hedge_delay() -> float:
+    p = BREAKERS[UPSTREAM_RUNPOD].quantile(HEDGE_QUANTILE)
+    if p is None:
+        return HEDGE_MAX_DELAY  # пока мало замеров — хеджируем только совсем медленные ответы
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p))
+
+def upstream_stats() -> dict:
+    stats = {name: b.stats() for name, b in BREAKERS.items()}
+    stats["hedge"] = dict(HEDGE_STATS)
+    if RUNPOD_BATCHER is not None:
+        stats["batch"] = dict(RUNPOD_BATCHER.stats)
+    return stats
+
+# ---------- МИКРОБАТЧИНГ RUNPOD ----------
+class BatchFailed(Exception):
+    """Весь /chat_batch не удался. Предохранитель это уже учёл один раз — в ходах не считаем."""
+
+class RunpodBatcher:
+    """
+    Копит одновременные запросы к /chat из разных чатов (до max_size или max_wait секунд)
+    и шлёт их одним POST в /chat_batch:
+        {"items": [payload, ...]} → {"results": [{"reply": "..."} | {"error": "..."}, ...]}
+    Если бэкенд /chat_batch не знает (404/405/501) — шлём по одному в /chat
+    и переспрашиваем не раньше чем через RUNPOD_BATCH_RECHECK секунд.
+    """
+
+    def __init__(self, url: str, batch_url: str, max_size: int, max_wait: float):
+        self.url = url
+        self.batch_url = batch_url
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._queue: list[tuple[dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._unsupported_until = 0.0
+        self.stats = {"batches": 0, "batched_items": 0, "single_items": 0, "largest": 0, "unsupported": 0}
+
+    async def submit(self, payload: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.append((payload, fut))
+        if len(self._queue) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._queue = self._queue, []
+        if items:
+            asyncio.create_task(self._send(items))
+
+    async def _send(self, items: list[tuple[dict, asyncio.Future]]) -> None:
+        items = [(p, f) for p, f in items if not f.done()]  # ожидающие могли уйти по дедлайну
+        if not items:
+            return
+        if len(items) == 1 or time.monotonic() < self._unsupported_until:
+            await asyncio.gather(*(self._send_one(p, f) for p, f in items))
+            return
+
+        client = http_client(UPSTREAM_RUNPOD)
+        try:
+            r = await client.post(self.batch_url, headers=_runpod_headers(), json={"items": [p for p, _ in items]})
+            if r.status_code in (404, 405, 501):
+                self.stats["unsupported"] += 1
+                self._unsupported_until = time.monotonic() + RUNPOD_BATCH_RECHECK
+                log.warning("RUNPOD batch endpoint unavailable (HTTP %s), sending items one by one", r.status_code)
+                await asyncio.gather(*(self._send_one(p, f) for p, f in items))
+                return
+            r.raise_for_status()
+            results = (r.json() or {}).get("results")
+            if not isinstance(results, list) or len(results) != len(items):
+                raise ValueError(f"bad /chat_batch response: {len(results or [])} results for {len(items)} items")
+        except Exception as e:
+            # одна ошибка апстрима, а не len(items): иначе один плохой батч открывает предохранитель
+            BREAKERS[UPSTREAM_RUNPOD].failure()
+            for _, f in items:
+                if not f.done():
+                    err = BatchFailed(f"/chat_batch failed: {e}")
+                    err.__cause__ = e
+                    f.set_exception(err)
+            return
+
+        self.stats["batches"] += 1
+        self.stats["batched_items"] += len(items)
+        self.stats["largest"] = max(self.stats["largest"], len(items))
+        for (_, f), res in zip(items, results):
+            if f.done():
+                continue
+            if not isinstance(res, dict) or res.get("error"):
+                err = res.get("error") if isinstance(res, dict) else res
+                f.set_exception(SessionMiss() if err == "session_miss" else RuntimeError(f"batch item failed: {err}"))
+            else:
+                f.set_result(res)
+
+    async def _send_one(self, payload: dict, fut: asyncio.Future) -> None:
+        self.stats["single_items"] += 1
+        try:
+            r = await http_client(UPSTREAM_RUNPOD).post(self.url, headers=_runpod_headers(), json=payload)
+            _runpod_raise_for_status(r)
+            data = r.json()
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        if not fut.done():
+            fut.set_result(data)
+
+def _runpod_batch_url(url: str) -> str:
+    return url[:-len("/chat")] + "/chat_batch" if url.endswith("/chat") else url.rstrip("/") + "_batch"
+
+RUNPOD_BATCHER = (
+    RunpodBatcher(RUNPOD_HTTP, RUNPOD_BATCH_URL or _runpod_batch_url(RUNPOD_HTTP), RUNPOD_BATCH_MAX, RUNPOD_BATCH_WAIT_MS / 1000.0)
+    if RUNPOD_BATCH and RUNPOD_HTTP else None
+)
+
+# ---------- ПЕРСИСТЕНТНОСТЬ ----------
+# user_data живёт в памяти, а в SQLite (WAL) уходит пачками по таймеру.
+# Пользователь подгружается из базы при первом апдейте после рестарта.
+def _pack_user_data(data: dict) -> bytes:
+    doc = dict(data)
+    hist = doc.pop(DIALOG_HISTORY, None)
+    doc.pop(DIALOG_TOKENS, None)
+    doc.pop(DIALOG_TOKENS_SUM, None)
+    packed = {"d": doc}
+    if isinstance(hist, list):
+        hist = DialogHistory.from_messages(hist)
+    if hist:
+        # история компактно: [[код роли, текст], ...]
+        packed["h"] = hist.packed()
+    raw = json.dumps(packed, ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(raw.encode("utf-8"), 6)
+
+def _unpack_user_data(blob: bytes) -> dict:
+    packed = json.loads(zlib.decompress(blob).decode("utf-8"))
+    data = packed.get("d") or {}
+    data.pop(DIALOG_TOKENS, None)
+    data.pop(DIALOG_TOKENS_SUM, None)
+    data[DIALOG_HISTORY] = DialogHistory.from_messages(packed.get("h"))
+    return data
+
+def _snapshot_user_data(data: dict) -> dict:
+    # поверхностная копия на цикле событий; сериализация — уже в потоке базы
+    return {k: (list(v) if isinstance(v, list) else v.copy() if isinstance(v, DialogHistory) else v)
+            for k, v in data.items()}
+
+class StateStore:
+    """SQLite-хранилище user_data. Все обращения к базе — в одном фоновом потоке."""
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-db")
+        self._conn: sqlite3.Connection | None = None
+        self._app: Application | None = None
+        self._loaded: set[int] = set()
+        self._dirty: set[int] = set()
+        self._seen: OrderedDict[int, float] = OrderedDict()  # uid -> последняя активность, старые в начале
+        self._cold: set[int] = set()  # история уже сжата
+        self._offset: tuple[int, list[int]] = (0, [])  # последнее записанное в meta: offset и обработанные выше
+        self._task: asyncio.Task | None = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open_sync(self) -> None:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.commit()
+        self._conn = conn
+
+    def _load_sync(self, user_id: int) -> dict | None:
+        row = self._conn.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return _unpack_user_data(row[0]) if row else None
+
+    def _write_sync(self, rows: list[tuple[int, dict]], meta: dict | None = None) -> None:
+        now = time.time()
+        packed = [(uid, _pack_user_data(data), now) for uid, data in rows]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO users (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                packed,
+            )
+            if meta:
+                self._conn.executemany(
+                    "INSERT INTO meta (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    [(k, str(v)) for k, v in meta.items()],
+                )
+
+    def _meta_sync(self, key: str) -> str | None:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _close_sync(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def open(self, app: Application) -> None:
+        self._app = app
+        await self._run(self._open_sync)
+        self._task = asyncio.create_task(self._flush_loop())
+        log.info("State DB ready: %s (flush every %.1fs)", self.path, self.flush_interval)
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=True)
+
+    async def load_offset(self) -> tuple[int, list[int]]:
+        """Сохранённый offset и апдейты выше него, которые уже были обработаны."""
+        try:
+            offset = int(await self._run(self._meta_sync, "update_offset") or 0)
+            ahead = [int(i) for i in (await self._run(self._meta_sync, "update_ahead") or "").split(",") if i]
+        except ValueError:
+            offset, ahead = 0, []
+        self._offset = (offset, ahead)
+        return offset, ahead
+
+    def is_loaded(self, user_id: int) -> bool:
+        return user_id in self._loaded
+
+    async def load(self, user_id: int) -> dict | None:
+        data = await self._run(self._load_sync, user_id)
+        self._loaded.add(user_id)
+        return data
+
+    def mark_dirty(self, user_id: int) -> None:
+        # пока сохранённые данные не прочитаны, пустой user_data не должен затереть строку в базе
+        if user_id in self._loaded:
+            self._dirty.add(user_id)
+
+    def touch(self, user_id: int) -> None:
+        self._seen[user_id] = time.monotonic()
+        self._seen.move_to_end(user_id)
+        self._cold.discard(user_id)
+
+    @property
+    def resident(self) -> int:
+        return len(self._seen)
+
+    def _busy(self, user_id: int, idle: float) -> bool:
+        # идущий ход, отложенная пачка сообщений или сводка ещё держат user_data
+        return idle < TURN_DEADLINE + 30 or user_id in _SUMMARY_TASKS or user_id in _BURSTS
+
+    async def sweep(self) -> None:
+        """Сжимаем остывшие истории и выгружаем давно молчащих пользователей."""
+        if self._app is None or not self._seen:
+            return
+        now = time.monotonic()
+        over = len(self._seen) - SESSION_MAX_RESIDENT if SESSION_MAX_RESIDENT else 0
+        evict: list[tuple[int, dict]] = []
+        for uid, seen in list(self._seen.items()):
+            idle = now - seen
+            expired = SESSION_IDLE_TTL and idle >= SESSION_IDLE_TTL
+            if not expired and over <= 0 and (not SESSION_COMPRESS_AFTER or idle < SESSION_COMPRESS_AFTER):
+                break  # дальше только более свежие
+            if self._busy(uid, idle):
+                continue
+            if expired or over > 0:
+                del self._seen[uid]
+                self._cold.discard(uid)
+                self._loaded.discard(uid)
+                self._dirty.discard(uid)
+                data = self._app.user_data.get(uid)
+                if data is not None:
+                    evict.append((uid, data))
+                    self._app.drop_user_data(uid)
+                over -= 1
+            elif uid not in self._cold:
+                hist = self._app.user_data.get(uid, {}).get(DIALOG_HISTORY)
+                if isinstance(hist, DialogHistory):
+                    hist.freeze()
+                self._cold.add(uid)
+        if not evict:
+            return
+        # запись уходит в тот же поток базы раньше любой повторной загрузки этих пользователей
+        try:
+            await self._run(self._write_sync, evict)
+        except Exception as e:
+            log.warning("State evict write failed (%d users): %s", len(evict), e)
+            for uid, data in evict:
+                if uid not in self._loaded:  # пользователь ещё не вернулся — возвращаем как было
+                    self._app.user_data[uid].update(data)
+                    self._loaded.add(uid)
+                    self._dirty.add(uid)
+                    self.touch(uid)
+            return
+        log.info("Evicted %d idle sessions, %d resident", len(evict), len(self._seen))
+
+    async def flush(self) -> None:
+        if self._app is None:
+            return
+        offset = (UPDATES.value, UPDATES.ahead()) if _tracks_offset() else self._offset
+        meta = None
+        if offset != self._offset:
+            meta = {"update_offset": offset[0], "update_ahead": ",".join(map(str, offset[1]))}
+        if not self._dirty and meta is None:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = [(uid, _snapshot_user_data(self._app.user_data[uid]))
+                for uid in dirty if uid in self._loaded and uid in self._app.user_data]
+        try:
+            await self._run(self._write_sync, rows, meta)
+        except Exception as e:
+            self._dirty |= dirty  # повторим в следующий раз
+            log.warning("State flush failed (%d users): %s", len(rows), e)
+            return
+        if meta:
+            self._offset = offset
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            await self.sweep()
+
+STATE: StateStore | None = None
+
+async def load_user_state(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    """group=-1: подтягиваем user_data из базы перед основными хендлерами."""
+    user = update.effective_user if isinstance(update, Update) else None
+    if STATE is None or user is None:
+        return
+    STATE.touch(user.id)
+    if STATE.is_loaded(user.id):
+        return
+    try:
+        data = await STATE.load(user.id)
+    except Exception as e:
+        # не помечен загруженным: следующий апдейт повторит загрузку, до тех пор ничего не пишем
+        log.warning("State load failed for %s, not saving until it succeeds: %s", user.id, e)
+        return
+    if data:
+        for key, value in data.items():
+            ctx.user_data.setdefault(key, value)
+
+async def mark_user_state(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    """group=1: после хендлеров помечаем пользователя к записи."""
+    user = update.effective_user if isinstance(update, Update) else None
+    if STATE is not None and user is not None:
+        STATE.mark_dirty(user.id)
+        STATE.touch(user.id)
+
+# ---------- ДЕДЛАЙН ХОДА ----------
+class DeadlineExceeded(Exception):
+    """Бюджет времени на ход исчерпан."""
+
+class Deadline:
+    """
+    Один бюджет времени на апдейт: бэкенд, fallback и повтор получают только остаток.
+    spent копит, куда ушло время ("primary.runpod", "retry.openrouter", ...).
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.started = time.monotonic()
+        self.phase = "primary"
+        self.spent: dict[str, float] = {}
+
+    def remaining(self) -> float:
+        return self.budget - (time.monotonic() - self.started)
+
+    def add(self, stage: str, seconds: float) -> None:
+        key = f"{self.phase}.{stage}" if self.phase else stage
+        self.spent[key] = self.spent.get(key, 0.0) + seconds
+
+    def summary(self) -> str:
+        parts = " ".join(f"{k}={v:.2f}s" for k, v in self.spent.items()) or "-"
+        return f"budget={self.budget:.0f}s used={time.monotonic() - self.started:.2f}s {parts}"
+
+async def _within(deadline: Deadline | None, stage: str, coro):
+    """Ждём coro не дольше остатка бюджета; по истечении запрос отменяется."""
+    if deadline is None:
+        return await coro
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        coro.close()
+        raise DeadlineExceeded(stage)
+    t0 = time.monotonic()
+    token = log_fields(stage=stage)
+    try:
+        return await asyncio.wait_for(coro, remaining)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(stage) from None
+    finally:
+        _LOG_FIELDS.reset(token)
+        deadline.add(stage, time.monotonic() - t0)
+
+# ---------- BACKEND / OPENROUTER ----------
+_STREAM_RESET = object()  # маркер для стрима: начатый ответ отброшен, генерация пошла заново
+
+def _runpod_headers() -> dict:
+    headers = {"Content-Type": "application/json"}
+    if RUNPOD_ACCOUNT_KEY:
+        headers["Authorization"] = f"Bearer {RUNPOD_ACCOUNT_KEY}"
+    if APP_KEY:
+        headers["x-api-key"] = APP_KEY
+    return headers
+
+class SessionMiss(Exception):
+    """Бэкенд не знает сессию или её версию — нужна полная история."""
+
+def _runpod_payload(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE,
+                    temperature: float | None = None) -> dict:
+    payload = {
+        "story_id": ctx.user_data.get(STORY_KEY, DEFAULT_STORY),
+        "character": character,
+        "lang": lang,
+        "message": text,
+        "history": _history(ctx).as_messages(),
+        "summary": ctx.user_data.get(DIALOG_SUMMARY) or "",
+    }
+    if temperature is not None:
+        payload["temperature"] = temperature  # иначе кандидаты и повтор получают один и тот же ответ
+    return payload
+
+def _runpod_session_payload(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE,
+                            temperature: float | None = None) -> tuple[dict, tuple | None]:
+    """
+    С RUNPOD_SESSIONS:
+        {..., "session": {"id", "base", "version", "drop"}, "history": [новые реплики]}
+        → {"reply": "...", "session": {"id", "version"}} или HTTP 409 (в батче — {"error": "session_miss"}).
+    Пока бэкенд ни разу не подтвердил сессию, история уходит целиком — старый бэкенд ничего не заметит.
+    """
+    if not RUNPOD_SESSIONS:
+        return _runpod_payload(character, lang, text, ctx, temperature), None
+    hist = _history(ctx)
+    part, mark = hist.session_delta()
+    payload = {
+        "story_id": ctx.user_data.get(STORY_KEY, DEFAULT_STORY),
+        "character": character,
+        "lang": lang,
+        "message": text,
+        "summary": ctx.user_data.get(DIALOG_SUMMARY) or "",
+        **part,
+    }
+    if temperature is not None:
+        payload["temperature"] = temperature
+    M_SESSIONS.inc("full" if part["session"]["base"] is None else "delta")
+    return payload, mark
+
+def _runpod_raise_for_status(r: httpx.Response) -> None:
+    if r.status_code == 409:
+        raise SessionMiss()
+    r.raise_for_status()
+
+def _openrouter_headers() -> dict:
+    return {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "HTTP-Referer": OR_HTTP_REFERER,
+        "X-Title": OR_X_TITLE,
+        "Content-Type": "application/json",
+    }
+
+def _openrouter_payload(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE, temperature: float) -> dict:
+    system_prompt = persona_system_prompt(character, lang, ctx.user_data.get(STORY_KEY))
+    return {
+        "model": OPENROUTER_MODEL,
+        "messages": _build_messages(ctx, system_prompt, text),
+        "temperature": temperature,
+        "top_p": 0.85,
+        "frequency_penalty": 0.35,
+        "max_tokens": 360,
+    }
+
+def _finish_reply(content: str) -> str:
+    return sanitize_reply(content or "") or "(пустой ответ)"
+
+def _log_runpod_error(e: Exception) -> None:
+    if isinstance(e, httpx.HTTPStatusError):
+        body = ""
+        try:
+            body = e.response.text[:300]
+        except Exception:
+            pass
+        log.warning("RUNPOD_HTTP HTTP %s: %s", e.response.status_code, body)
+    else:
+        log.warning("RUNPOD_HTTP failed, falling back to OpenRouter: %s", e)
+
+async def _post_runpod(payload: dict, deadline: Deadline | None) -> dict:
+    if RUNPOD_BATCHER is not None:
+        return await _within(deadline, UPSTREAM_RUNPOD, RUNPOD_BATCHER.submit(payload))
+    r = await _within(deadline, UPSTREAM_RUNPOD, http_client(UPSTREAM_RUNPOD).post(
+        RUNPOD_HTTP,
+        headers=_runpod_headers(),
+        json=payload,
+    ))
+    _runpod_raise_for_status(r)
+    return r.json()
+
+async def _call_runpod(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE,
+                       deadline: Deadline | None = None, temperature: float | None = None) -> str:
+    breaker = BREAKERS[UPSTREAM_RUNPOD]
+    t0 = time.monotonic()
+    try:
+        payload, mark = _runpod_session_payload(character, lang, text, ctx, temperature)
+        try:
+            data = await _post_runpod(payload, deadline)
+        except SessionMiss:
+            # бэкенд потерял сессию (рестарт, вытеснение) — сразу повторяем с полной историей
+            M_SESSIONS.inc("miss")
+            _history(ctx).drop_session()
+            payload, mark = _runpod_session_payload(character, lang, text, ctx, temperature)
+            data = await _post_runpod(payload, deadline)
+        if mark is not None:
+            _history(ctx).ack((data or {}).get("session"), mark)
+    except (asyncio.CancelledError, DeadlineExceeded, BatchFailed):
+        breaker.cancelled()  # BatchFailed уже посчитан в RunpodBatcher._send
+        raise
+    except Exception:
+        breaker.failure()
+        raise
+    breaker.success(time.monotonic() - t0)
+    return _finish_reply((data or {}).get("reply", ""))
+
+async def _call_openrouter_api(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE, temperature: float,
+                               deadline: Deadline | None = None) -> str:
+    breaker = BREAKERS[UPSTREAM_OPENROUTER]
+    t0 = time.monotonic()
+    try:
+        r = await _within(deadline, UPSTREAM_OPENROUTER, http_client(UPSTREAM_OPENROUTER).post(
+            OPENROUTER_URL,
+            headers=_openrouter_headers(),
+            json=_openrouter_payload(character, lang, text, ctx, temperature),
+        ))
+        r.raise_for_status()
+        data = r.json()
+    except (asyncio.CancelledError, DeadlineExceeded):
+        breaker.cancelled()
+        raise
+    except Exception:
+        breaker.failure()
+        raise
+    breaker.success(time.monotonic() - t0)
+
+    choice = (data.get("choices") or [{}])[0]
+    return _finish_reply((choice.get("message") or {}).get("content"))
+
+async def _hedged_call(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE, temperature: float,
+                       deadline: Deadline | None = None) -> str:
+    """
+    Бэкенд не ответил за hedge_delay() — параллельно шлём в OpenRouter,
+    берём первый успешный ответ, проигравшего отменяем.
+    """
+    primary = asyncio.create_task(_call_runpod(character, lang, text, ctx, deadline, temperature))
+    pending = {primary}
+    try:
+        delay = hedge_delay()
+        if deadline is not None:
+            delay = min(delay, max(0.0, deadline.remaining()))
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            pending = set()
+            if primary.exception() is None:
+                HEDGE_STATS["unhedged"] += 1
+                return primary.result()
+            if isinstance(primary.exception(), DeadlineExceeded):
+                raise primary.exception()
+            _log_runpod_error(primary.exception())
+
+        hedged = bool(pending)
+        if BREAKERS[UPSTREAM_OPENROUTER].allow():
+            if hedged:
+                HEDGE_STATS["hedged"] += 1
+            pending.add(asyncio.create_task(_call_openrouter_api(character, lang, text, ctx, temperature, deadline)))
+        elif not pending:
+            raise UpstreamUnavailable("RUNPOD_HTTP failed and OpenRouter circuit open")
+
+        last_error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if hedged:
+                        HEDGE_STATS["primary_wins" if task is primary else "fallback_wins"] += 1
+                    return task.result()
+                last_error = task.exception()
+                if task is primary and not isinstance(last_error, DeadlineExceeded):
+                    _log_runpod_error(last_error)
+        raise last_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def call_openrouter(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE, temperature: float = 0.6,
+                          deadline: Deadline | None = None) -> str:
+    """
+    Если задан RUNPOD_HTTP — шлём в бэкенд (/chat) с историей, языком и нужными заголовками.
+    Иначе — прямой вызов OpenRouter (fallback).
+    Бэкенд с открытым предохранителем пропускаем сразу; с HEDGE_ENABLED fallback стартует параллельно.
+    С deadline каждый апстрим получает только остаток бюджета, иначе — DeadlineExceeded.
+    """
+    if RUNPOD_HTTP:
+        if not BREAKERS[UPSTREAM_RUNPOD].allow():
+            log.info("RUNPOD_HTTP circuit open, going straight to OpenRouter")
+            M_FALLBACKS.inc("circuit_open", *_metric_labels(ctx))
+        elif HEDGE_ENABLED and OPENROUTER_API_KEY:
+            return await _hedged_call(character, lang, text, ctx, temperature, deadline)
+        else:
+            try:
+                return await _call_runpod(character, lang, text, ctx, deadline, temperature)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                _log_runpod_error(e)
+                M_FALLBACKS.inc("error", *_metric_labels(ctx))
+
+    # ---- Fallback: прямой OpenRouter ----
+    if not OPENROUTER_API_KEY:
+        return "(LLM не настроен)"
+    if not BREAKERS[UPSTREAM_OPENROUTER].allow():
+        raise UpstreamUnavailable("OpenRouter circuit open")
+
+    return await _call_openrouter_api(character, lang, text, ctx, temperature, deadline)
+
+# ---------- НЕСКОЛЬКО КАНДИДАТОВ ----------
+# Вместо последовательного повтора при мусорном ответе — CANDIDATES параллельных запросов,
+# первый приличный ответ выигрывает, остальные отменяются. Каждый запрос занимает свой слот LLM:
+# первый — слот хода, дополнительные берут свободные без ожидания, а если их нет — не запускаются.
+CANDIDATE_STATS = {"turns": 0, "first_good": 0, "later_good": 0, "all_bad": 0, "cancelled": 0, "no_slot": 0}
+
+def _good_candidate(reply: str) -> bool:
+    # после санитайзера "!!!!!!!!!!" превращается в "!!" и looks_bad его уже не ловит
+    if looks_bad(reply) or RE_PUNCT_PARTIAL.match(reply):
+        return False
+    return reply not in ("(пустой ответ)", "(LLM не настроен)")
+
+async def generate_candidates(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE,
+                              deadline: Deadline | None = None) -> str:
+    temps = [CANDIDATE_TEMPERATURES[i % len(CANDIDATE_TEMPERATURES)] for i in range(CANDIDATES)]
+    tasks = [asyncio.create_task(call_openrouter(character, lang, text, ctx, temps[0], deadline))]
+    for t in temps[1:]:
+        if not await try_acquire_llm_slot():
+            CANDIDATE_STATS["no_slot"] += 1
+            continue
+        task = asyncio.create_task(call_openrouter(character, lang, text, ctx, t, deadline))
+        task.add_done_callback(lambda _t: release_llm_slot())
+        tasks.append(task)
+    CANDIDATE_STATS["turns"] += 1
+    fallback: str | None = None
+    last_error: Exception | None = None
+    try:
+        for n, fut in enumerate(asyncio.as_completed(tasks)):
+            try:
+                reply = await fut
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                last_error = e
+                continue
+            if _good_candidate(reply):
+                CANDIDATE_STATS["first_good" if n == 0 else "later_good"] += 1
+                return reply
+            fallback = fallback or reply
+        CANDIDATE_STATS["all_bad"] += 1
+        if fallback is not None:
+            return fallback
+        raise last_error or RuntimeError("no candidates")
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                CANDIDATE_STATS["cancelled"] += 1
+
+# ---------- КЭШ ПЕРВЫХ ОТВЕТОВ ----------
+RE_CACHE_NORM = re.compile(r"[\W_]+")
+REPLY_CACHE_MAX_TEXT = 80  # длинные реплики почти не повторяются — не тратим на них место
+
+class _CacheEntry:
+    __slots__ = ("replies", "size", "expires")
+
+    def __init__(self, expires: float):
+        self.replies: list[str] = []
+        self.size = 0
+        self.expires = expires
+
+class ReplyCache:
+    """LRU + TTL с бюджетом по байтам; на ключ — несколько разных ответов, отдаём случайный."""
+
+    def __init__(self, variants: int, ttl: float, max_bytes: int):
+        self.variants, self.ttl, self.max_bytes = variants, ttl, max_bytes
+        self.size = 0
+        self._entries: OrderedDict[tuple, _CacheEntry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _drop(self, key: tuple) -> None:
+        self.size -= self._entries.pop(key).size
+
+    def get(self, key: tuple) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        # пока вариантов мало, отвечает LLM — иначе все получат один и тот же ответ
+        return random.choice(entry.replies) if len(entry.replies) >= self.variants else None
+
+    def add(self, key: tuple, reply: str) -> bool:
+        entry = self._entries.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            if entry is not None:
+                self._drop(key)
+            entry = self._entries[key] = _CacheEntry(time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(entry.replies) >= self.variants or reply in entry.replies:
+            return False
+        n = len(reply.encode("utf-8"))
+        entry.replies.append(reply)
+        entry.size += n
+        self.size += n
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+        return True
+
+REPLY_CACHE_STORE = ReplyCache(REPLY_CACHE_VARIANTS, REPLY_CACHE_TTL, REPLY_CACHE_MAX_KB * 1024)
+
+def _normalize_for_cache(text: str) -> str:
+    return RE_CACHE_NORM.sub(" ", text.casefold()).strip()
+
+def reply_cache_key(ctx: ContextTypes.DEFAULT_TYPE, char: str, lang: str, user_text: str) -> tuple | None:
+    """
+    Ключ кэша или None, если ход не подходит. Ключ покрывает всю историю целиком,
+    так что после расхождения диалога он просто не совпадёт ни с чем закэшированным.
+    """
+    if not REPLY_CACHE or ctx.user_data.get(DIALOG_SUMMARY) or ctx.user_data.get(SUMMARY_PENDING):
+        return None
+    hist = _history(ctx)
+    if len(hist) > REPLY_CACHE_MAX_HISTORY:
+        return None
+    text = _normalize_for_cache(user_text)
+    if not text or len(text) > REPLY_CACHE_MAX_TEXT:
+        return None
+    story = ctx.user_data.get(STORY_KEY) or DEFAULT_STORY
+    digest = hashlib.blake2b(digest_size=16)
+    for role, content in zip(hist.roles, hist.texts):
+        digest.update(b"%d\x00%s\x00" % (role, _normalize_for_cache(content).encode("utf-8")))
+    digest.update(text.encode("utf-8"))
+    # хэш промпта: правка персонажа в каталоге сама уводит мимо старых записей
+    return story, char, lang, hash(persona_system_prompt(char, lang, story)), digest.digest()
+
+# ---------- СТРИМИНГ ----------
+async def _iter_sse_data(r: httpx.Response) -> AsyncIterator[str]:
+    async for line in r.aiter_lines():
+        if not line.startswith("data:"):
+            continue  # комментарии (": OPENROUTER PROCESSING"), event:, id:
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        if data:
+            yield data
+
+async def _stream_runpod(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE,
+                         temperature: float | None = None) -> AsyncIterator[str]:
+    """
+    Бэкенд может ответить SSE (data: {"delta": "..."}), чанкованным текстом
+    или обычным JSON {"reply": "..."} — последнее значит, что стрим он не умеет.
+    """
+    hist = _history(ctx)
+    for attempt in range(2):
+        payload, mark = _runpod_session_payload(character, lang, text, ctx, temperature)
+        payload["stream"] = True
+        async with http_client(UPSTREAM_RUNPOD).stream("POST", RUNPOD_HTTP, headers=_runpod_headers(), json=payload) as r:
+            if r.status_code >= 400:
+                await r.aread()
+            if r.status_code == 409 and mark is not None and attempt == 0:
+                M_SESSIONS.inc("miss")
+                hist.drop_session()
+                continue
+            _runpod_raise_for_status(r)
+            ctype = r.headers.get("content-type", "")
+            if "text/event-stream" in ctype:
+                # подтверждение сессии приходит отдельным событием {"session": {...}}
+                async for data in _iter_sse_data(r):
+                    item = json.loads(data)
+                    if mark is not None and "session" in item:
+                        hist.ack(item["session"], mark)
+                    delta = item.get("delta") or item.get("token") or item.get("reply") or ""
+                    if delta:
+                        yield delta
+            elif "application/json" in ctype:
+                data = json.loads(await r.aread()) or {}
+                if mark is not None:
+                    hist.ack(data.get("session"), mark)
+                yield data.get("reply", "") or ""
+            else:
+                async for chunk in r.aiter_text():
+                    if chunk:
+                        yield chunk
+        return
+
+async def _stream_openrouter_api(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE, temperature: float) -> AsyncIterator[str]:
+    payload = _openrouter_payload(character, lang, text, ctx, temperature)
+    payload["stream"] = True
+    async with http_client(UPSTREAM_OPENROUTER).stream("POST", OPENROUTER_URL, headers=_openrouter_headers(), json=payload) as r:
+        if r.status_code >= 400:
+            await r.aread()
+        r.raise_for_status()
+        async for data in _iter_sse_data(r):
+            item = json.loads(data)
+            choice = (item.get("choices") or [{}])[0]
+            delta = (choice.get("delta") or {}).get("content") or ""
+            if delta:
+                yield delta
+
+async def stream_openrouter(character: str, lang: str, text: str, ctx: ContextTypes.DEFAULT_TYPE, temperature: float = 0.6) -> AsyncIterator:
+    """
+    Потоковый вариант call_openrouter: отдаёт сырые куски текста по мере генерации.
+    Если бэкенд упал посреди ответа — отдаём _STREAM_RESET и продолжаем через OpenRouter.
+    """
+    if RUNPOD_HTTP and BREAKERS[UPSTREAM_RUNPOD].allow():
+        breaker = BREAKERS[UPSTREAM_RUNPOD]
+        started = False
+        t0 = time.monotonic()
+        try:
+            async for delta in _stream_runpod(character, lang, text, ctx, temperature):
+                started = True
+                yield delta
+            breaker.success(time.monotonic() - t0)
+            return
+        except (asyncio.CancelledError, GeneratorExit):
+            breaker.cancelled()
+            raise
+        except Exception as e:
+            breaker.failure()
+            _log_runpod_error(e)
+            if started:
+                yield _STREAM_RESET
+
+    if not OPENROUTER_API_KEY:
+        yield "(LLM не настроен)"
+        return
+    if not BREAKERS[UPSTREAM_OPENROUTER].allow():
+        raise UpstreamUnavailable("OpenRouter circuit open")
+
+    breaker = BREAKERS[UPSTREAM_OPENROUTER]
+    t0 = time.monotonic()
+    try:
+        async for delta in _stream_openrouter_api(character, lang, text, ctx, temperature):
+            yield delta
+    except (asyncio.CancelledError, GeneratorExit):
+        breaker.cancelled()
+        raise
+    except Exception:
+        breaker.failure()
+        raise
+    breaker.success(time.monotonic() - t0)
+
+class ReplyStreamer:
+    """
+    Первое сообщение отправляется, как только набралось STREAM_MIN_CHARS символов,
+    дальше оно редактируется не чаще раза в STREAM_EDIT_INTERVAL секунд (лимиты Telegram на правки).
+    """
+
+    def __init__(self, update: Update):
+        self.update = update
+        self.message = None
+        self.sanitizer = StreamSanitizer()
+        self.shown = ""
+        self._last_edit = 0.0
+
+    @property
+    def raw(self) -> str:
+        return self.sanitizer.raw
+
+    def reset(self) -> None:
+        self.sanitizer.reset()
+
+    async def feed(self, delta: str) -> None:
+        # очищаем на лету только дописанные слова, без повторного прохода по всему ответу
+        preview = self.sanitizer.feed(delta)
+        if self.message is not None and time.monotonic() - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        if not preview or preview == self.shown or RE_PUNCT_PARTIAL.match(preview):
+            return
+        if self.message is None and len(preview) < STREAM_MIN_CHARS:
+            return
+        await self._show(preview)
+
+    async def _show(self, text: str) -> None:
+        try:
+            if self.message is None:
+                self.message = await self.update.message.reply_text(text)
+            else:
+                await self.message.edit_text(text)
+            self.shown = text
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                log.warning("Stream edit failed: %s", e)
+        except Exception as e:
+            log.warning("Stream update failed: %s", e)
+        self._last_edit = time.monotonic()
+
+    async def discard(self) -> None:
+        # ход отменён (пришло новое сообщение) или сорвался (дедлайн, ошибка) — недописанный ответ убираем
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except Exception:
+                pass
+            self.message = None
+
+    async def finish(self, text: str) -> None:
+        if self.message is None:
+            await self.update.message.reply_text(text)
+        elif text != self.shown:
+            delay = STREAM_EDIT_INTERVAL - (time.monotonic() - self._last_edit)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.message.edit_text(text)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+
+async def stream_reply(update: Update, ctx: ContextTypes.DEFAULT_TYPE, character: str, lang: str, text: str,
+                       temperature: float = 0.6, deadline: Deadline | None = None) -> tuple[str, ReplyStreamer]:
+    streamer = ReplyStreamer(update)
+
+    async def consume() -> None:
+        async for delta in stream_openrouter(character, lang, text, ctx, temperature):
+            if delta is _STREAM_RESET:
+                streamer.reset()
+                continue
+            await streamer.feed(delta)
+
+    try:
+        await _within(deadline, "stream", consume())
+    except (asyncio.CancelledError, Exception):
+        # вместо обрывка пользователь увидит извинение или текст ошибки из run_turn
+        await streamer.discard()
+        raise
+    return streamer.sanitizer.finish() or "(пустой ответ)", streamer
+
+# ---------- СВОДКА ИСТОРИИ ----------
+# Сводка строится в фоне после отправки ответа, пользователь её никогда не ждёт.
+_SUMMARY_TASKS: dict[int, asyncio.Task] = {}
+
+def _summary_header(lang: str | None) -> str:
+    if (lang or "ru") == "ru":
+        return "Кратко о том, что было раньше в этом чате:\n"
+    return "Earlier in this chat (summary):\n"
+
+def _clip_summary(text: str) -> str:
+    text = (text or "").strip()
+    return text if len(text) <= SUMMARY_MAX_CHARS else "…" + text[-SUMMARY_MAX_CHARS + 1:]
+
+def _extractive_summary(prev: str, turns: list[dict]) -> str:
+    # без LLM: первые фразы выпавших реплик
+    lines = [prev] if prev else []
+    for m in turns:
+        first = re.split(r"(?<=[.!?…])\s", (m.get("content") or "").strip(), maxsplit=1)[0]
+        who = "U" if m.get("role") == "user" else "A"
+        lines.append(f"{who}: {first[:160]}")
+    return _clip_summary("\n".join(lines))
+
+async def _llm_summary(prev: str, turns: list[dict], lang: str) -> str:
+    if not OPENROUTER_API_KEY:
+        return _extractive_summary(prev, turns)
+    dialog = "\n".join(f"{m.get('role')}: {m.get('content')}" for m in turns)
+    if lang == "ru":
+        instr = (f"Обнови краткую сводку ролевого диалога (до {SUMMARY_MAX_CHARS} символов, по-русски). "
+                 "Сохрани факты, имена, договорённости и чувства. Только текст сводки.")
+    else:
+        instr = (f"Update the short summary of a role-play chat (max {SUMMARY_MAX_CHARS} chars, in English). "
+                 "Keep facts, names, promises and feelings. Output only the summary.")
+    payload = {
+        "model": OPENROUTER_MODEL,
+        "messages": [
+            {"role": "system", "content": instr},
+            {"role": "user", "content": f"{prev or '-'}\n\n---\n{dialog}"},
+        ],
+        "temperature": 0.2,
+        "max_tokens": 220,
+    }
+    # сводка делит с живыми ходами и слоты LLM, и предохранитель OpenRouter
+    breaker = BREAKERS[UPSTREAM_OPENROUTER]
+    if not breaker.allow():
+        raise UpstreamUnavailable("OpenRouter circuit open")
+    await acquire_llm_slot(LLM_QUEUE_TIMEOUT)
+    t0 = time.monotonic()
+    try:
+        r = await http_client(UPSTREAM_OPENROUTER).post(OPENROUTER_URL, headers=_openrouter_headers(), json=payload)
+        r.raise_for_status()
+        data = r.json()
+    except asyncio.CancelledError:
+        breaker.cancelled()
+        raise
+    except Exception:
+        breaker.failure()
+        raise
+    finally:
+        release_llm_slot()
+    breaker.success(time.monotonic() - t0)
+    choice = (data.get("choices") or [{}])[0]
+    return _clip_summary((choice.get("message") or {}).get("content") or "") or _extractive_summary(prev, turns)
+
+async def _summarize(user_data: dict) -> None:
+    pending = user_data.get(SUMMARY_PENDING)
+    if not isinstance(pending, list) or not pending:
+        return
+    chunk = list(pending)
+    try:
+        summary = await _llm_summary(user_data.get(DIALOG_SUMMARY) or "", chunk, user_data.get(LANG_KEY) or "ru")
+    except Exception as e:
+        log.warning("Summary failed, will retry later: %s", e)
+        return
+    if user_data.get(SUMMARY_PENDING) is not pending:
+        return  # пока считали — был сброс диалога
+    del pending[:len(chunk)]
+    user_data[DIALOG_SUMMARY] = summary
+
+def schedule_summary(user_id: int, user_data: dict) -> None:
+    if not SUMMARY_ENABLED or not user_data.get(SUMMARY_PENDING):
+        return
+    if user_id in _SUMMARY_TASKS:
+        return
+    if _LLM_SLOTS is not None and _LLM_SLOTS.locked():
+        return  # все слоты заняты живыми ответами — свернём в следующий раз
+    task = asyncio.create_task(_summarize(user_data))
+    _SUMMARY_TASKS[user_id] = task
+    task.add_done_callback(lambda _t: _SUMMARY_TASKS.pop(user_id, None))
+
+# ---------- СЕРИИ СООБЩЕНИЙ ----------
+# Несколько быстрых сообщений подряд склеиваются в один ход. Новое сообщение во время
+# генерации отменяет её и запускает заново с объединённым текстом. Ходы запускаются через
+# app.create_task, и Application.stop их дожидается; что осталось — добирает on_shutdown.
+class _Burst:
+    __slots__ = ("texts", "update_ids", "update", "history", "task", "sender", "generating", "lock", "flush")
+
+    def __init__(self):
+        self.texts: list[str] = []
+        self.update_ids: list[int] = []  # удержаны в UPDATES, пока их текст не разобран ходом
+        self.update: Update | None = None
+        self.history: DialogHistory | None = None  # история, в которой написаны texts
+        self.task: asyncio.Task | None = None
+        self.sender: asyncio.Task | None = None  # ход, чей ответ уже уходит — его не отменяем
+        self.generating = False
+        self.lock = asyncio.Lock()
+        self.flush = asyncio.Event()  # остановка: окна больше не ждём
+
+_BURSTS: dict[int, _Burst] = {}
+BURST_STATS = {"messages": 0, "turns": 0, "merged": 0, "restarted": 0, "dropped": 0}
+
+def submit_burst(update: Update, ctx: ContextTypes.DEFAULT_TYPE, char: str, lang: str, text: str) -> None:
+    chat_id = update.effective_chat.id
+    burst = _BURSTS.get(chat_id)
+    if burst is None:
+        burst = _BURSTS[chat_id] = _Burst()
+    BURST_STATS["messages"] += 1
+    hist = _history(ctx)
+    if burst.texts and burst.history is not hist:
+        # диалог сбросили, пока копилась серия: старые сообщения к новому диалогу не относятся
+        BURST_STATS["dropped"] += len(burst.texts)
+        _take_burst(burst, len(burst.texts))
+    burst.history = hist
+    burst.texts.append(text)
+    burst.update_ids.append(update.update_id)
+    UPDATES.begin(update.update_id)  # обработчик вернётся сразу, а ответ ещё впереди — не подтверждаем
+    burst.update = update  # отвечаем на последнее сообщение серии
+
+    prev = burst.task
+    if prev is not None and not prev.done() and prev is not burst.sender:
+        BURST_STATS["restarted" if burst.generating else "merged"] += 1
+        prev.cancel()
+    burst.task = ctx.application.create_task(_burst_turn(chat_id, burst, ctx, char, lang))
+
+def _take_burst(burst: _Burst, n: int) -> None:
+    """Первые n сообщений серии разобраны: повторно не отправляются, offset может их пройти."""
+    ids = burst.update_ids[:n]
+    del burst.texts[:n]
+    del burst.update_ids[:n]
+    for update_id in ids:
+        UPDATES.done(update_id)
+
+async def _burst_turn(chat_id: int, burst: _Burst, ctx: ContextTypes.DEFAULT_TYPE, char: str, lang: str) -> None:
+    me = asyncio.current_task()
+    try:
+        try:
+            await asyncio.wait_for(burst.flush.wait(), BURST_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+        async with burst.lock:  # предыдущий ход мог ещё отправлять ответ
+            texts = list(burst.texts)
+            if not texts:
+                return
+
+            taken = ended = False
+
+            def commit() -> None:
+                nonlocal taken
+                burst.generating = False
+                burst.sender = me
+                _take_burst(burst, len(texts))
+                taken = True
+
+            BURST_STATS["turns"] += 1
+            burst.generating = True
+            try:
+                await run_turn(burst.update, ctx, char, lang, "\n".join(texts), on_reply=commit, hist=burst.history)
+                ended = True
+            except asyncio.CancelledError:
+                raise  # перезапуск: тексты остаются следующему ходу
+            except Exception:
+                ended = True
+                raise
+            finally:
+                # ход закончился без ответа (занято, ошибка LLM, дедлайн) — серию не повторяем
+                if ended and not taken:
+                    _take_burst(burst, len(texts))
+                burst.generating = False
+                if burst.sender is me:
+                    burst.sender = None
+                user = burst.update.effective_user
+                if STATE is not None and user is not None:
+                    STATE.mark_dirty(user.id)  # ход шёл вне процессора апдейтов
+                    STATE.touch(user.id)
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        log.exception("Burst turn failed (chat %s)", chat_id)
+    finally:
+        if burst.task is me and _BURSTS.get(chat_id) is burst and not burst.texts:
+            del _BURSTS[chat_id]
+
+async def drain_bursts() -> None:
+    """Остановка: оставшиеся серии уходят в ход без ожидания окна, ждём, пока ответы отправятся."""
+    tasks = []
+    for burst in _BURSTS.values():
+        burst.flush.set()
+        if burst.task is not None and not burst.task.done():
+            tasks.append(burst.task)
+    if tasks:
+        log.info("Flushing %d pending message bursts", len(tasks))
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# ---------- ПЛАНИРОВЩИК АПДЕЙТОВ ----------
+class LLMBusy(Exception):
+    """Не дождались свободного слота LLM за LLM_QUEUE_TIMEOUT."""
+
+_LLM_SLOTS: asyncio.Semaphore | None = None  # создаётся в цикле приложения (on_startup)
+
+async def acquire_llm_slot(timeout: float = LLM_QUEUE_TIMEOUT) -> None:
+    global _LLM_SLOTS
+    if _LLM_SLOTS is None:
+        _LLM_SLOTS = asyncio.Semaphore(LLM_MAX_INFLIGHT)
+    try:
+        await asyncio.wait_for(_LLM_SLOTS.acquire(), max(0.0, timeout))
+    except asyncio.TimeoutError:
+        raise LLMBusy() from None
+
+async def try_acquire_llm_slot() -> bool:
+    """Слот без ожидания: False — все заняты."""
+    global _LLM_SLOTS
+    if _LLM_SLOTS is None:
+        _LLM_SLOTS = asyncio.Semaphore(LLM_MAX_INFLIGHT)
+    if _LLM_SLOTS.locked():
+        return False
+    await _LLM_SLOTS.acquire()  # свободный семафор отдаёт слот без переключения задач
+    return True
+
+def release_llm_slot() -> None:
+    _LLM_SLOTS.release()
+
+def _update_chat_id(update: object) -> int | None:
+    if isinstance(update, Update) and update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+def _is_fast_update(update: object) -> bool:
+    """Кнопки меню и лёгкие команды — без ожидания генерации в этом же чате."""
+    if not isinstance(update, Update):
+        return False
+    if update.callback_query is not None:
+        return True
+    msg = update.message
+    if msg and msg.text and msg.text.startswith("/"):
+        cmd = msg.text.split(maxsplit=1)[0].split("@", 1)[0].lower()
+        return cmd in FAST_COMMANDS
+    return False
+
+class UpdateWatermark:
+    """
+    Наибольший update_id, до которого включительно все апдейты уже обработаны.
+    Апдейт удерживается (begin) с момента, как его забрали у Telegram, и до конца обработки;
+    done без begin просто отмечает апдейт обработанным.
+    """
+
+    def __init__(self):
+        self._inflight: dict[int, int] = {}  # update_id -> сколько раз удержан
+        self._done = 0
+        self._ahead: set[int] = set()  # обработаны, но за ещё не обработанным — повторно не берём
+        self.first_done: float | None = None
+
+    def resume(self, update_id: int, ahead=()) -> None:
+        self._done = max(self._done, update_id)
+        self._ahead.update(i for i in ahead if i > update_id)
+
+    def begin(self, update_id: int) -> None:
+        self._inflight[update_id] = self._inflight.get(update_id, 0) + 1
+
+    def done(self, update_id: int) -> None:
+        left = self._inflight.pop(update_id, 0) - 1
+        if left > 0:
+            self._inflight[update_id] = left
+            return
+        if not self._inflight:
+            self._ahead.clear()  # value станет максимумом — отметки выше него не нужны
+        elif update_id > min(self._inflight):
+            self._ahead.add(update_id)
+        self._done = max(self._done, update_id)
+        if self.first_done is None:
+            self.first_done = time.monotonic()
+            log.info("First update handled %.2fs after process start", self.first_done - PROCESS_STARTED)
+
+    def finished(self, update_id: int) -> bool:
+        return update_id <= self.value or update_id in self._ahead
+
+    def ahead(self) -> list[int]:
+        value = self.value
+        self._ahead = {i for i in self._ahead if i > value}
+        return sorted(self._ahead)
+
+    @property
+    def value(self) -> int:
+        # пока более ранний апдейт в работе, дальше него offset не двигаем
+        return min(self._inflight) - 1 if self._inflight else self._done
+
+UPDATES = UpdateWatermark()
+
+def _tracks_offset() -> bool:
+    # в webhook-режиме очередь ведёт сам Telegram, offset не нужен
+    return WARM_RESTART and BOT_MODE != "webhook"
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Разные чаты обрабатываются параллельно, апдейты одного чата — строго по очереди
+    (иначе два быстрых сообщения гоняются за DIALOG_HISTORY / LANG_MISMATCH_STREAK).
+    Быстрая полоса (_is_fast_update) не ждёт ни очередь чата, ни общий лимит.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._chat_waiters: dict[int, int] = {}
+
+    async def process_update(self, update: object, coroutine) -> None:
+        update_id = update.update_id if isinstance(update, Update) else None
+        if update_id is None:
+            await self._process(update, coroutine)
+            return
+        token = log_fields(chat_id=_update_chat_id(update), update_id=update_id)
+        try:
+            await self._process(update, coroutine)
+        finally:
+            _LOG_FIELDS.reset(token)
+            UPDATES.done(update_id)
+
+    async def _process(self, update: object, coroutine) -> None:
+        if _is_fast_update(update):
+            await coroutine
+            return
+        chat_id = _update_chat_id(update)
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+
+        # Замок чата берём раньше общего семафора: порядок внутри чата задаёт очередь замка
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+        t0 = time.monotonic()
+        try:
+            async with lock:
+                M_CHAT_QUEUE.observe(time.monotonic() - t0)
+                await super().process_update(update, coroutine)
+        finally:
+            left = self._chat_waiters[chat_id] - 1
+            if left:
+                self._chat_waiters[chat_id] = left
+            else:
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ---------- СТОРОЖ ЦИКЛА СОБЫТИЙ ----------
+class LoopWatchdog:
+    """
+    Пульс на цикле раз в interval отмечается и меряет лаг (насколько позже проснулся).
+    Поток-сторож видит, что пульса нет дольше threshold, и пишет стек потока цикла —
+    там ровно та корутина (или синхронный вызов), которая держит цикл.
+    """
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval, self.threshold = interval, threshold
+        self._beat = time.monotonic()
+        self._loop_thread: int | None = None
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+
+    async def _pulse(self) -> None:
+        self._loop_thread = threading.get_ident()
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - t0 - self.interval)
+            self._beat = now
+            M_LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                log.warning("Event loop lagged %.2fs", lag, extra={"latency": f"{lag:.2f}s"})
+
+    def _watch(self) -> None:
+        dumped = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or dumped == beat or self._loop_thread is None:
+                continue
+            dumped = beat  # один стек на одну остановку
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+            log.warning("Event loop blocked for %.2fs, loop thread stack:\n%s", stalled, stack.rstrip())
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._pulse())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+def start_loop_watchdog(app: Application) -> None:
+    if LOOP_WATCHDOG:
+        watchdog = app.bot_data["_loop_watchdog"] = LoopWatchdog(LOOP_WATCHDOG_INTERVAL, LOOP_LAG_THRESHOLD)
+        watchdog.start()
+
+def stop_loop_watchdog(app: Application) -> None:
+    watchdog = app.bot_data.pop("_loop_watchdog", None)
+    if watchdog is not None:
+        watchdog.stop()
+
+# ---------- ВЕБХУК ----------
+async def delete_webhook(app: Application) -> None:
+    drop = not WARM_RESTART
+    try:
+        await app.bot.delete_webhook(drop_pending_updates=drop)
+        log.info("Webhook deleted (drop_pending_updates=%s).", drop)
+        # без базы состояние потеряно, так что старые кнопки всё равно не сработают
+        if drop or STATE is None:
+            app.bot_data["started_at"] = datetime.now(timezone.utc)
+    except Exception as e:
+        log.warning("delete_webhook failed: %s", e)
+
+async def resume_offset() -> None:
+    if STATE is None:
+        return
+    saved, ahead = await STATE.load_offset()
+    UPDATES.resume(saved, ahead)
+    log.info("Warm restart: resuming after update %s (%d already handled above it)", saved or "-", len(ahead))
+
+class WarmPoller:
+    """
+    Свой цикл getUpdates вместо Updater'а. Штатный Updater подтверждает Telegram всё полученное
+    следующим же запросом, и апдейты, которые ещё обрабатывались, после падения уже не вернуть.
+    Здесь offset = UPDATES.value + 1: Telegram держит всё, что не обработано до конца,
+    а повторно пришедшие апдейты отбрасываются по update_id.
+    """
+
+    def __init__(self, app: Application):
+        self.app = app
+        self._queued: set[int] = set()  # забраны и ещё выше водяного знака
+        self.stats = {"polls": 0, "queued": 0, "refetched": 0, "stale": 0, "skipped_ahead": 0}
+
+    def _offset(self) -> int | None:
+        mark = UPDATES.value
+        self._queued = {i for i in self._queued if i > mark}
+        if len(self._queued) >= 100:
+            # ответ getUpdates (до 100 штук) целиком из уже взятых — без сдвига новые не получить;
+            # апдейты ниже сдвига после падения потеряются, как и с обычным Updater'ом
+            self.stats["skipped_ahead"] += 1
+            return max(self._queued) + 1
+        return mark + 1 if mark else None
+
+    async def _idle(self, stop: asyncio.Event, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self, stop: asyncio.Event) -> None:
+        cutoff_age = timedelta(seconds=WARM_CATCHUP_MAX_AGE) if WARM_CATCHUP_MAX_AGE else None
+        while not stop.is_set():
+            if len(self._queued) >= WARM_CATCHUP_MAX:
+                await self._idle(stop, WARM_REFETCH_INTERVAL)  # ждём, пока разберут уже взятые
+                self._offset()
+                continue
+            fetch = asyncio.ensure_future(self.app.bot.get_updates(
+                offset=self._offset(), limit=100, timeout=0 if self._queued else WARM_POLL_TIMEOUT,
+                allowed_updates=Update.ALL_TYPES,
+            ))
+            halt = asyncio.ensure_future(stop.wait())
+            await asyncio.wait({fetch, halt}, return_when=asyncio.FIRST_COMPLETED)
+            halt.cancel()
+            if not fetch.done():
+                fetch.cancel()
+                break
+            try:
+                batch = fetch.result()
+            except Conflict:
+                log.warning("409 Conflict. Retry in 5s…")
+                await self._idle(stop, 5.0)
+                continue
+            except Exception as e:
+                log.warning("getUpdates failed: %s", e)
+                await self._idle(stop, 1.0)
+                continue
+            self.stats["polls"] += 1
+            fresh = {u.update_id for u in batch if u.update_id not in self._queued and not UPDATES.finished(u.update_id)}
+            cutoff = datetime.now(timezone.utc) - cutoff_age if cutoff_age else None
+            for update in batch:
+                if update.update_id not in fresh:
+                    self.stats["refetched"] += 1
+                    continue
+                msg = update.message or update.edited_message
+                if cutoff and msg and msg.date and msg.date.replace(tzinfo=timezone.utc) < cutoff:
+                    self.stats["stale"] += 1
+                    UPDATES.done(update.update_id)
+                    continue
+                UPDATES.begin(update.update_id)  # отпустит процессор апдейтов
+                self._queued.add(update.update_id)
+                self.stats["queued"] += 1
+                await self.app.update_queue.put(update)
+            if batch and not fresh:
+                # всё полученное ещё в работе: Telegram отдаёт его сразу, long-poll не ждёт
+                await self._idle(stop, WARM_REFETCH_INTERVAL)
+            elif POLL_INTERVAL:
+                await self._idle(stop, POLL_INTERVAL)
+        log.info("Warm poller stopped: %s", " ".join(f"{k}={v}" for k, v in self.stats.items()))
+
+async def open_state(app: Application) -> None:
+    global STATE
+    if not STATE_DB:
+        return
+    store = StateStore(STATE_DB, STATE_FLUSH_INTERVAL)
+    try:
+        await store.open(app)
+    except Exception as e:
+        log.warning("State DB disabled, open failed: %s", e)
+        return
+    STATE = store
+
+async def close_state(app: Application) -> None:
+    global STATE
+    store, STATE = STATE, None
+    if store is not None:
+        await store.close()
+
+class _StartupClock:
+    def __init__(self):
+        self.t = time.monotonic()
+        # импорт, каталог и getMe (initialize) — всё, что было до post_init
+        self.laps = [f"boot={(self.t - PROCESS_STARTED) * 1000:.0f}ms"]
+
+    def lap(self, name: str) -> None:
+        now = time.monotonic()
+        self.laps.append(f"{name}={(now - self.t) * 1000:.0f}ms")
+        self.t = now
+
+    def summary(self) -> str:
+        return " ".join(self.laps) + f" total={(self.t - PROCESS_STARTED) * 1000:.0f}ms"
+
+async def on_startup(app: Application) -> None:
+    global _LLM_SLOTS
+    clock = _StartupClock()
+    start_loop_watchdog(app)
+    _LLM_SLOTS = asyncio.Semaphore(LLM_MAX_INFLIGHT)
+    await init_http_clients(app)
+    if WARM_RESTART:
+        await prewarm_http_clients()
+    clock.lap("http")
+    await start_metrics(app)
+    await open_state(app)
+    clock.lap("state")
+    start_catalog_watch(app)
+    if BOT_MODE == "webhook":
+        if not WARM_RESTART or STATE is None:
+            app.bot_data["started_at"] = datetime.now(timezone.utc)
+    else:
+        await delete_webhook(app)
+        clock.lap("webhook")
+        if WARM_RESTART:
+            await resume_offset()
+            clock.lap("offset")
+    log.info("Startup: %s", clock.summary())
+
+async def on_shutdown(app: Application) -> None:
+    stop_loop_watchdog(app)
+    stop_catalog_watch(app)
+    await drain_bursts()
+    await close_state(app)
+    await stop_metrics(app)
+    await close_http_clients(app)
+
+# ---------- КОМАНДЫ ----------
+async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    ctx.user_data[STARTED_KEY] = True
+
+    if FORCE_RESELECT_ON_START:
+        for key in (STORY_KEY, CHAR_KEY, LANG_KEY):
+            ctx.user_data.pop(key, None)
+
+    reset_setup(ctx)
+
+    if not ctx.user_data.get(STORY_KEY):
+        await update.message.reply_text("Выбери историю:", reply_markup=choose_story_kb(ctx.user_data.get(LANG_KEY, "ru")))
+        return
+
+    if not ctx.user_data.get(CHAR_KEY):
+        story = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
+        await update.message.reply_text("Теперь выбери персонажа:",
+                                        reply_markup=choose_char_kb(story, ctx.user_data.get(LANG_KEY, "ru")))
+        return
+
+    if not ctx.user_data.get(LANG_KEY):
+        await update.message.reply_text("Выбери язык:", reply_markup=choose_lang_kb())
+        return
+
+    title = CATALOG.title(ctx.user_data[STORY_KEY], ctx.user_data[LANG_KEY])
+    await update.message.reply_text(
+        f"История: {title}\n"
+        f"Персонаж: {ctx.user_data[CHAR_KEY].title()}, язык: {ctx.user_data[LANG_KEY].upper()}.\n"
+        f"Нажми «Меню» для смены настроек.",
+        reply_markup=main_menu_kb()
+    )
+
+async def cmd_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("Меню:", reply_markup=main_menu_kb())
+
+async def cmd_story(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    cur = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
+    meta = CATALOG.story(cur)
+    await update.message.reply_text(f"Текущая история: {meta['title_ru']} / {meta['title_en']}")
+
+async def cmd_char(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    cur = ctx.user_data.get(CHAR_KEY, "не выбран")
+    await update.message.reply_text(f"Текущий персонаж: {cur}")
+
+async def cmd_lang(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    cur = ctx.user_data.get(LANG_KEY, "не выбран")
+    await update.message.reply_text(f"Текущий язык: {cur}. Сменить?", reply_markup=choose_lang_kb())
+
+async def cmd_reset(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    ctx.user_data.clear()
+    reset_setup(ctx)
+    await update.message.reply_text("Сброс настроек. Выбери историю:", reply_markup=choose_story_kb())
+
+# ---------- CALLBACKS ----------
+def _is_stale_callback(update: Update, app: Application) -> bool:
+    started_at = app.bot_data.get("started_at")
+    msg = update.callback_query.message
+    if not (started_at and msg and msg.date):
+        return False
+    return msg.date.replace(tzinfo=timezone.utc) < started_at
+
+async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    await q.answer()
+
+    if _is_stale_callback(update, ctx.application):
+        log.info("Ignore stale callback: %s", q.data)
+        return
+
+    parts = (q.data or "").split("|", 1)
+    tag = parts[0]
+    val = parts[1] if len(parts) > 1 else None
+
+    # листание длинных списков историй/персонажей
+    if tag in ("spage", "cpage") and val:
+        sid, _, page = val.rpartition("|")
+        lang = ctx.user_data.get(LANG_KEY, "ru")
+        kb = choose_story_kb(lang, int(page)) if tag == "spage" else choose_char_kb(sid, lang, int(page))
+        try:
+            await q.edit_message_reply_markup(reply_markup=kb)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        return
+
+    if tag == "story" and val:
+        ctx.user_data[STORY_KEY] = val
+        ctx.user_data.pop(CHAR_KEY, None)
+        reset_setup(ctx)
+        await q.edit_message_text("История выбрана. Теперь выбери персонажа:",
+                                  reply_markup=choose_char_kb(val, ctx.user_data.get(LANG_KEY, "ru")))
+        return
+
+    if tag == "char" and val:
+        ctx.user_data[CHAR_KEY] = val
+        ctx.user_data.pop(LANG_KEY, None)
+        reset_setup(ctx)
+        await q.edit_message_text("Персонаж выбран. Теперь выбери язык:",
+                                  reply_markup=choose_lang_kb())
+        return
+
+    if tag == "lang" and val:
+        ctx.user_data[LANG_KEY] = val
+        ctx.user_data[AWAIT_SETUP] = False
+        ctx.user_data[LANG_MISMATCH_STREAK] = 0
+        await q.edit_message_text(
+            f"Язык установлен: {val.upper()}. Можно писать сообщения!",
+            reply_markup=main_menu_kb()
+        )
+        return
+
+    if tag == "menu" and val == "change_story":
+        reset_setup(ctx)
+        await q.edit_message_text("Выбери историю:", reply_markup=choose_story_kb(ctx.user_data.get(LANG_KEY, "ru")))
+        return
+
+    if tag == "menu" and val == "change_char":
+        reset_setup(ctx)
+        story = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
+        await q.edit_message_text("Выбери персонажа:", reply_markup=choose_char_kb(story, ctx.user_data.get(LANG_KEY, "ru")))
+        return
+
+    if tag == "menu" and val == "change_lang":
+        reset_setup(ctx)
+        await q.edit_message_text("Выбери язык:", reply_markup=choose_lang_kb())
+        return
+
+# ---------- ТЕКСТ ----------
+async def on_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.message or not update.message.text:
+        return
+
+    # Последовательность выбора
+    if need_setup(ctx):
+        if not ctx.user_data.get(STORY_KEY):
+            await update.message.reply_text("Сначала выбери историю:", reply_markup=choose_story_kb())
+        elif not ctx.user_data.get(CHAR_KEY):
+            story = ctx.user_data.get(STORY_KEY, DEFAULT_STORY)
+            await update.message.reply_text("Теперь выбери персонажа:", reply_markup=choose_char_kb(story))
+        elif not ctx.user_data.get(LANG_KEY):
+            await update.message.reply_text("Теперь выбери язык:", reply_markup=choose_lang_kb())
+        else:
+            await update.message.reply_text("Нажми кнопки настройки выше, затем продолжим.")
+        return
+
+    char = ctx.user_data.get(CHAR_KEY)
+    lang = ctx.user_data.get(LANG_KEY)
+    user_text = update.message.text.strip()
+
+    # Контроль языка пользователя
+    in_lang = detect_lang(user_text)
+    if in_lang and in_lang != lang:
+        streak = int(ctx.user_data.get(LANG_MISMATCH_STREAK, 0)) + 1
+        ctx.user_data[LANG_MISMATCH_STREAK] = streak
+
+        M_LANG_REMINDERS.inc(*_metric_labels(ctx))
+        reminder = get_lang_reminder(lang)
+        if streak >= LANG_SWITCH_THRESHOLD:
+            await update.message.reply_text(reminder, reply_markup=choose_lang_kb())
+        else:
+            await update.message.reply_text(reminder)
+        return
+    else:
+        if ctx.user_data.get(LANG_MISMATCH_STREAK):
+            ctx.user_data[LANG_MISMATCH_STREAK] = 0
+
+    if BURST_WINDOW > 0:
+        submit_burst(update, ctx, char, lang, user_text)
+        return
+    await run_turn(update, ctx, char, lang, user_text)
+
+async def run_turn(update: Update, ctx: ContextTypes.DEFAULT_TYPE, char: str, lang: str, user_text: str,
+                   on_reply=None, hist: DialogHistory | None = None) -> None:
+    """
+    Один ход диалога в рамках одного бюджета времени TURN_DEADLINE.
+    on_reply() вызывается, когда ответ готов и уходит пользователю (ход больше не отменяем).
+    hist — история, к которой относится текст; если её уже сменили, ход ничего не пишет.
+    """
+    deadline = Deadline(TURN_DEADLINE)
+    story, _ = labels = _metric_labels(ctx)
+    try:
+        await _run_turn(update, ctx, char, lang, user_text, deadline, on_reply, hist)
+    except DeadlineExceeded as e:
+        log.warning("Turn deadline exceeded at %s", e, extra={"stage": str(e)})
+        M_ERRORS.inc("deadline")
+        await update.message.reply_text("Не успел ответить вовремя 😔 Напиши ещё раз, пожалуйста.")
+    finally:
+        log.info("Turn budget: %s", deadline.summary(), extra={"latency": f"{time.monotonic() - deadline.started:.2f}s"})
+        for stage, seconds in deadline.spent.items():
+            M_STAGE.observe(seconds, stage, *labels)
+        M_STAGE.observe(time.monotonic() - deadline.started, "turn", *labels)
+
+async def _run_turn(update: Update, ctx: ContextTypes.DEFAULT_TYPE, char: str, lang: str, user_text: str,
+                    deadline: Deadline, on_reply=None, hist: DialogHistory | None = None) -> None:
+    # Кнопки меню идут мимо очереди чата и могут сбросить диалог посреди хода (а серия сообщений
+    # ждёт своего окна вне её) — тогда ни реплику, ни ответ в новую историю не пишем
+    if hist is None:
+        hist = _history(ctx)
+    elif not _owns_history(ctx, hist):
+        log.info("Dialog was reset before the turn started, message dropped")
+        return
+
+    cache_key = reply_cache_key(ctx, char, lang, user_text)
+    if cache_key is not None:
+        reply = REPLY_CACHE_STORE.get(cache_key)
+        M_REPLY_CACHE.inc("hit" if reply is not None else "miss", *_metric_labels(ctx))
+        if reply is not None:
+            await _send_cached_reply(update, ctx, user_text, reply, deadline, on_reply)
+            return
+
+    def rollback() -> None:
+        if _owns_history(ctx, hist):
+            _pop_history(ctx, "user", user_text)
+
+    # Общий лимит одновременных запросов к LLM
+    t0 = time.monotonic()
+    try:
+        await acquire_llm_slot(min(LLM_QUEUE_TIMEOUT, deadline.remaining()))
+    except LLMBusy:
+        log.warning("LLM busy: no free slot in %.0fs", LLM_QUEUE_TIMEOUT)
+        M_ERRORS.inc("llm_busy")
+        await update.message.reply_text("Сейчас очень много сообщений — напиши чуть позже 🙏")
+        return
+    finally:
+        deadline.add("queue", time.monotonic() - t0)
+
+    try:
+        if not _owns_history(ctx, hist):
+            return  # диалог сбросили, пока ждали слот
+        # Память: добавляем реплику пользователя (при отмене хода — откатываем)
+        _push_history(ctx, "user", user_text)
+
+        # Индикатор «печатает»
+        await send_action_safe(update, ChatAction.TYPING)
+
+        # Генерация ответа
+        streamer = None
+        try:
+            if STREAM_REPLIES:
+                reply, streamer = await stream_reply(update, ctx, char, lang, user_text, temperature=0.6, deadline=deadline)
+            elif CANDIDATES > 1:
+                reply = await generate_candidates(char, lang, user_text, ctx, deadline=deadline)
+            else:
+                reply = await call_openrouter(char, lang, user_text, ctx, temperature=0.6, deadline=deadline)
+        except DeadlineExceeded:
+            raise
+        except httpx.HTTPStatusError as e:
+            log.exception("OpenRouter HTTP error")
+            M_ERRORS.inc("llm_http")
+            rollback()  # ответа не было — реплику в память не берём
+            await update.message.reply_text(f"LLM HTTP {e.response.status_code}: {e.response.reason_phrase}")
+            return
+        except Exception as e:
+            log.exception("OpenRouter error")
+            M_ERRORS.inc("llm")
+            rollback()
+            await update.message.reply_text(f"LLM ошибка: {e}")
+            return
+
+        # Если ответ мусорный — 2-я попытка, если в бюджете ещё есть время
+        # (в режиме кандидатов запасные ответы уже были получены параллельно)
+        if looks_bad(reply) and (STREAM_REPLIES or CANDIDATES <= 1) and deadline.remaining() >= RETRY_MIN_BUDGET:
+            log.warning("Bad reply detected, retrying with temperature=0.4")
+            M_BAD_RETRIES.inc(*_metric_labels(ctx))
+            await send_action_safe(update, ChatAction.TYPING)
+            deadline.phase = "retry"
+            try:
+                reply = await call_openrouter(char, lang, user_text, ctx, temperature=0.4, deadline=deadline)
+            except Exception:
+                pass
+    except (asyncio.CancelledError, DeadlineExceeded):
+        rollback()
+        raise
+    finally:
+        release_llm_slot()
+
+    if not _owns_history(ctx, hist):
+        log.info("Dialog was reset during the turn, reply dropped")
+        if streamer is not None:
+            await streamer.discard()
+        return
+
+    if looks_bad(reply):
+        reply = "Давай попробуем ещё раз — сформулируй мысль чуть точнее."
+    elif cache_key is not None and _good_candidate(reply) and REPLY_CACHE_STORE.add(cache_key, reply):
+        M_REPLY_CACHE.inc("fill", *_metric_labels(ctx))
+
+    if on_reply is not None:
+        on_reply()
+    labels = _metric_labels(ctx)
+    M_TURNS.inc(*labels)
+    # пользовательская реплика уже в истории, так что сумма истории ≈ размер промпта
+    M_TOKENS.inc("prompt", *labels, value=_history(ctx).total)
+    M_TOKENS.inc("completion", *labels, value=_estimate_tokens(reply))
+    _push_history(ctx, "assistant", reply)
+    deadline.phase = ""
+    t0 = time.monotonic()
+    if streamer is not None:
+        await streamer.finish(reply)
+    else:
+        await update.message.reply_text(reply)
+    deadline.add("send", time.monotonic() - t0)
+
+    if update.effective_user:
+        schedule_summary(update.effective_user.id, ctx.user_data)
+
+async def _send_cached_reply(update: Update, ctx: ContextTypes.DEFAULT_TYPE, user_text: str, reply: str,
+                             deadline: Deadline, on_reply=None) -> None:
+    """Ответ из кэша: без слота LLM, ретраев и стриминга."""
+    if on_reply is not None:
+        on_reply()
+    _push_history(ctx, "user", user_text)
+    _push_history(ctx, "assistant", reply)
+    M_TURNS.inc(*_metric_labels(ctx))
+    t0 = time.monotonic()
+    await update.message.reply_text(reply)
+    deadline.add("send", time.monotonic() - t0)
+
+# ---------- ОШИБКИ ----------
+async def on_error(update: object, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    if isinstance(ctx.error, Conflict):
+        log.warning("409 Conflict. Waiting…")
+        return
+    log.exception("Unhandled error", exc_info=ctx.error)
+    M_ERRORS.inc("unhandled")
+    try:
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text("Ошибка 🛠️")
+    except Exception:
+        pass
+
+# ---------- APP ----------
+def build_app(with_updater: bool = True) -> Application:
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE)
+        .concurrent_updates(ChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if OUTBOX is not None:
+        builder = builder.rate_limiter(OUTBOX)
+    if not with_updater:
+        builder = builder.updater(None)  # апдейты приносит приёмник вебхука или WarmPoller
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, load_user_state), group=-1)
+    app.add_handler(CommandHandler("start", cmd_start))
+    app.add_handler(CommandHandler("menu", cmd_menu))
+    app.add_handler(CommandHandler("story", cmd_story))
+    app.add_handler(CommandHandler("char", cmd_char))
+    app.add_handler(CommandHandler("lang", cmd_lang))
+    app.add_handler(CommandHandler("reset", cmd_reset))
+    app.add_handler(CallbackQueryHandler(on_callback))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    app.add_handler(TypeHandler(Update, mark_user_state), group=1)
+    app.add_error_handler(on_error)
+    return app
+
+# ---------- МИНИ-HTTP-СЕРВЕР ----------
+# Без внешних зависимостей: HTTP/1.1 с keep-alive, тело только по Content-Length.
+# handler(method, path, headers, body) -> (status, content_type, payload)
+# authorize(method, path, headers) -> None или такой же ответ; зовётся до чтения тела.
+HTTP_MAX_BODY = 1 << 20  # апдейт Telegram — единицы килобайт
+
+def _http_response(status: int, ctype: str, payload: bytes, keep: bool) -> bytes:
+    return (
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+        f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n"
+        f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n".encode("latin-1") + payload
+    )
+
+async def _serve_http_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handler,
+                           authorize=None, max_body: int = HTTP_MAX_BODY) -> None:
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            method, target, version = line.decode("latin-1").strip().split(" ", 2)
+            headers = {}
+            while True:
+                h = await reader.readline()
+                if h in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = h.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+            length = int(headers.get("content-length") or 0)
+            if length < 0:
+                raise ValueError("negative Content-Length")
+            # отказ до чтения тела: непрочитанное тело не даёт продолжить keep-alive
+            rejected = (413, "text/plain", b"too large") if length > max_body else None
+            if rejected is None and authorize is not None:
+                rejected = authorize(method, target, headers)
+            if rejected is not None:
+                writer.write(_http_response(*rejected, keep=False))
+                await writer.drain()
+                break
+            body = await reader.readexactly(length) if length else b""
+            try:
+                status, ctype, payload = await handler(method, target, headers, body)
+            except Exception:
+                log.exception("HTTP handler failed: %s %s", method, target)
+                status, ctype, payload = 500, "text/plain", b"error"
+            keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            writer.write(_http_response(status, ctype, payload, keep))
+            await writer.drain()
+            if not keep:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    except asyncio.CancelledError:
+        pass  # остановка сервера: простаивающие keep-alive соединения просто закрываем
+    finally:
+        writer.close()
+
+async def serve_http(host: str, port: int, handler, authorize=None) -> asyncio.base_events.Server:
+    return await asyncio.start_server(lambda r, w: _serve_http_conn(r, w, handler, authorize), host, port)
+
+# ---------- WEBHOOK-РЕЖИМ ----------
+# Процесс-приёмник принимает вебхук Telegram и раздаёт апдейты N воркерам по хешу chat_id
+# (консистентное кольцо): порядок апдейтов чата и его user_data всегда на одном воркере.
+# Каждый воркер — обычное PTB-приложение без Updater со своим циклом событий.
+def _hash64(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+class HashRing:
+    def __init__(self, nodes: int, replicas: int = 64):
+        points = sorted((_hash64(f"{node}:{r}"), node) for node in range(nodes) for r in range(replicas))
+        self._keys = [p for p, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def node(self, key: int | str) -> int:
+        i = bisect.bisect(self._keys, _hash64(str(key)))
+        return self._nodes[i % len(self._nodes)]
+
+def _update_route_key(data: dict) -> int:
+    """chat_id апдейта (в личке совпадает с user_id); иначе — отправитель."""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        chat = (data.get(field) or {}).get("chat")
+        if chat:
+            return chat["id"]
+    cq = data.get("callback_query")
+    if cq:
+        chat = (cq.get("message") or {}).get("chat")
+        return chat["id"] if chat else cq["from"]["id"]
+    for value in data.values():
+        if isinstance(value, dict):
+            if isinstance(value.get("chat"), dict):
+                return value["chat"]["id"]
+            if isinstance(value.get("from"), dict):
+                return value["from"]["id"]
+    return int(data.get("update_id", 0))
+
+async def _worker_main(index: int, queue) -> None:
+    global _WORKER_INDEX
+    _WORKER_INDEX = index
+    if OUTBOX is not None:
+        # чат всегда попадает в один воркер, так что делить нужно только общий лимит
+        OUTBOX.share_global(WEBHOOK_WORKERS)
+    app = build_app(with_updater=False)
+    loop = asyncio.get_running_loop()
+    async with app:
+        # без Updater'а run_* не вызываются, поэтому post_init/post_shutdown зовём сами
+        await app.post_init(app)
+        await app.start()
+        log.info("Webhook worker %d ready (pid %d)", index, os.getpid())
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            try:
+                await app.update_queue.put(Update.de_json(json.loads(raw), app.bot))
+            except Exception as e:
+                log.warning("Worker %d: bad update dropped: %s", index, e)
+        await app.stop()
+    await app.post_shutdown(app)
+
+def _webhook_worker(index: int, queue) -> None:
+    try:
+        asyncio.run(_worker_main(index, queue))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logging()
+
+async def _run_ingress() -> None:
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue() for _ in range(WEBHOOK_WORKERS)]
+    workers: list = [None] * WEBHOOK_WORKERS
+    ring = HashRing(WEBHOOK_WORKERS)
+    routed = [0] * WEBHOOK_WORKERS
+
+    def spawn(i: int) -> None:
+        proc = mp.Process(target=_webhook_worker, args=(i, queues[i]), name=f"pixorbi-worker-{i}", daemon=True)
+        proc.start()
+        workers[i] = proc
+
+    for i in range(WEBHOOK_WORKERS):
+        spawn(i)
+
+    async def handle(method: str, path: str, headers: dict, body: bytes):
+        if method == "GET" and path == "/healthz":
+            alive = sum(1 for p in workers if p is not None and p.is_alive())
+            return 200, "application/json", json.dumps({"workers": alive, "routed": routed}).encode()
+        if method != "POST" or path != WEBHOOK_PATH:
+            return 404, "text/plain", b"not found"
+        try:
+            data = json.loads(body)
+            i = ring.node(_update_route_key(data))
+        except Exception:
+            return 400, "text/plain", b"bad update"
+        queues[i].put(body)
+        routed[i] += 1
+        return 200, "text/plain", b"ok"
+
+    def authorize(method: str, path: str, headers: dict):
+        # чужой апдейт отбиваем по заголовку, не читая тело; /healthz открыт
+        if path == WEBHOOK_PATH and WEBHOOK_SECRET and headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403, "text/plain", b"forbidden"
+        return None
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    server = await serve_http(WEBHOOK_LISTEN, WEBHOOK_PORT, handle, authorize)
+    log.info("Webhook ingress on %s:%d%s → %d workers", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_WORKERS)
+
+    if WEBHOOK_URL:
+        async with Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_BASE) as tg:
+            await tg.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=not WARM_RESTART,
+            )
+        log.info("Webhook set: %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+            for i, proc in enumerate(workers):
+                if not stop.is_set() and not proc.is_alive():
+                    log.warning("Worker %d exited (code %s), restarting", i, proc.exitcode)
+                    spawn(i)
+    finally:
+        server.close()
+        await server.wait_closed()
+        for q in queues:
+            q.put(None)
+        for proc in workers:
+            await loop.run_in_executor(None, proc.join, 15)
+            if proc.is_alive():
+                proc.terminate()
+
+def run_webhook() -> None:
+    asyncio.run(_run_ingress())
+
+async def _run_warm_polling() -> None:
+    app = build_app(with_updater=False)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    async with app:
+        # без Updater'а run_* не вызываются, поэтому post_init/post_shutdown зовём сами
+        await app.post_init(app)
+        await app.start()
+        await WarmPoller(app).run(stop)
+        await app.stop()  # дожидается начатых апдейтов; offset сохранит post_shutdown
+    await app.post_shutdown(app)
+
+def run_polling() -> None:
+    if WARM_RESTART:
+        asyncio.run(_run_warm_polling())
+        return
+    app = build_app()
+    while True:
+        try:
+            app.run_polling(allowed_updates=Update.ALL_TYPES, poll_interval=POLL_INTERVAL)
+            break
+        except Conflict:
+            logging.getLogger("pixorbi-bot").warning("409 Conflict. Retry in 5s…")
+            time.sleep(5)
+
+if __name__ == "__main__":
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        run_polling()
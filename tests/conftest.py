@@ -0,0 +1,9 @@
+import os
+import sys
+
+# bot.py читает окружение при импорте
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:test")
+os.environ["STATE_DB"] = ""
+os.environ["LOG_QUEUE"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
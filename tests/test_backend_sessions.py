@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bench
+import bot
+
+
+def test_session_delta_and_ack():
+    hist = bot.DialogHistory()
+    hist.append("user", "a")
+    part, mark = hist.session_delta()
+    assert part["session"]["base"] is None and len(part["history"]) == 1
+    assert hist.ack({"id": hist.session, "version": 1}, mark)
+
+    hist.append("assistant", "b")
+    hist.append("user", "c")
+    part, mark = hist.session_delta()
+    assert part["session"] == {"id": hist.session, "base": 1, "version": 3, "drop": 0}
+    assert [m["content"] for m in part["history"]] == ["b", "c"]
+    assert hist.ack({"id": hist.session, "version": 3}, mark)
+
+    hist.append("assistant", "d")
+    hist.append("user", "e")
+    hist.popleft()
+    hist.popleft()
+    part, mark = hist.session_delta()
+    assert part["session"]["drop"] == 2 and [m["content"] for m in part["history"]] == ["d", "e"]
+
+    assert hist.ack({"id": hist.session, "version": 5}, mark)
+    hist.pop()  # откат после подтверждения — бэкенд помнит уже другое
+    assert hist.acked is None
+    hist.append("user", "E")
+    part, mark = hist.session_delta()
+    assert part["session"]["base"] is None
+    assert not hist.ack({"id": "other", "version": 5}, mark)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    llm = bench.FakeLLM(0, 0, 0, 0, 0, 0)
+    port = bench._free_port()
+    monkeypatch.setattr(bot, "RUNPOD_HTTP", f"http://127.0.0.1:{port}/chat")
+    monkeypatch.setattr(bot, "RUNPOD_SESSIONS", True)
+    monkeypatch.setattr(bot, "RUNPOD_BATCHER", None)
+    monkeypatch.setattr(bot, "BREAKERS", {
+        name: bot.CircuitBreaker(name, bot.BREAKER_FAILURES, bot.BREAKER_OPEN_SECONDS) for name in bot.BREAKERS
+    })
+    llm.port = port
+    return llm
+
+
+def test_backend_gets_deltas_and_recovers_from_miss(backend):
+    ctx = SimpleNamespace(user_data={})
+
+    async def turn(text):
+        bot._push_history(ctx, "user", text)
+        reply = await bot._call_runpod("c", "ru", text, ctx)
+        bot._push_history(ctx, "assistant", reply)
+
+    async def main():
+        server = await bench.serve("127.0.0.1", backend.port, backend.handle)
+        try:
+            await turn("раз")
+            await turn("два")
+            assert backend.stats["session_delta"] == 1
+            backend.sessions.clear()  # бэкенд перезапустился и забыл сессию
+            await turn("три")
+            await turn("четыре")
+        finally:
+            await bot.close_http_clients(SimpleNamespace(bot_data={}))
+            server.close()
+
+    asyncio.run(main())
+    assert backend.stats["session_miss"] == 1
+    assert backend.stats["chat"] == 5  # четыре хода + один повтор с полной историей
+    assert backend.stats["session_delta"] == 2
+    assert len(bot._history(ctx)) == 8
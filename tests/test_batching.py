@@ -0,0 +1,114 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import pytest
+
+import bench
+import bot
+
+
+class FakeBackend:
+    """/chat_batch с ошибкой для сообщений "bad ..." и OpenRouter-совместимый fallback."""
+
+    def __init__(self):
+        self.batches = []
+        self.single = []
+        self.openrouter = []
+
+    async def handle(self, method, target, headers, body):
+        path = urlsplit(target).path
+        data = json.loads(body or b"{}")
+        if path.endswith("/chat_batch"):
+            items = data["items"]
+            self.batches.append([it["message"] for it in items])
+            await asyncio.sleep(0.01)
+            if any(it["message"].startswith("boom") for it in items):
+                return bench._json(500, {"error": "backend down"})
+            return bench._json(200, {"results": [
+                {"error": "backend error"} if it["message"].startswith("bad") else {"reply": f"batch {it['message']}"}
+                for it in items
+            ]})
+        if path.endswith("/chat"):
+            self.single.append(data["message"])
+            return bench._json(200, {"reply": f"single {data['message']}"})
+        if path.endswith("/chat/completions"):
+            text = data["messages"][-1]["content"]
+            self.openrouter.append(text)
+            return bench._json(200, {"choices": [{"message": {"role": "assistant", "content": f"fallback {text}"}}]})
+        return bench._json(404, {"error": "not found"})
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    fake = FakeBackend()
+    port = bench._free_port()
+    base = f"http://127.0.0.1:{port}"
+    monkeypatch.setattr(bot, "RUNPOD_HTTP", base + "/chat")
+    monkeypatch.setattr(bot, "RUNPOD_BATCHER", bot.RunpodBatcher(base + "/chat", base + "/chat_batch", 8, 0.05))
+    monkeypatch.setattr(bot, "OPENROUTER_URL", base + "/v1/chat/completions")
+    monkeypatch.setattr(bot, "OPENROUTER_API_KEY", "test")
+    monkeypatch.setattr(bot, "HEDGE_ENABLED", False)
+    monkeypatch.setattr(bot, "RUNPOD_SESSIONS", False)
+    monkeypatch.setattr(bot, "BREAKERS", {
+        name: bot.CircuitBreaker(name, bot.BREAKER_FAILURES, bot.BREAKER_OPEN_SECONDS) for name in bot.BREAKERS
+    })
+    fake.port = port
+    return fake
+
+
+def _run(fake, coro_factory):
+    async def main():
+        server = await bench.serve("127.0.0.1", fake.port, fake.handle)
+        try:
+            return await coro_factory()
+        finally:
+            await bot.close_http_clients(SimpleNamespace(bot_data={}))
+            server.close()
+
+    return asyncio.run(main())
+
+
+def test_concurrent_turns_share_one_batch(backend):
+    texts = [f"hi {i}" for i in range(5)]
+
+    async def turns():
+        return await asyncio.gather(*(
+            bot.call_openrouter("c", "en", t, SimpleNamespace(user_data={})) for t in texts
+        ))
+
+    replies = _run(backend, turns)
+    assert replies == [f"batch {t}" for t in texts]
+    assert backend.batches == [texts]
+    assert backend.single == [] and backend.openrouter == []
+    assert bot.RUNPOD_BATCHER.stats["batches"] == 1
+
+
+def test_failed_item_falls_back_alone(backend):
+    texts = ["hi 0", "bad 1", "hi 2"]
+
+    async def turns():
+        return await asyncio.gather(*(
+            bot.call_openrouter("c", "en", t, SimpleNamespace(user_data={})) for t in texts
+        ))
+
+    replies = _run(backend, turns)
+    assert replies == ["batch hi 0", "fallback bad 1", "batch hi 2"]
+    assert backend.batches == [texts]
+    assert backend.openrouter == ["bad 1"]
+
+
+def test_whole_batch_failure_counts_once(backend):
+    texts = [f"boom {i}" for i in range(6)]
+
+    async def turns():
+        return await asyncio.gather(*(
+            bot.call_openrouter("c", "en", t, SimpleNamespace(user_data={})) for t in texts
+        ))
+
+    replies = _run(backend, turns)
+    breaker = bot.BREAKERS[bot.UPSTREAM_RUNPOD]
+    assert replies == [f"fallback {t}" for t in texts]
+    assert len(texts) >= bot.BREAKER_FAILURES
+    assert breaker.counters["failure"] == 1 and breaker.state == breaker.CLOSED
@@ -0,0 +1,179 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import bot
+
+
+class FakeState:
+    def __init__(self):
+        self.dirty = set()
+
+    def mark_dirty(self, user_id):
+        self.dirty.add(user_id)
+
+    def touch(self, user_id):
+        pass
+
+
+def _update(update_id, chat_id=7, replies=None):
+    async def reply_text(text, **kw):
+        if replies is not None:
+            replies.append(text)
+
+    return SimpleNamespace(
+        update_id=update_id,
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id),
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+
+
+@pytest.fixture
+def bursts(monkeypatch):
+    monkeypatch.setattr(bot, "BURST_WINDOW", 0.0)
+    monkeypatch.setattr(bot, "STATE", FakeState())
+    monkeypatch.setattr(bot, "UPDATES", bot.UpdateWatermark())
+    bot._BURSTS.clear()
+    yield
+    bot._BURSTS.clear()
+
+
+def _ctx():
+    app = SimpleNamespace(create_task=lambda coro, **kw: asyncio.get_running_loop().create_task(coro))
+    return SimpleNamespace(user_data={}, application=app)
+
+
+async def _drain():
+    while bot._BURSTS:
+        await asyncio.sleep(0.01)
+
+
+def test_failed_turn_drops_texts_and_releases_watermark(bursts, monkeypatch):
+    calls = []
+
+    async def run_turn(update, ctx, char, lang, text, on_reply=None, hist=None):
+        calls.append(text)  # LLM занят / ошибка: ответа нет, on_reply не зовётся
+
+    monkeypatch.setattr(bot, "run_turn", run_turn)
+
+    async def main():
+        ctx = _ctx()
+        bot.submit_burst(_update(10), ctx, "c", "en", "hi")
+        assert bot.UPDATES.value < 10  # ответа ещё нет — offset стоит
+        await asyncio.wait_for(_drain(), 2)
+        bot.submit_burst(_update(11), ctx, "c", "en", "again")
+        await asyncio.wait_for(_drain(), 2)
+
+    asyncio.run(main())
+    assert calls == ["hi", "again"]
+    assert bot.UPDATES.value == 11
+    assert bot.STATE.dirty == {7}
+
+
+def test_restart_merges_and_holds_watermark(bursts, monkeypatch):
+    calls = []
+
+    async def main():
+        started = asyncio.Event()
+
+        async def run_turn(update, ctx, char, lang, text, on_reply=None, hist=None):
+            calls.append(text)
+            if len(calls) == 1:
+                started.set()
+                await asyncio.sleep(10)  # отменится вторым сообщением
+            on_reply()
+
+        monkeypatch.setattr(bot, "run_turn", run_turn)
+        ctx = _ctx()
+        bot.UPDATES.begin(20)  # так апдейт ведёт процессор
+        bot.submit_burst(_update(20), ctx, "c", "en", "one")
+        bot.UPDATES.done(20)
+        await asyncio.wait_for(started.wait(), 2)
+        assert bot.UPDATES.value < 20
+        bot.submit_burst(_update(21), ctx, "c", "en", "two")
+        await asyncio.wait_for(_drain(), 2)
+
+    asyncio.run(main())
+    assert calls == ["one", "one\ntwo"]
+    assert bot.UPDATES.value == 21
+
+
+def test_reset_drops_buffered_messages(bursts, monkeypatch):
+    monkeypatch.setattr(bot, "BURST_WINDOW", 0.2)
+    calls = []
+
+    async def run_turn(update, ctx, char, lang, text, on_reply=None, hist=None):
+        calls.append((text, hist is bot._history(ctx)))
+
+    monkeypatch.setattr(bot, "run_turn", run_turn)
+
+    async def main():
+        ctx = _ctx()
+        bot.submit_burst(_update(30), ctx, "c", "en", "old")
+        bot.reset_setup(ctx)  # /reset, пока серия ждёт окна
+        bot.submit_burst(_update(31), ctx, "c", "en", "new")
+        await asyncio.wait_for(_drain(), 2)
+
+    asyncio.run(main())
+    assert calls == [("new", True)]
+    assert bot.UPDATES.value == 31
+
+
+def test_turn_for_replaced_history_writes_nothing(monkeypatch):
+    async def never(*a, **kw):
+        raise AssertionError("LLM must not be called")
+
+    monkeypatch.setattr(bot, "call_openrouter", never)
+    monkeypatch.setattr(bot, "STREAM_REPLIES", False)
+    monkeypatch.setattr(bot, "_LLM_SLOTS", None)
+    replies = []
+    ctx = SimpleNamespace(user_data={})
+    old = bot._history(ctx)
+    bot.reset_setup(ctx)
+
+    asyncio.run(bot.run_turn(_update(1, replies=replies), ctx, "c", "en", "hello", hist=old))
+    assert bot._history(ctx).as_messages() == [] and old.as_messages() == []
+    assert replies == []
+
+
+def test_shutdown_flushes_pending_burst(bursts, monkeypatch):
+    monkeypatch.setattr(bot, "BURST_WINDOW", 30.0)
+    calls = []
+
+    async def run_turn(update, ctx, char, lang, text, on_reply=None, hist=None):
+        calls.append(text)
+        on_reply()
+
+    monkeypatch.setattr(bot, "run_turn", run_turn)
+
+    async def main():
+        bot.submit_burst(_update(40), _ctx(), "c", "en", "bye")
+        await asyncio.sleep(0)
+        await asyncio.wait_for(bot.drain_bursts(), 2)
+
+    asyncio.run(main())
+    assert calls == ["bye"]
+    assert bot.UPDATES.value == 40 and not bot._BURSTS
+
+
+def test_llm_error_rolls_back_user_turn(monkeypatch):
+    async def failing(*a, **kw):
+        raise httpx.ConnectError("down")
+
+    async def no_action(*a, **kw):
+        pass
+
+    monkeypatch.setattr(bot, "call_openrouter", failing)
+    monkeypatch.setattr(bot, "send_action_safe", no_action)
+    monkeypatch.setattr(bot, "STREAM_REPLIES", False)
+    monkeypatch.setattr(bot, "CANDIDATES", 1)
+    monkeypatch.setattr(bot, "_LLM_SLOTS", None)
+    replies = []
+    ctx = SimpleNamespace(user_data={})
+
+    asyncio.run(bot.run_turn(_update(1, replies=replies), ctx, "c", "en", "hello"))
+    assert len(bot._history(ctx)) == 0
+    assert replies and replies[0].startswith("LLM")
@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+def test_extra_candidates_take_their_own_slots(monkeypatch):
+    temps = []
+
+    async def generate(char, lang, text, ctx, temperature=0.6, deadline=None):
+        temps.append(temperature)
+        await asyncio.sleep(0.05 if temperature == 0.6 else 0)
+        return "Ответ, который подходит." if temperature == 0.6 else "!!!!!!!!!!"
+
+    monkeypatch.setattr(bot, "call_openrouter", generate)
+    monkeypatch.setattr(bot, "CANDIDATES", 3)
+    monkeypatch.setattr(bot, "CANDIDATE_TEMPERATURES", [0.6, 0.4, 0.8])
+    monkeypatch.setattr(bot, "LLM_MAX_INFLIGHT", 2)
+    monkeypatch.setattr(bot, "_LLM_SLOTS", None)
+    monkeypatch.setattr(bot, "CANDIDATE_STATS", dict.fromkeys(bot.CANDIDATE_STATS, 0))
+
+    async def main():
+        await bot.acquire_llm_slot(1.0)  # слот самого хода
+        reply = await bot.generate_candidates("c", "ru", "привет", SimpleNamespace(user_data={}))
+        await asyncio.sleep(0)
+        free = bot._LLM_SLOTS._value
+        bot.release_llm_slot()
+        return reply, free
+
+    reply, free = asyncio.run(main())
+    assert reply == "Ответ, который подходит."
+    assert temps == [0.6, 0.4]  # на третьего кандидата свободного слота не нашлось
+    assert bot.CANDIDATE_STATS["no_slot"] == 1
+    assert free == 1  # слот второго кандидата вернулся, занят только слот хода
+
+
+def test_runpod_payload_carries_temperature(monkeypatch):
+    sent = []
+
+    async def post(payload, deadline):
+        sent.append(payload)
+        return {"reply": "ok"}
+
+    monkeypatch.setattr(bot, "_post_runpod", post)
+    ctx = SimpleNamespace(user_data={})
+    for sessions in (False, True):
+        monkeypatch.setattr(bot, "RUNPOD_SESSIONS", sessions)
+        asyncio.run(bot._call_runpod("c", "ru", "привет", ctx, temperature=0.4))
+    assert [p["temperature"] for p in sent] == [0.4, 0.4]
+    assert "temperature" not in bot._runpod_payload("c", "ru", "привет", ctx)
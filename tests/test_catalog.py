@@ -0,0 +1,120 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+_stamps = itertools.count(1_700_000_000_000_000_000, 1_000_000_000)
+
+
+def _write(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(data if isinstance(data, str) else json.dumps(data, ensure_ascii=False))
+    stamp = next(_stamps)  # mtime гарантированно другой, даже если запись в ту же секунду
+    os.utime(path, ns=(stamp, stamp))
+
+
+def _characters(n, persona="Ты — {}."):
+    return {f"c{i}": {"ru": f"Персонаж {i}", "en": f"Character {i}",
+                      "persona_ru": persona.format(i), "persona_en": persona.format(i)} for i in range(n)}
+
+
+@pytest.fixture
+def stories(tmp_path, monkeypatch):
+    root = tmp_path / "stories"
+    root.mkdir()
+    index = {sid: {"title_ru": f"История {sid}", "title_en": f"Story {sid}"} for sid in ("hope", "other")}
+    _write(root / "index.json", {"stories": index})
+    _write(root / "hope.json", {"characters": _characters(2)})
+    _write(root / "other.json", {"characters": _characters(1, "Старая версия {}.")})
+    monkeypatch.setattr(bot, "CATALOG", bot.Catalog.load(str(root)))
+    return root
+
+
+def test_reload_swaps_snapshot(stories):
+    old = bot.CATALOG
+    assert "Старая версия" in old.prompt("other", "c0", "ru")
+    old.prompt("hope", "c0", "ru")
+    _write(stories / "other.json", {"characters": _characters(1, "Новая версия {}.")})
+
+    assert asyncio.run(bot.reload_catalog())
+    assert bot.CATALOG is not old
+    assert "Новая версия" in bot.CATALOG.prompt("other", "c0", "ru")
+    assert "Старая версия" in old.prompt("other", "c0", "ru")  # начатые ходы дорабатывают со старым снимком
+    assert bot.CATALOG._loaded["hope"] is old._loaded["hope"]  # неизменённая история не перечитывается
+
+
+def test_broken_story_file_keeps_previous_version(stories, caplog):
+    bot.CATALOG.prompt("other", "c0", "ru")
+    _write(stories / "other.json", "{ not json")
+
+    assert asyncio.run(bot.reload_catalog())
+    assert "Старая версия" in bot.CATALOG.prompt("other", "c0", "ru")
+    assert not bot.CATALOG.changed()  # до следующей правки файла снимок не пересобирается
+    caplog.clear()
+    assert not asyncio.run(bot.reload_catalog())
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_broken_index_keeps_catalog(stories, caplog):
+    current = bot.CATALOG
+    _write(stories / "index.json", "{ broken")
+
+    assert not asyncio.run(bot.reload_catalog())
+    assert bot.CATALOG is current and current.story_ids == ["hope", "other"]
+    caplog.clear()
+    assert not asyncio.run(bot.reload_catalog())  # тот же битый index.json повторно не читаем
+    assert not caplog.records
+
+
+def test_missing_story_file_fails_once_per_mtime(stories, caplog):
+    os.remove(stories / "other.json")
+    catalog = bot.Catalog.load(str(stories))
+    caplog.clear()
+    for _ in range(3):
+        assert "Персонаж 0" in catalog.prompt("other", "c0", "ru")  # откат на историю по умолчанию
+    assert len([r for r in caplog.records if r.levelno >= logging.ERROR]) == 1
+
+    _write(stories / "other.json", {"characters": _characters(1, "Вернулась {}.")})
+    assert "Вернулась" in catalog.prompt("other", "c0", "ru")
+
+
+def _callback(data, edits):
+    async def answer():
+        pass
+
+    async def edit_message_reply_markup(reply_markup=None):
+        edits.append(reply_markup)
+
+    query = SimpleNamespace(data=data, answer=answer, message=None,
+                            edit_message_reply_markup=edit_message_reply_markup)
+    return SimpleNamespace(callback_query=query)
+
+
+def _buttons(kb):
+    return [b.callback_data for row in kb.inline_keyboard for b in row]
+
+
+def test_page_callbacks(tmp_path, monkeypatch):
+    root = tmp_path / "stories"
+    root.mkdir()
+    index = {f"s{i}": {"title_ru": f"История {i}", "title_en": f"Story {i}"} for i in range(bot.KB_PAGE_SIZE + 2)}
+    _write(root / "index.json", {"stories": index})
+    _write(root / "s0.json", {"characters": _characters(bot.KB_PAGE_SIZE + 1)})
+    monkeypatch.setattr(bot, "CATALOG", bot.Catalog.load(str(root)))
+    ctx = SimpleNamespace(user_data={bot.LANG_KEY: "en"}, application=SimpleNamespace(bot_data={}))
+    edits = []
+
+    asyncio.run(bot.on_callback(_callback("spage|1", edits), ctx))
+    asyncio.run(bot.on_callback(_callback("cpage|s0|1", edits), ctx))
+
+    stories_page, chars_page = (_buttons(kb) for kb in edits)
+    last = bot.KB_PAGE_SIZE + 1
+    assert stories_page == [f"story|s{bot.KB_PAGE_SIZE}", f"story|s{last}", "spage|0", "noop"]
+    assert chars_page == [f"char|c{bot.KB_PAGE_SIZE}", "cpage|s0|0", "noop"]
+    assert edits[0].inline_keyboard[0][0].text == f"Story {bot.KB_PAGE_SIZE}"
@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update
+
+import bot
+
+
+def _update(update_id: int, chat_id: int = 5) -> Update:
+    chat = Chat(id=chat_id, type="private")
+    return Update(update_id, message=Message(update_id, datetime.now(timezone.utc), chat, text="hi"))
+
+
+def test_chat_updates_run_in_order_and_queue_wait_is_unlabeled(monkeypatch):
+    monkeypatch.setattr(bot, "UPDATES", bot.UpdateWatermark())
+    monkeypatch.setattr(bot, "M_CHAT_QUEUE", bot.Histogram("pixorbi_chat_queue_seconds", "test"))
+    monkeypatch.setattr(bot, "M_STAGE", bot.Histogram("pixorbi_stage_seconds", "test", ("stage", "story", "char")))
+    order = []
+
+    async def handle(n: int, delay: float):
+        order.append(("start", n))
+        await asyncio.sleep(delay)
+        order.append(("end", n))
+
+    async def main():
+        processor = bot.ChatUpdateProcessor(8)
+        await asyncio.gather(
+            processor.process_update(_update(1), handle(1, 0.05)),
+            processor.process_update(_update(2), handle(2, 0.0)),
+        )
+
+    asyncio.run(main())
+    assert order == [("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+    assert sum(bot.M_CHAT_QUEUE._series[()][0]) == 2
+    assert bot.M_STAGE._series == {}
+    assert bot.UPDATES.value == 2
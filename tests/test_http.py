@@ -0,0 +1,60 @@
+import asyncio
+
+import bot
+
+
+async def _serve(authorize=None):
+    seen = []
+
+    async def handler(method, path, headers, body):
+        seen.append(body)
+        return 200, "text/plain", b"ok"
+
+    server = await bot.serve_http("127.0.0.1", 0, handler, authorize)
+    return server, server.sockets[0].getsockname()[1], seen
+
+
+async def _raw(port, request: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), 2)  # сервер сам закрывает соединение
+    writer.close()
+    return response
+
+
+def test_oversized_body_rejected_before_read():
+    async def main():
+        server, port, seen = await _serve()
+        head = b"POST /hook HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (bot.HTTP_MAX_BODY + 1)
+        response = await _raw(port, head)  # тело так и не отправлено
+        server.close()
+        return response, seen
+
+    response, seen = asyncio.run(main())
+    assert response.startswith(b"HTTP/1.1 413 ")
+    assert seen == []
+
+
+def test_secret_checked_before_body():
+    def authorize(method, path, headers):
+        if headers.get("x-telegram-bot-api-secret-token") != "s3cret":
+            return 403, "text/plain", b"forbidden"
+        return None
+
+    async def main():
+        server, port, seen = await _serve(authorize)
+        denied = await _raw(port, b"POST /hook HTTP/1.1\r\nContent-Length: 1000\r\n\r\n")
+        body = b'{"update_id": 1}'
+        allowed = await _raw(
+            port,
+            b"POST /hook HTTP/1.1\r\nConnection: close\r\nX-Telegram-Bot-Api-Secret-Token: s3cret\r\n"
+            b"Content-Length: %d\r\n\r\n%s" % (len(body), body),
+        )
+        server.close()
+        return denied, allowed, seen
+
+    denied, allowed, seen = asyncio.run(main())
+    assert denied.startswith(b"HTTP/1.1 403 ")
+    assert allowed.startswith(b"HTTP/1.1 200 ")
+    assert seen == [b'{"update_id": 1}']
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+
+import bot
+
+
+def _error_record(n: int) -> logging.LogRecord:
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        exc_info = sys.exc_info()
+    return logging.LogRecord("pixorbi-bot", logging.ERROR, __file__, 1, "failed %d", (n,), exc_info)
+
+
+def test_repeated_tracebacks_are_sampled():
+    fields = bot._FieldsFilter(60.0)
+    records = [_error_record(n) for n in range(3)]
+    for record in records:
+        assert fields.filter(record)
+    assert records[0].exc_info is not None
+    for record in records[1:]:
+        assert record.exc_info is None
+        assert record.fields["exc"] == "ValueError: boom"
+
+
+def test_context_fields_reach_json_lines():
+    token = bot.log_fields(chat_id=5, update_id=9)
+    try:
+        record = logging.LogRecord("pixorbi-bot", logging.INFO, __file__, 1, "turn %s", ("ok",), None)
+        record.latency = "1.00s"
+        bot._FieldsFilter(0).filter(record)
+    finally:
+        bot._LOG_FIELDS.reset(token)
+    doc = json.loads(bot._Formatter(True).format(record))
+    assert doc["msg"] == "turn ok"
+    assert (doc["chat_id"], doc["update_id"], doc["latency"]) == (5, 9, "1.00s")
+    assert bot._Formatter(False).format(record).endswith("| chat_id=5 update_id=9 latency=1.00s")
+
+
+def test_watchdog_dumps_blocking_stack(caplog):
+    def busy_block():
+        time.sleep(0.5)
+
+    async def main():
+        watchdog = bot.LoopWatchdog(0.05, 0.2)
+        watchdog.start()
+        await asyncio.sleep(0.2)
+        busy_block()  # синхронный вызов держит цикл
+        await asyncio.sleep(0.2)
+        watchdog.stop()
+
+    with caplog.at_level(logging.WARNING, logger="pixorbi-bot"):
+        asyncio.run(main())
+    blocked = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Event loop blocked")]
+    assert blocked and "busy_block" in blocked[0]
+    assert any(r.getMessage().startswith("Event loop lagged") for r in caplog.records)
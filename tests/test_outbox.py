@@ -0,0 +1,66 @@
+import asyncio
+
+import bot
+
+
+def _scheduler(burst=1.0):
+    return bot.OutboundScheduler(0.01, burst, 0.01, burst, 1)
+
+
+def _recorder(calls):
+    async def send(name):
+        calls.append(name)
+        return name
+
+    return send
+
+
+async def _request(outbox, send, endpoint, chat=1):
+    return await asyncio.wait_for(
+        outbox.process_request(send, (endpoint,), {}, endpoint, {"chat_id": chat}, None), 2
+    )
+
+
+def test_initialize_is_idempotent():
+    async def main():
+        outbox = _scheduler()
+        await outbox.initialize()
+        task = outbox._task
+        await outbox.initialize()
+        assert outbox._task is task
+        await outbox.shutdown()
+
+    asyncio.run(main())
+
+
+def test_callback_answers_and_actions_skip_buckets():
+    calls = []
+
+    async def main():
+        outbox = _scheduler()
+        await outbox.initialize()
+        send = _recorder(calls)
+        await _request(outbox, send, "sendChatAction")
+        assert outbox._global.tokens == 1  # «печатает» токен не тратит
+        await _request(outbox, send, "sendMessage")
+        # оба бакета пусты: ответ на кнопку уходит сразу, «печатает» выбрасывается
+        assert await _request(outbox, send, "answerCallbackQuery") == "answerCallbackQuery"
+        assert await _request(outbox, send, "sendChatAction") is True
+        stats = outbox.stats()
+        await outbox.shutdown()
+        return stats
+
+    stats = asyncio.run(main())
+    assert calls == ["sendChatAction", "sendMessage", "answerCallbackQuery"]
+    assert stats["dropped_actions"] == 1
+    assert stats["sent"] == 1
+
+
+def test_webhook_workers_share_the_global_limit():
+    outbox = bot.OutboundScheduler(28.0, 30.0, 1.0, 3.0, 1)
+    outbox.share_global(4)
+    assert outbox._global.rate == 7.0 and outbox._global.burst == 7.5
+    assert outbox._global.tokens == 7.5
+    outbox.share_global(16)
+    assert outbox._global.burst == 1.0  # хотя бы одно сообщение без ожидания
+    assert outbox._chat_rate == 1.0 and outbox._chat_burst == 3.0
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+def _ctx():
+    return SimpleNamespace(user_data={bot.STORY_KEY: bot.DEFAULT_STORY, bot.LANG_KEY: "ru"})
+
+
+@pytest.fixture
+def char():
+    return next(iter(bot.CATALOG.story(bot.DEFAULT_STORY)))
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    store = bot.ReplyCache(2, 60.0, 1 << 20)
+    monkeypatch.setattr(bot, "REPLY_CACHE", True)
+    monkeypatch.setattr(bot, "REPLY_CACHE_MAX_HISTORY", 0)
+    monkeypatch.setattr(bot, "REPLY_CACHE_STORE", store)
+    return store
+
+
+def test_key_normalizes_text_and_covers_history(cache, char):
+    ctx = _ctx()
+    key = bot.reply_cache_key(ctx, char, "ru", "Привет!!")
+    assert key is not None
+    assert bot.reply_cache_key(ctx, char, "ru", "привет") == key
+    assert bot.reply_cache_key(ctx, char, "en", "привет") != key
+    bot._push_history(ctx, "user", "привет")
+    bot._push_history(ctx, "assistant", "a")
+    assert bot.reply_cache_key(ctx, char, "ru", "привет") is None  # только первый ход
+
+
+def test_variants_collected_before_serving(cache):
+    key = ("k",)
+    assert cache.add(key, "a")
+    assert cache.get(key) is None  # пока вариантов меньше REPLY_CACHE_VARIANTS — не отдаём
+    assert not cache.add(key, "a")
+    assert cache.add(key, "b")
+    assert cache.get(key) in ("a", "b")
+    assert not cache.add(key, "c")
+
+
+def test_byte_budget_and_ttl():
+    small = bot.ReplyCache(1, 100.0, 10)
+    small.add(("x",), "12345678")
+    small.add(("y",), "12345678")
+    assert len(small) == 1 and small.get(("y",)) == "12345678" and small.size == 8
+
+    short = bot.ReplyCache(1, 0.01, 100)
+    short.add(("x",), "a")
+    time.sleep(0.02)
+    assert short.get(("x",)) is None and short.size == 0
+
+
+def test_repeated_opening_turn_skips_llm(cache, char, monkeypatch):
+    monkeypatch.setattr(cache, "variants", 1)
+    monkeypatch.setattr(bot, "STREAM_REPLIES", False)
+    monkeypatch.setattr(bot, "CANDIDATES", 1)
+    monkeypatch.setattr(bot, "_LLM_SLOTS", None)
+    calls = []
+
+    async def llm(*a, **kw):
+        calls.append(a[2])
+        return "Здравствуй! Я рада тебя видеть."
+
+    async def no_action(*a, **kw):
+        pass
+
+    monkeypatch.setattr(bot, "call_openrouter", llm)
+    monkeypatch.setattr(bot, "send_action_safe", no_action)
+    replies = []
+
+    async def reply_text(text, **kw):
+        replies.append(text)
+
+    update = SimpleNamespace(message=SimpleNamespace(reply_text=reply_text), effective_user=None)
+
+    async def main():
+        for _ in range(2):  # два разных пользователя с одинаковым первым ходом
+            await bot.run_turn(update, _ctx(), char, "ru", "Привет!")
+
+    asyncio.run(main())
+    assert calls == ["Привет!"]
+    assert replies == ["Здравствуй! Я рада тебя видеть."] * 2
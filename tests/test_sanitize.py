@@ -0,0 +1,22 @@
+import random
+
+import pytest
+
+import bench
+import bot
+
+_rng = random.Random(1)
+CORPUS = bench.GOLDEN + [bench.realistic_reply(_rng, _rng.randint(5, 360), noise=0.3) for _ in range(300)]
+
+
+@pytest.mark.parametrize("text", CORPUS, ids=range(len(CORPUS)))
+def test_sanitize_matches_legacy(text):
+    want = bench._legacy_sanitize_reply(text)
+    assert bot.sanitize_reply(text) == want
+
+    rng = random.Random(text)
+    for _ in range(3):  # разные нарезки одного текста
+        stream = bot.StreamSanitizer()
+        for chunk in bench._chunks(text, rng):
+            stream.feed(chunk)
+        assert stream.finish() == want
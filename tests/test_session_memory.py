@@ -0,0 +1,106 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import ApplicationBuilder
+
+import bot
+
+MESSAGES = [{"role": "user", "content": "привет"}, {"role": "assistant", "content": "hi there"}]
+
+
+def test_history_freeze_and_copy():
+    hist = bot.DialogHistory.from_messages([MESSAGES[0], ["a", "hi there"]])
+    assert hist.as_messages() == MESSAGES
+    copy = hist.copy()
+    hist.freeze()
+    assert hist._texts is None
+    assert copy.packed() == [["u", "привет"], ["a", "hi there"]]
+    assert hist.last() == ("assistant", "hi there")  # чтение размораживает
+    assert hist._texts is not None
+
+
+def test_legacy_history_migrates_and_respects_budget(monkeypatch):
+    monkeypatch.setattr(bot, "HIST_TOKEN_BUDGET", 50)
+    ctx = SimpleNamespace(user_data={
+        bot.DIALOG_HISTORY: [{"role": "user", "content": "x"}], bot.DIALOG_TOKENS: [1], bot.DIALOG_TOKENS_SUM: 1,
+    })
+    for _ in range(40):
+        bot._push_history(ctx, "user", "word " * 5)
+    hist = bot._history(ctx)
+    assert 0 < hist.total <= 50 and hist.total == sum(hist.tokens)
+    assert bot.DIALOG_TOKENS not in ctx.user_data
+    assert bot._pop_history(ctx, "user", "word " * 5)
+    assert not bot._pop_history(ctx, "assistant", "zz")
+
+    restored = bot._unpack_user_data(bot._pack_user_data(ctx.user_data))
+    assert restored[bot.DIALOG_HISTORY].as_messages() == hist.as_messages()
+
+
+def test_sweep_compresses_then_evicts(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "SESSION_COMPRESS_AFTER", 100.0)
+    monkeypatch.setattr(bot, "SESSION_IDLE_TTL", 200.0)
+    monkeypatch.setattr(bot, "SESSION_MAX_RESIDENT", 0)
+    blob = bot._pack_user_data({bot.DIALOG_HISTORY: bot.DialogHistory.from_messages(MESSAGES)})
+
+    async def main():
+        app = ApplicationBuilder().token("1:test").build()
+        store = bot.StateStore(str(tmp_path / "state.sqlite3"), 999)
+        await store.open(app)
+        monkeypatch.setattr(bot, "STATE", store)
+        try:
+            for uid in (1, 2, 3):
+                app.user_data[uid].update(bot._unpack_user_data(blob))
+                store._loaded.add(uid)
+                store.touch(uid)
+                store.mark_dirty(uid)
+            now = time.monotonic()
+            store._seen[1] = now - 250  # выгрузить
+            store._seen[2] = now - 150  # только сжать
+            await store.sweep()
+
+            assert 1 not in app.user_data
+            assert app.user_data[2][bot.DIALOG_HISTORY]._texts is None
+            assert app.user_data[3][bot.DIALOG_HISTORY]._texts is not None
+            assert store.resident == 2
+            data = await store.load(1)  # выгруженный вернулся из базы целиком
+            assert data[bot.DIALOG_HISTORY].as_messages() == MESSAGES
+            assert b"pixorbi_sessions_resident 2" in bot.render_metrics()
+        finally:
+            await store.close()
+
+    asyncio.run(main())
+
+
+def test_failed_load_never_overwrites_saved_row(tmp_path, monkeypatch):
+    user = User(5, "u", False)
+    update = Update(1, message=Message(1, datetime.now(timezone.utc), Chat(5, "private"), from_user=user))
+
+    async def main():
+        app = ApplicationBuilder().token("1:test").build()
+        store = bot.StateStore(str(tmp_path / "state.sqlite3"), 999)
+        await store.open(app)
+        monkeypatch.setattr(bot, "STATE", store)
+        try:
+            await store._run(store._write_sync, [(5, {bot.STORY_KEY: "saved"})])
+            broken = store._load_sync
+            store._load_sync = lambda uid: 1 / 0  # база на миг недоступна
+            ctx = SimpleNamespace(user_data=app.user_data[5])
+            await bot.load_user_state(update, ctx)
+            ctx.user_data[bot.LANG_KEY] = "en"  # хендлер поработал с пустым user_data
+            await bot.mark_user_state(update, ctx)
+            await store.flush()
+
+            store._load_sync = broken
+            await bot.load_user_state(update, ctx)  # следующий апдейт загружает заново
+            assert ctx.user_data[bot.STORY_KEY] == "saved" and ctx.user_data[bot.LANG_KEY] == "en"
+            await bot.mark_user_state(update, ctx)
+            await store.flush()
+            return await store._run(store._load_sync, 5)
+        finally:
+            await store.close()
+
+    saved = asyncio.run(main())
+    assert saved[bot.STORY_KEY] == "saved" and saved[bot.LANG_KEY] == "en"
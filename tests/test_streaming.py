@@ -0,0 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class FakeMessage:
+    def __init__(self, log):
+        self.log = log
+
+    async def edit_text(self, text):
+        self.log.append(("edit", text))
+
+    async def delete(self):
+        self.log.append(("delete",))
+
+
+def _update(log):
+    async def reply_text(text, **kw):
+        log.append(("send", text))
+        return FakeMessage(log)
+
+    return SimpleNamespace(message=SimpleNamespace(reply_text=reply_text))
+
+
+def test_partial_reply_removed_on_deadline(monkeypatch):
+    async def slow_stream(*a, **kw):
+        yield "Сейчас расскажу тебе одну длинную историю, "
+        await asyncio.sleep(10)
+        yield "которая так и не закончится."
+
+    monkeypatch.setattr(bot, "stream_openrouter", slow_stream)
+    monkeypatch.setattr(bot, "STREAM_MIN_CHARS", 10)
+    log = []
+
+    async def main():
+        with pytest.raises(bot.DeadlineExceeded):
+            await bot.stream_reply(_update(log), SimpleNamespace(user_data={}), "c", "ru", "hi",
+                                   deadline=bot.Deadline(0.2))
+
+    asyncio.run(main())
+    assert log[0][0] == "send"
+    assert log[-1] == ("delete",)
@@ -0,0 +1,71 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import bench
+import bot
+
+TURNS = [{"role": "user", "content": "Меня зовут Аня."}, {"role": "assistant", "content": "Привет, Аня."}]
+
+
+@pytest.fixture
+def openrouter(monkeypatch):
+    port = bench._free_port()
+    monkeypatch.setattr(bot, "OPENROUTER_URL", f"http://127.0.0.1:{port}/v1/chat/completions")
+    monkeypatch.setattr(bot, "OPENROUTER_API_KEY", "test")
+    monkeypatch.setattr(bot, "LLM_QUEUE_TIMEOUT", 0.05)
+    monkeypatch.setattr(bot, "BREAKERS", {
+        name: bot.CircuitBreaker(name, 1, 60.0) for name in bot.BREAKERS
+    })
+    calls = []
+
+    async def handle(method, target, headers, body):
+        calls.append(bot._LLM_SLOTS.locked())  # слот занят, пока идёт запрос
+        json.loads(body)
+        return bench._json(200, {"choices": [{"message": {"content": "Пользователя зовут Аня."}}]})
+
+    async def run(coro_factory):
+        server = await bench.serve("127.0.0.1", port, handle)
+        bot._LLM_SLOTS = asyncio.Semaphore(1)
+        try:
+            return await coro_factory()
+        finally:
+            await bot.close_http_clients(SimpleNamespace(bot_data={}))
+            server.close()
+
+    monkeypatch.setattr(bot, "_LLM_SLOTS", None)
+    return SimpleNamespace(calls=calls, run=lambda f: asyncio.run(run(f)))
+
+
+def test_summary_takes_llm_slot(openrouter):
+    async def go():
+        summary = await bot._llm_summary("", TURNS, "ru")
+        return summary, bot._LLM_SLOTS.locked()
+
+    summary, locked_after = openrouter.run(go)
+    assert summary == "Пользователя зовут Аня."
+    assert openrouter.calls == [True]
+    assert not locked_after
+
+
+def test_summary_waits_for_busy_slots(openrouter):
+    async def go():
+        await bot._LLM_SLOTS.acquire()  # все слоты у живых ходов
+        with pytest.raises(bot.LLMBusy):
+            await bot._llm_summary("", TURNS, "ru")
+
+    openrouter.run(go)
+    assert openrouter.calls == []
+
+
+def test_summary_respects_open_breaker(openrouter):
+    bot.BREAKERS[bot.UPSTREAM_OPENROUTER].failure()  # порог 1 — предохранитель открыт
+
+    async def go():
+        with pytest.raises(bot.UpstreamUnavailable):
+            await bot._llm_summary("", TURNS, "ru")
+
+    openrouter.run(go)
+    assert openrouter.calls == []
@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    gate = SimpleNamespace(started=None, release=None)
+
+    async def generate(*a, **kw):
+        gate.started.set()
+        await gate.release.wait()
+        return "Ответ старого персонажа Эллиса."
+
+    async def no_action(*a, **kw):
+        pass
+
+    monkeypatch.setattr(bot, "call_openrouter", generate)
+    monkeypatch.setattr(bot, "send_action_safe", no_action)
+    monkeypatch.setattr(bot, "STREAM_REPLIES", False)
+    monkeypatch.setattr(bot, "CANDIDATES", 1)
+    monkeypatch.setattr(bot, "_LLM_SLOTS", None)
+    return gate
+
+
+def test_menu_reset_during_turn_drops_reply(llm):
+    replies = []
+
+    async def reply_text(text, **kw):
+        replies.append(text)
+
+    update = SimpleNamespace(message=SimpleNamespace(reply_text=reply_text), effective_user=None)
+    ctx = SimpleNamespace(user_data={bot.STORY_KEY: bot.DEFAULT_STORY, bot.CHAR_KEY: "ellis", bot.LANG_KEY: "ru"})
+
+    async def main():
+        llm.started, llm.release = asyncio.Event(), asyncio.Event()
+        turn = asyncio.create_task(bot.run_turn(update, ctx, "ellis", "ru", "Привет"))
+        await llm.started.wait()
+        ctx.user_data[bot.CHAR_KEY] = "kyle"  # кнопка «char|kyle» из быстрой полосы
+        bot.reset_setup(ctx)
+        llm.release.set()
+        await turn
+
+    asyncio.run(main())
+    assert bot._history(ctx).as_messages() == []
+    assert replies == []
@@ -0,0 +1,128 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+import bench
+import bot
+
+
+def test_watermark_waits_for_earliest_update():
+    marks = bot.UpdateWatermark()
+    for update_id in (1, 2, 3):
+        marks.begin(update_id)
+    marks.done(2)
+    assert marks.value == 0
+    marks.done(1)
+    assert marks.value == 2
+    marks.begin(3)  # второе удержание того же апдейта (серия сообщений)
+    marks.done(3)
+    assert marks.value == 2
+    marks.done(3)
+    assert marks.value == 3
+    marks.resume(10)
+    assert marks.value == 10
+
+
+def test_watermark_remembers_updates_done_ahead():
+    marks = bot.UpdateWatermark()
+    for update_id in (5, 6, 7):
+        marks.begin(update_id)
+    marks.done(7)
+    assert marks.value == 4 and marks.finished(7) and not marks.finished(6)
+    assert marks.ahead() == [7]
+    marks.done(5)
+    marks.done(6)
+    assert marks.value == 7 and marks.ahead() == []
+
+    again = bot.UpdateWatermark()
+    again.resume(4, [7, 3])
+    assert again.value == 4 and again.finished(7) and not again.finished(5)
+    assert again.ahead() == [7]
+
+
+class _PollingBot:
+    """getUpdates как у Telegram: отдаёт всё, что не ниже offset."""
+
+    def __init__(self, updates, stop):
+        self.updates, self.stop, self.offsets = updates, stop, []
+
+    async def get_updates(self, offset=None, **kwargs):
+        self.offsets.append(offset)
+        if len(self.offsets) >= 4:
+            self.stop.set()
+        await asyncio.sleep(0)
+        return [u for u in self.updates if offset is None or u.update_id >= offset]
+
+
+def test_warm_poller_confirms_only_finished_updates(monkeypatch):
+    marks = bot.UpdateWatermark()
+    monkeypatch.setattr(bot, "UPDATES", marks)
+    monkeypatch.setattr(bot, "WARM_REFETCH_INTERVAL", 0.01)
+    monkeypatch.setattr(bot, "WARM_CATCHUP_MAX_AGE", 0.0)
+
+    async def main():
+        stop = asyncio.Event()
+        fake = _PollingBot([Update(update_id=i) for i in (1, 2, 3)], stop)
+        app = SimpleNamespace(bot=fake, update_queue=asyncio.Queue())
+        poller = bot.WarmPoller(app)
+        task = asyncio.create_task(poller.run(stop))
+        got = [(await app.update_queue.get()).update_id for _ in range(3)]
+        marks.done(2)  # 1 ещё в работе: Telegram должен отдавать его снова
+        await task
+        return got, fake.offsets, poller.stats
+
+    got, offsets, stats = asyncio.run(main())
+    assert got == [1, 2, 3]
+    assert set(offsets) == {None}  # апдейт 1 не обработан — подтверждать Telegram нечего
+    assert stats["queued"] == 3 and stats["refetched"] >= 3
+    marks.done(1)
+    assert marks.value == 2
+
+
+def test_offset_survives_store_reopen(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "WARM_RESTART", True)
+    monkeypatch.setattr(bot, "BOT_MODE", "polling")
+    marks = bot.UpdateWatermark()
+    monkeypatch.setattr(bot, "UPDATES", marks)
+    path = str(tmp_path / "state.sqlite3")
+
+    async def main():
+        app = ApplicationBuilder().token("1:test").build()
+        store = bot.StateStore(path, 999)
+        await store.open(app)
+        marks.begin(41)
+        marks.done(41)
+        await store.flush()
+        await store.close()
+
+        again = bot.StateStore(path, 999)
+        await again.open(app)
+        try:
+            return await again.load_offset()
+        finally:
+            await again.close()
+
+    assert asyncio.run(main()) == (41, [])
+
+
+def test_warm_restart_answers_messages_sent_while_down(tmp_path):
+    out = tmp_path / "restart.json"
+    code = bench.main(["restart", "--users", "5", "--warm", "--downtime", "0.5", "--step-timeout", "20",
+                       "--bot-log", str(tmp_path / "bot.log"), "--json", str(out), "--fail-on-error"])
+    result = json.loads(out.read_text())
+    assert code == 0
+    assert result["answered"] == 5 and result["dropped_by_telegram"] == 0
+
+
+def test_warm_restart_recovers_turns_killed_mid_generation(tmp_path, monkeypatch):
+    monkeypatch.setenv("STATE_FLUSH_INTERVAL", "0.5")
+    out = tmp_path / "midturn.json"
+    code = bench.main(["restart", "--users", "5", "--warm", "--crash", "--midturn", "0.5", "--llm-latency", "3000",
+                       "--llm-sigma", "0", "--downtime", "0.3", "--step-timeout", "20",
+                       "--bot-log", str(tmp_path / "bot.log"), "--json", str(out), "--fail-on-error"])
+    result = json.loads(out.read_text())
+    assert code == 0
+    assert result["answered"] == 5 and result["repeated"] == 0
@@ -0,0 +1,74 @@
+"""Приёмник + 2 воркера подпроцессом против фейкового Bot API из bench.py."""
+import asyncio
+import json
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import bench
+
+USERS = 6
+MESSAGES = 8
+
+
+class EchoLLM:
+    """Отвечает текстом самого сообщения и запоминает, что видел."""
+
+    def __init__(self):
+        self.seen = Counter()
+
+    async def handle(self, method, target, headers, body):
+        if method != "POST":
+            return 200, "text/plain", b"" if method == "HEAD" else b"ok"
+        data = json.loads(body or b"{}")
+        if urlsplit(target).path.endswith("/chat"):
+            self.seen[data["message"]] += 1
+            await asyncio.sleep(0.02)
+            return bench._json(200, {"reply": f"Получила сообщение {data['message']}, спасибо."})
+        return bench._json(404, {"error": "not found"})
+
+
+def test_two_workers_keep_chat_order_and_handle_once(tmp_path):
+    args = SimpleNamespace(mode="webhook", workers=2, metrics_port=0, startup_timeout=60.0,
+                           bot_log=str(tmp_path / "bot.log"), step_timeout=15.0, lang="ru", turns=0, think=0)
+
+    async def main():
+        api_port, llm_port = bench._free_port(), bench._free_port()
+        args.webhook_port = bench._free_port()
+        tg = bench.FakeTelegram(f"http://127.0.0.1:{args.webhook_port}/telegram", "bench-secret")
+        llm = EchoLLM()
+        servers = [await bench.serve("127.0.0.1", api_port, tg.handle),
+                   await bench.serve("127.0.0.1", llm_port, llm.handle)]
+        env = bench.bot_env(args, api_port, llm_port, str(tmp_path))
+        env["STATE_DB"] = ""
+        proc = bench.start_bot(env, args.bot_log)
+        try:
+            await bench.wait_ready(tg, args, proc)
+            rec = bench.Recorder()
+            chats = [200_000 + i for i in range(USERS)]
+            await asyncio.gather(*(bench.run_user(tg, rec, chat, args) for chat in chats))
+            assert not rec.errors, rec.errors
+
+            inboxes = {chat: tg.inbox.setdefault(chat, asyncio.Queue()) for chat in chats}
+            for n in range(MESSAGES):  # без ожидания ответов, чаты вперемешку
+                for chat in chats:
+                    await tg.push(tg.user_message(chat, f"{chat}-{n}"))
+
+            replies = {chat: [] for chat in chats}
+            for chat, inbox in inboxes.items():
+                while len(replies[chat]) < MESSAGES:
+                    method, msg, _ = await asyncio.wait_for(inbox.get(), 30)
+                    if method == "sendMessage":
+                        replies[chat].append(msg["text"])
+            await tg.settle(quiet=0.5)
+            return replies, llm.seen
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, bench.stop_bot, proc)
+            await tg.close()
+            for server in servers:
+                server.close()
+
+    replies, seen = asyncio.run(main())
+    for chat, texts in replies.items():
+        assert texts == [f"Получила сообщение {chat}-{n}, спасибо." for n in range(MESSAGES)]
+    assert seen == Counter({f"{chat}-{n}": 1 for chat in replies for n in range(MESSAGES)})